@@ -3,8 +3,13 @@ CLI to add new hands to the dataset efficienctly.
 """
 import json
 import os
-import pymongo
+import time
 import bson
+import auction
+import deal_hashing
+import hand_features
+import search_index
+import storage
 
 def parse_hand_string_to_list(hand_str):
     """
@@ -68,12 +73,13 @@ def validate_and_parse(key, value):
         assert value in ["N", "S", "E", "W"]
         parsed_value = value 
 
-    # Validate auction: currently simply check for string.
-    # TODO add more sophisticated validation that
-    # it is a legal auction.
+    # Validate auction: must be a string holding a legal (possibly
+    # incomplete) auction.
     elif key == "auction":
 
-        assert type(key) == type("")
+        assert type(value) == type(""), NOT_STRING_ERROR
+        # This function will raise an exception if the auction is illegal.
+        auction.parse_auction(value)
         parsed_value = value
 
     # Validate hidden hands: string with NSEW only.
@@ -91,7 +97,7 @@ def validate_and_parse(key, value):
 
     # Validate keys which simply must be strings.
     elif key in ["notes", "correct_answer", "notes", "hand_id", "explanation", 
-            "source", "question"]:
+            "source", "question", "context"]:
         assert type(value) == type("aa"), NOT_STRING_ERROR
         parsed_value = value
     
@@ -183,9 +189,7 @@ def enter_hands_wrapper():
     """ wrapper function to enter hands """
 
     # Load existing hands.
-    client = pymongo.MongoClient()
-    db = client["bridge_problem_database"]
-    hands_collection = db["hands"]
+    hand_storage = storage.get_storage()
 
     # While user wants to keep entering hands, enter one 
     done = False
@@ -204,20 +208,38 @@ def enter_hands_wrapper():
         # results as a json. 
         hand_json = ask_for_hand()
 
-        # Add the new hand to the MongoDB database.
-        hands_collection.insert_one(hand_json)
+        # Warn if the deal is already in the database, perhaps rotated,
+        # with the suits swapped, or with other spot cards.
+        hand_json["deal_hashes"] = deal_hashing.compute_deal_hashes(hand_json)
+        for kind, similarity, duplicate_json in deal_hashing.find_duplicates(
+                hand_storage, hand_json):
+            print("Warning: possible duplicate ({}, similarity {:.2f}) of hand {}, "
+                    "source: {}".format(kind, similarity, duplicate_json["_id"],
+                        duplicate_json.get("source")))
+
+        # Add the new hand to the database, and tell running apps to
+        # reload their cached hands. updated_at lets backup_database.py
+        # export only changed hands, and the features let problems be
+        # found by indexed queries (see hand_features.py).
+        hand_json["updated_at"] = time.time()
+        hand_json["features"] = hand_features.compute_features(hand_json)
+        generation = hand_storage.read_generation()
+        n_inserted, failures = hand_storage.insert_hands([hand_json])
+        INSERT_FAILED_ERROR = "hand was not added: {}".format(failures)
+        assert n_inserted == 1, INSERT_FAILED_ERROR
+        hand_storage.bump_generation()
+
+        # Add the hand to the search index when it is next opened.
+        search_index.record_change(hand_json, generation=generation)
 
         # Update the user on how many hands are currently in the database.
-        print("Hands currently in the database: ", 
-                hands_collection.count_documents({}))
+        print("Hands currently in the database: ", hand_storage.count_hands())
 
 
 def edit_hands_wrapper():
 
     # Load existing hands.
-    client = pymongo.MongoClient()
-    db = client["bridge_problem_database"]
-    hands_collection = db["hands"]
+    hand_storage = storage.get_storage()
 
     # Ask the user if they want to make another change.
     # While they want to make changes, accept changes one 
@@ -237,11 +259,10 @@ def edit_hands_wrapper():
         hand_id_to_edit = input("which hand id would you like to edit?:  ")
         hand_id_to_edit = bson.objectid.ObjectId(hand_id_to_edit)
 
-        # Need to list valid hand IDs from mongo db.
+        # Need to list valid hand IDs from the database.
         INVALID_HAND_ID_ERROR = "hand id does not exist"
-        HAND_ID_EXISTS = (type(hands_collection.find_one({"_id" : hand_id_to_edit})) 
-                == type({"a": "b"}))
-        assert HAND_ID_EXISTS, INVALID_HAND_ID_ERROR
+        edited_hand_json = hand_storage.get_hand(hand_id_to_edit)
+        assert edited_hand_json is not None, INVALID_HAND_ID_ERROR
         
         # Ask which key to edit.
         key_to_edit = input("which key would you like to edit?:  ")
@@ -251,10 +272,7 @@ def edit_hands_wrapper():
         assert key_to_edit in valid_keys, INVALID_KEY_ERROR
 
         # Show the old value of this key.
-        OLD_KEY_VALUE = hands_collection.find_one(
-            {"_id" : hand_id_to_edit}, # filter by
-            {key_to_edit : 1, "_id": 0} # return fields where value = 1.
-            )[key_to_edit]
+        OLD_KEY_VALUE = edited_hand_json.get(key_to_edit)
         
         OLD_VALUE_MSG = "The old value of this key was: {}".format(OLD_KEY_VALUE)
         print(OLD_VALUE_MSG)
@@ -266,11 +284,23 @@ def edit_hands_wrapper():
         new_value = input("What should the new value be?:  ")
         new_value = validate_and_parse(key_to_edit, new_value)
 
-        # Update the relevant record in the database.
-        query = {"_id" : hand_id_to_edit} # update rows matching this query.
-        update = {"$set" : {key_to_edit : new_value}} # update to perform.
+        # Recompute the features of the edited hand.
+        edited_hand_json[key_to_edit] = new_value
+        features = hand_features.compute_features(edited_hand_json)
+        edited_hand_json["features"] = features
+        deal_hashes = deal_hashing.compute_deal_hashes(edited_hand_json)
 
-        hands_collection.update_one(query, update)
+        # Update the relevant record in the database.
+        fields = {key_to_edit : new_value, "features" : features,
+                "deal_hashes" : deal_hashes, "updated_at" : time.time()}
+        generation = hand_storage.read_generation()
+        hand_storage.update_hand(hand_id_to_edit, fields)
+
+        # Tell running apps to reload their cached hands, and reindex the
+        # hand for search.
+        hand_storage.bump_generation()
+        edited_hand_json.update(fields)
+        search_index.record_change(edited_hand_json, generation=generation)
 
 def ask_to_add_or_edit():
     """
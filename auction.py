@@ -0,0 +1,166 @@
+"""
+Parse and check auctions stored as strings, e.g. "P 1N P 2N P P P".
+
+Calls are separated by whitespace, starting with the dealer:
+    P            pass
+    X / XX       double / redouble
+    1C ... 7N    bids, with strains C D H S N (NT is accepted for N)
+A bidding problem may end with "?" for the call the solver should find.
+"""
+
+SEATS = "NESW"
+STRAINS = "CDHSN" # in ascending order.
+
+def normalize_call(call):
+    """
+    Normalize one call, e.g. "pass" -> "P", "1nt" -> "1N", "dbl" -> "X".
+
+    Parameters:
+        call (string)
+
+    Returns:
+        call (string) one of P, X, XX, ?, or a bid such as 1N.
+    """
+
+    INVALID_CALL_ERROR = "call not understood: {}".format(call)
+
+    call = call.upper()
+    aliases = {"PASS" : "P", "D" : "X", "DBL" : "X", "R" : "XX", "RDBL" : "XX"}
+    call = aliases.get(call, call)
+    if call.endswith("NT"):
+        call = call[:-1]
+
+    if call in ["P", "X", "XX", "?"]:
+        return call
+
+    assert len(call) == 2, INVALID_CALL_ERROR
+    assert call[0] in "1234567", INVALID_CALL_ERROR
+    assert call[1] in STRAINS, INVALID_CALL_ERROR
+
+    return call
+
+def bid_rank(bid):
+    """Return a sortable rank of a bid, 1C = 0 ... 7N = 34."""
+
+    return 5*(int(bid[0]) - 1) + STRAINS.index(bid[1])
+
+def parse_auction(auction_string):
+    """
+    Parse an auction string to a list of calls, checking it is legal.
+
+    Parameters:
+        auction_string (string) e.g. "P 1N P 2N P P P", possibly empty,
+        possibly incomplete, possibly ending with "?".
+
+    Returns:
+        calls (string []) e.g. ["P", "1N", "P", "2N", "P", "P", "P"]
+
+    Raises an AssertionError describing the first illegal call.
+    """
+
+    calls = [normalize_call(call) for call in auction_string.split()]
+
+    QUESTION_NOT_LAST_ERROR = "? may only be the last call"
+    for call in calls[:-1]:
+        assert call != "?", QUESTION_NOT_LAST_ERROR
+
+    last_bid_rank = -1
+    last_bid_position = None # position of the last bid.
+    doubled = "" # "", "X" or "XX" for the last bid.
+    passes_in_a_row = 0
+    for position, call in enumerate(calls):
+
+        AUCTION_OVER_ERROR = "call {} comes after the auction ended".format(position + 1)
+        auction_over = (passes_in_a_row == 4 or
+                (last_bid_position is not None and passes_in_a_row == 3))
+        assert not auction_over, AUCTION_OVER_ERROR
+
+        # Opponents of the last bidder are at an odd distance from them.
+        by_opponents = (last_bid_position is not None and
+                (position - last_bid_position) % 2 == 1)
+
+        if call == "P":
+            passes_in_a_row += 1
+            continue
+        if call == "?":
+            continue
+        passes_in_a_row = 0
+
+        if call == "X":
+            ILLEGAL_DOUBLE_ERROR = "call {}: X is only allowed over an opponent's undoubled bid".format(
+                    position + 1)
+            assert by_opponents and doubled == "", ILLEGAL_DOUBLE_ERROR
+            doubled = "X"
+        elif call == "XX":
+            ILLEGAL_REDOUBLE_ERROR = "call {}: XX is only allowed over an opponent's X".format(
+                    position + 1)
+            assert not by_opponents and last_bid_position is not None \
+                    and doubled == "X", ILLEGAL_REDOUBLE_ERROR
+            doubled = "XX"
+        else:
+            INSUFFICIENT_BID_ERROR = "call {}: {} is insufficient".format(
+                    position + 1, call)
+            assert bid_rank(call) > last_bid_rank, INSUFFICIENT_BID_ERROR
+            last_bid_rank = bid_rank(call)
+            last_bid_position = position
+            doubled = ""
+
+    return calls
+
+def is_complete(calls):
+    """Return True if the auction (a list of calls) has ended."""
+
+    if len(calls) >= 4 and calls[:4] == ["P"]*4:
+        return True
+    has_bid = any(call not in ["P", "X", "XX", "?"] for call in calls)
+    return has_bid and len(calls) >= 4 and calls[-3:] == ["P"]*3
+
+def final_contract(auction_string, dealer):
+    """
+    Return the contract reached by an auction.
+
+    Parameters:
+        auction_string (string) e.g. "1N P 3N P P P"
+        dealer (string) N S E or W
+
+    Returns:
+        contract (dict or None) e.g.
+            {"level" : 3, "strain" : "N", "doubled" : "", "declarer" : "N"}
+        or None if there is no bid yet. For an auction still in progress,
+        the contract is the one that would be played if everyone passed.
+    """
+
+    calls = parse_auction(auction_string)
+    dealer_index = SEATS.index(dealer)
+
+    last_bid_position = None
+    doubled = ""
+    for position, call in enumerate(calls):
+        if call in ["P", "?"]:
+            continue
+        if call in ["X", "XX"]:
+            doubled = call
+        else:
+            last_bid_position = position
+            doubled = ""
+
+    if last_bid_position is None:
+        return None
+
+    # The declarer is the first player of the declaring side to name
+    # the final strain.
+    strain = calls[last_bid_position][1]
+    declaring_side = last_bid_position % 2
+    for position, call in enumerate(calls):
+        if position % 2 == declaring_side and call[-1] == strain and call[0] in "1234567":
+            declarer = SEATS[(dealer_index + position) % 4]
+            break
+
+    contract = {
+        "level" : int(calls[last_bid_position][0]),
+        "strain" : strain,
+        "doubled" : doubled,
+        "declarer" : declarer
+    }
+
+    return contract
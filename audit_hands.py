@@ -0,0 +1,319 @@
+"""
+CLI to audit every hand in the database in one pass.
+
+Each hand is checked for a complete deal (13 cards per seat, 52 different
+cards), a legal auction, a dealer in NSEW and well-formed text fields.
+Hands are read lazily from the configured storage backend (see
+storage.py), or from a backup file (a JSON array such as data/hands.json,
+or one document per line such as database_backup/hands_backup_6_14.json),
+and checked in a process pool.
+
+One JSON line per hand is appended to the report, and the report doubles
+as the checkpoint: with --resume, hands already in the report are skipped.
+
+Usage:
+    python audit_hands.py --report audit.jsonl
+    python audit_hands.py --json database_backup/hands_backup_6_14.json
+    python audit_hands.py --resume
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import auction
+from deal import SEAT_KEYS, hand_list_to_mask, Deal
+
+# Keys which must hold strings when present.
+STRING_KEYS = ["question", "context", "correct_answer", "explanation",
+        "source", "notes"]
+
+# Characters read at a time from a JSON array file.
+JSON_CHUNK_SIZE = 1 << 16
+
+# Chunks per worker handed to the pool at a time. The pool reads its
+# whole input at once, so it is fed in windows to keep the streaming
+# readers streaming.
+CHUNKS_IN_FLIGHT = 4
+
+def iter_json_array(f, chunk_size=JSON_CHUNK_SIZE):
+    """
+    Yield the elements of a JSON array from a file, one at a time, so
+    memory use is that of one element rather than the whole array.
+
+    Parameters:
+        f (file object) open for reading text, positioned before the "[".
+        chunk_size (int) characters read at a time.
+
+    Yields:
+        element (json)
+    """
+
+    decoder = json.JSONDecoder()
+    buffer, position, at_end = "", 0, False
+
+    def read_more():
+        nonlocal buffer, position, at_end
+        chunk = f.read(chunk_size)
+        at_end = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def next_char():
+        # Skip whitespace, reading on as needed; "" at the end of the file.
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer) or at_end:
+                return buffer[position:position + 1]
+            read_more()
+
+    NOT_AN_ARRAY_ERROR = "expected a JSON array"
+    if next_char() != "[":
+        raise ValueError(NOT_AN_ARRAY_ERROR)
+    position += 1
+
+    if next_char() == "]":
+        return
+
+    while True:
+        # Decode the next element, reading on while it is cut off. A number
+        # followed only by number characters may be cut off, so read on.
+        next_char()
+        while True:
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if at_end:
+                    raise
+                read_more()
+                continue
+            if at_end or buffer[end:].lstrip("0123456789+-.eE"):
+                break
+            read_more()
+        position = end
+        yield element
+
+        separator = next_char()
+        position += 1
+        if separator == "]":
+            return
+        BAD_SEPARATOR_ERROR = "expected , or ] after element, not {!r}".format(separator)
+        if separator != ",":
+            raise ValueError(BAD_SEPARATOR_ERROR)
+
+def iter_hands_from_file(path):
+    """
+    Yield hand documents from a backup file, one at a time.
+
+    Parameters:
+        path (string) a JSON array of hands, or one JSON hand per line.
+
+    Yields:
+        hand_json (json)
+    """
+
+    with open(path) as f:
+        first_char = f.read(1)
+        while first_char.isspace():
+            first_char = f.read(1)
+        f.seek(0)
+
+        # A JSON array is parsed one element at a time.
+        if first_char == "[":
+            for hand_json in iter_json_array(f):
+                yield hand_json
+            return
+
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def iter_hands_from_storage():
+    """Yield hand documents from the storage backend, one at a time."""
+
+    import storage
+
+    for hand_json in storage.get_storage().iter_hands():
+        yield hand_json
+
+def audit_hand(hand_json):
+    """
+    Check one hand, returning a report rather than raising.
+
+    Parameters:
+        hand_json (json) a hand document; "_id" must already be a string.
+
+    Returns:
+        report (dict) e.g.
+            {"hand_id" : "5eb6...", "ok" : False,
+             "errors" : ["auction: call 3: 1C is insufficient"]}
+    """
+
+    errors = []
+
+    # Each seat holds 13 valid, different cards.
+    seats_ok = True
+    for key in SEAT_KEYS:
+        try:
+            hand = hand_json[key]
+            assert isinstance(hand, list), "a list of cards is required"
+            hand_list_to_mask(hand)
+            assert len(hand) == 13, "{} cards, not 13".format(len(hand))
+        except KeyError:
+            errors.append("{}: missing".format(key))
+            seats_ok = False
+        except AssertionError as e:
+            errors.append("{}: {}".format(key, e))
+            seats_ok = False
+
+    # The four hands together are the 52 cards.
+    if seats_ok:
+        try:
+            Deal.from_hand_json(hand_json).validate()
+        except AssertionError as e:
+            errors.append("deal: {}".format(e))
+
+    dealer = hand_json.get("dealer")
+    if dealer not in ["N", "S", "E", "W"]:
+        errors.append("dealer: {!r} is not one of N S E W".format(dealer))
+
+    auction_string = hand_json.get("auction")
+    if not isinstance(auction_string, str):
+        errors.append("auction: {!r} is not a string".format(auction_string))
+    else:
+        try:
+            auction.parse_auction(auction_string)
+        except AssertionError as e:
+            errors.append("auction: {}".format(e))
+
+    hidden_hands = hand_json.get("hidden_hands", "")
+    if not isinstance(hidden_hands, str) or not all(
+            c.lower() in "nsew" for c in hidden_hands):
+        errors.append("hidden_hands: {!r} may only contain NSEW".format(hidden_hands))
+
+    for key in STRING_KEYS:
+        if key in hand_json and not isinstance(hand_json[key], str):
+            errors.append("{}: a string is required".format(key))
+    if "question" not in hand_json and "context" not in hand_json:
+        errors.append("question: missing")
+    if "correct_answer" not in hand_json:
+        errors.append("correct_answer: missing")
+
+    if not isinstance(hand_json.get("elo"), (int, float)):
+        errors.append("elo: a number is required")
+
+    report = {
+        "hand_id" : hand_json["_id"],
+        "ok" : len(errors) == 0,
+        "errors" : errors
+    }
+
+    return report
+
+def iter_hands_to_audit(hands, audited_ids):
+    """
+    Give every hand a string _id, and skip hands already audited.
+
+    Hands without an _id (e.g. in data/hands.json) are identified by their
+    position in the file, e.g. "#12".
+    """
+
+    for position, hand_json in enumerate(hands):
+        hand_id = hand_json.get("_id")
+        if isinstance(hand_id, dict) and "$oid" in hand_id: # mongoexport format.
+            hand_id = hand_id["$oid"]
+        hand_id = "#{}".format(position) if hand_id is None else str(hand_id)
+
+        if hand_id in audited_ids:
+            continue
+
+        hand_json = dict(hand_json)
+        hand_json["_id"] = hand_id
+        yield hand_json
+
+def read_audited_ids(report_path):
+    """Return the ids of hands already in a report, to resume an audit."""
+
+    audited_ids = set()
+    if not os.path.exists(report_path):
+        return audited_ids
+
+    with open(report_path) as f:
+        for line in f:
+            # A crash can leave a partly written last line; audit it again.
+            try:
+                audited_ids.add(json.loads(line)["hand_id"])
+            except ValueError:
+                continue
+
+    return audited_ids
+
+def audit_wrapper(report_path, json_path=None, resume=False,
+        processes=None, chunksize=16):
+    """
+    Audit every hand, appending one JSON line per hand to report_path.
+
+    Parameters:
+        report_path (string)
+        json_path (string) read hands from this file rather than storage.
+        resume (boolean) skip hands already in the report.
+        processes (int) pool size, default one per core.
+        chunksize (int) hands sent to a worker at a time.
+
+    Returns:
+        (n_audited, n_failed) counts for this run.
+    """
+
+    audited_ids = read_audited_ids(report_path) if resume else set()
+    hands = (iter_hands_from_file(json_path) if json_path is not None
+            else iter_hands_from_storage())
+    hands_to_audit = iter_hands_to_audit(hands, audited_ids)
+
+    n_audited = 0
+    n_failed = 0
+    window_size = chunksize*CHUNKS_IN_FLIGHT*(processes or os.cpu_count() or 1)
+    mode = "a" if resume else "w"
+    with open(report_path, mode) as report_file, \
+            multiprocessing.Pool(processes) as pool:
+
+        # Start on a fresh line after a crash mid-write.
+        if report_file.tell() > 0:
+            with open(report_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    report_file.write("\n")
+
+        while True:
+            window = list(itertools.islice(hands_to_audit, window_size))
+            if not window:
+                break
+
+            for report in pool.imap_unordered(audit_hand, window, chunksize):
+                report_file.write(json.dumps(report) + "\n")
+                report_file.flush() # so the report is a valid checkpoint.
+
+                n_audited += 1
+                if not report["ok"]:
+                    n_failed += 1
+
+    return n_audited, n_failed
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--json", help="audit a backup file instead of the database")
+    parser.add_argument("--report", default="audit_report.jsonl",
+            help="JSON-lines report, one line per hand")
+    parser.add_argument("--resume", action="store_true",
+            help="skip hands already in the report")
+    parser.add_argument("--processes", type=int, default=None,
+            help="worker processes (default: one per core)")
+    parser.add_argument("--chunksize", type=int, default=16)
+    args = parser.parse_args()
+
+    n_audited, n_failed = audit_wrapper(report_path=args.report,
+            json_path=args.json, resume=args.resume,
+            processes=args.processes, chunksize=args.chunksize)
+    print("Hands audited: {} Hands with errors: {}".format(n_audited, n_failed))
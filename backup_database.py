@@ -0,0 +1,273 @@
+"""
+CLI to back up the database incrementally, and to restore it.
+
+Each backup run streams the hands, user and events collections to gzipped
+JSON-lines chunks (MongoDB extended JSON, so ObjectIds survive) under
+<backup_dir>/<run_id>/, e.g.
+
+    database_backup/incremental/20200614-093000/hands-00000.jsonl.gz
+
+and records a high-water mark per collection in
+<backup_dir>/backup_state.json. The next run exports only what changed
+since the marks:
+    hands, user   documents with updated_at at or after the start of the
+                  previous run. Every write path sets updated_at; the first
+                  run exports everything, including older documents
+                  without it.
+    events        documents with an _id created at or after the start of
+                  the previous run, less --overlap seconds, since events
+                  are written in delayed batches by event_sink.py.
+
+Documents are read from a cursor and written as they come, so time and
+memory depend on the change set, not the size of the database.
+
+Restore replays the runs oldest first, upserting each document by _id with
+bulk writes, so later runs overwrite earlier copies. Deleted documents are
+not tracked, and so are not deleted by a restore.
+
+Only the Mongo backend is backed up. With BRIDGE_STORAGE=sqlite (see
+storage.py) the database is one file; copy it with the sqlite3 shell's
+.backup command, which is safe while the app is writing.
+
+Usage:
+    python backup_database.py backup
+    python backup_database.py backup --full --backup-dir /mnt/backups
+    python backup_database.py restore
+    python backup_database.py restore --collections hands --until 20200614-093000
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import time
+from bson import json_util, ObjectId
+import pymongo
+import db
+import hand_cache
+
+DEFAULT_BACKUP_DIR = os.path.join("database_backup", "incremental")
+STATE_FILE = "backup_state.json"
+COLLECTIONS = ["hands", "user", "events"]
+
+DEFAULT_CHUNK_SIZE = 50000
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_OVERLAP = 3600 # seconds
+
+def read_state(backup_dir):
+    """Return the backup state: {"runs" : [run ids], "marks" : {...}}."""
+
+    path = os.path.join(backup_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {"runs" : [], "marks" : {}}
+
+    with open(path) as f:
+        return json.load(f)
+
+def write_state(backup_dir, state):
+    """Write the backup state atomically, so a failed run leaves the old one."""
+
+    path = os.path.join(backup_dir, STATE_FILE)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(temporary_path, path)
+
+    return None
+
+def changed_documents_query(collection_name, mark, overlap=DEFAULT_OVERLAP):
+    """
+    Return the filter selecting documents changed since a mark.
+
+    Parameters:
+        collection_name (string) hands, user or events.
+        mark (float) start time of the previous run, or None for all.
+        overlap (float) seconds to look back further for events.
+    """
+
+    if mark is None:
+        return {}
+
+    if collection_name == "events":
+        since = datetime.datetime.fromtimestamp(mark - overlap, datetime.timezone.utc)
+        return {"_id" : {"$gte" : ObjectId.from_datetime(since)}}
+
+    return {"updated_at" : {"$gte" : mark}}
+
+def write_chunks(documents, run_dir, collection_name, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Write documents to gzipped JSON-lines files of chunk_size documents.
+
+    Returns:
+        (n_documents, paths) documents written, and the files written.
+    """
+
+    n_documents = 0
+    paths = []
+    chunk_file = None
+    try:
+        for document in documents:
+            if n_documents % chunk_size == 0:
+                if chunk_file is not None:
+                    chunk_file.close()
+                path = os.path.join(run_dir, "{}-{:05d}.jsonl.gz".format(
+                    collection_name, len(paths)))
+                chunk_file = gzip.open(path, "wt", encoding="utf-8")
+                paths.append(path)
+            chunk_file.write(json_util.dumps(document) + "\n")
+            n_documents += 1
+    finally:
+        if chunk_file is not None:
+            chunk_file.close()
+
+    return n_documents, paths
+
+def backup(database, backup_dir=DEFAULT_BACKUP_DIR, full=False,
+        chunk_size=DEFAULT_CHUNK_SIZE, overlap=DEFAULT_OVERLAP,
+        collections=COLLECTIONS):
+    """
+    Export documents changed since the last run, and move the marks.
+
+    Parameters:
+        database (pymongo database object)
+        backup_dir (string)
+        full (boolean) export everything, ignoring the marks.
+        chunk_size (int) documents per file.
+        overlap (float) seconds the events mark looks back, see the module
+            docstring.
+        collections (string []) collections to export.
+
+    Returns:
+        counts (dict) collection name -> documents exported.
+    """
+
+    state = read_state(backup_dir)
+
+    # Marks are the time the run starts: anything written during the run
+    # is exported again by the next one.
+    started = time.time()
+    run_id = datetime.datetime.fromtimestamp(started).strftime("%Y%m%d-%H%M%S")
+    run_dir = os.path.join(backup_dir, run_id)
+    suffix = 0
+    while os.path.exists(run_dir):
+        suffix += 1
+        run_dir = os.path.join(backup_dir, "{}-{}".format(run_id, suffix))
+    run_id = os.path.basename(run_dir)
+    os.makedirs(run_dir)
+
+    counts = {}
+    for collection_name in collections:
+        mark = None if full else state["marks"].get(collection_name)
+        query = changed_documents_query(collection_name, mark, overlap)
+        cursor = database[collection_name].find(query, batch_size=DEFAULT_BATCH_SIZE)
+        counts[collection_name], paths = write_chunks(cursor, run_dir,
+                collection_name, chunk_size)
+        print("{}: {} documents in {} files".format(collection_name,
+            counts[collection_name], len(paths)))
+
+    for collection_name in collections:
+        state["marks"][collection_name] = started
+    state["runs"].append(run_id)
+    write_state(backup_dir, state)
+
+    return counts
+
+def iter_backup_documents(path):
+    """Yield the documents of one backup file, one at a time."""
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json_util.loads(line)
+
+def restore_file(collection, path, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Upsert every document of a backup file by _id, in bulk writes.
+
+    Returns:
+        n_documents (int) documents written.
+    """
+
+    n_documents = 0
+    batch = []
+    for document in iter_backup_documents(path):
+        batch.append(pymongo.ReplaceOne({"_id" : document["_id"]}, document,
+            upsert=True))
+        if len(batch) >= batch_size:
+            collection.bulk_write(batch, ordered=False)
+            n_documents += len(batch)
+            batch = []
+    if batch:
+        collection.bulk_write(batch, ordered=False)
+        n_documents += len(batch)
+
+    return n_documents
+
+def restore(database, backup_dir=DEFAULT_BACKUP_DIR, collections=COLLECTIONS,
+        until=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Restore collections from every backup run, oldest first.
+
+    Parameters:
+        database (pymongo database object)
+        backup_dir (string)
+        collections (string []) collections to restore.
+        until (string) optional, the last run id to apply.
+        batch_size (int) documents per bulk write.
+
+    Returns:
+        counts (dict) collection name -> documents written.
+    """
+
+    state = read_state(backup_dir)
+    NO_BACKUPS_ERROR = "no backup runs in {}".format(backup_dir)
+    assert state["runs"], NO_BACKUPS_ERROR
+
+    counts = {collection_name : 0 for collection_name in collections}
+    for run_id in sorted(state["runs"]):
+        if until is not None and run_id > until:
+            break
+        run_dir = os.path.join(backup_dir, run_id)
+        for collection_name in collections:
+            prefix = collection_name + "-"
+            for file_name in sorted(os.listdir(run_dir)):
+                if file_name.startswith(prefix) and file_name.endswith(".jsonl.gz"):
+                    counts[collection_name] += restore_file(database[collection_name],
+                            os.path.join(run_dir, file_name), batch_size)
+        print("restored {}: {}".format(run_id, counts))
+
+    # Running apps hold hands in memory; make them re-read.
+    if counts.get("hands"):
+        hand_cache.bump_generation(database["meta"])
+
+    return counts
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["backup", "restore"])
+    parser.add_argument("--backup-dir", default=DEFAULT_BACKUP_DIR)
+    parser.add_argument("--collections", nargs="+", default=COLLECTIONS,
+            choices=COLLECTIONS)
+    parser.add_argument("--full", action="store_true",
+            help="backup: export everything, not just changes")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+            help="backup: documents per file")
+    parser.add_argument("--overlap", type=float, default=DEFAULT_OVERLAP,
+            help="backup: seconds the events mark looks back")
+    parser.add_argument("--until", help="restore: last run id to apply")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+            help="restore: documents per bulk write")
+    args = parser.parse_args()
+
+    SQLITE_BACKUP_ERROR = ("backup_database.py backs up Mongo only; back up "
+            "the SQLite file with: sqlite3 <file> '.backup <copy>'")
+    assert os.environ.get("BRIDGE_STORAGE", "mongo") == "mongo", SQLITE_BACKUP_ERROR
+
+    database = db.get_database()
+    if args.command == "backup":
+        backup(database, args.backup_dir, full=args.full, chunk_size=args.chunk_size,
+                overlap=args.overlap, collections=args.collections)
+    else:
+        restore(database, args.backup_dir, collections=args.collections,
+                until=args.until, batch_size=args.batch_size)
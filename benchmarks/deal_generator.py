@@ -0,0 +1,85 @@
+"""
+Benchmark of deal_generator.py: deals per second, and the acceptance rate
+of typical constraint sets.
+
+For each constraint set, batches are generated and filtered until
+--seconds have passed. Reported per set:
+    deals_per_second      random deals generated and filtered
+    accepted_per_second   deals meeting the constraints
+    acceptance_rate       accepted / generated
+
+Usage:
+    python benchmarks/deal_generator.py
+    python benchmarks/deal_generator.py --batch-size 200000 --seconds 5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+# Shared modules live in the repository root.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import deal_generator
+
+# name -> (constraints, fixed cards)
+CONSTRAINT_SETS = {
+    "unconstrained" : (None, None),
+    "1NT opener (S 15-17 balanced)" : (
+        {"S" : {"hcp" : [15, 17], "balanced" : True}}, None),
+    "weak two (N 5-10, six hearts)" : (
+        {"N" : {"hcp" : [5, 10], "H" : [6, 6]}}, None),
+    "1NT opposite invite (S 15-17 bal, N 8-9)" : (
+        {"S" : {"hcp" : [15, 17], "balanced" : True}, "N" : {"hcp" : [8, 9]}}, None),
+    "lead problem (W holds KQJ of hearts)" : (
+        None, {"W" : ["HK", "HQ", "HJ"]}),
+    "fixed and filtered (S AK spades, 5+ spades, 12-14)" : (
+        {"S" : {"hcp" : [12, 14], "S" : [5, 13]}}, {"S" : ["SA", "SK"]}),
+}
+
+def benchmark_constraint_set(constraints, fixed, batch_size, seconds, rng):
+    """Generate and filter batches for about seconds; return the rates."""
+
+    n_generated = 0
+    n_accepted = 0
+    started = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < seconds:
+        deals = deal_generator.random_deals(batch_size, rng, fixed)
+        accepted = deal_generator.constraint_mask(deals, constraints)
+        deal_generator.deals_to_masks(deals[accepted])
+        n_generated += batch_size
+        n_accepted += int(accepted.sum())
+        elapsed = time.perf_counter() - started
+
+    return {
+        "deals_per_second" : n_generated / elapsed,
+        "accepted_per_second" : n_accepted / elapsed,
+        "acceptance_rate" : n_accepted / n_generated,
+    }
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--batch-size", type=int, default=deal_generator.DEFAULT_BATCH_SIZE)
+    parser.add_argument("--seconds", type=float, default=2.0,
+            help="time spent on each constraint set")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    print("{:<52} {:>16} {:>16} {:>10}".format("constraints", "deals/s",
+        "accepted/s", "accepted"))
+    for name, (constraints, fixed) in CONSTRAINT_SETS.items():
+        results[name] = benchmark_constraint_set(constraints, fixed,
+                args.batch_size, args.seconds, rng)
+        print("{:<52} {:>16,.0f} {:>16,.0f} {:>10.4%}".format(name,
+            results[name]["deals_per_second"], results[name]["accepted_per_second"],
+            results[name]["acceptance_rate"]))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
@@ -0,0 +1,213 @@
+"""
+Correctness and timing check of the double-dummy solver.
+
+Random endings of a few tricks are solved both by double_dummy.py, with
+its own search and, if endplay is installed, with DDS, and by a plain
+minimax over every legal card, and the results, for the whole position
+and for each lead, must agree. Then the sample deals of data/hands.json
+are solved with --engine in every strain with solve_deal(), and every
+lead with solve_leads(), each timed against --budget seconds.
+
+The exit status is 1 if any result disagrees or any solve is over budget.
+The default budget is the target for DDS; the search of double_dummy.py
+takes seconds a deal (see its docstring), so time it with a larger one.
+
+Usage:
+    python benchmarks/double_dummy.py --engine dds
+    python benchmarks/double_dummy.py --budget 60
+    python benchmarks/double_dummy.py --deals 0 1 2 --leader W --budget 60
+    python benchmarks/double_dummy.py --tricks 4 --endings 500 --no-timing
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+# Shared modules live in the repository root.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import double_dummy
+from deal import SEATS, SUITS, SUIT_MASK, Deal
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+HANDS_PATH = os.path.join(BENCHMARKS_DIR, "..", "data", "hands.json")
+STRAINS = ["N", "S", "H", "D", "C"]
+# Seconds per solve, met by DDS; the search of double_dummy.py needs about
+# --budget 60.
+DEFAULT_BUDGET = 1.0
+
+def minimax_tricks(hands, trump_mask, leader, trick=()):
+    """
+    Return the tricks North-South take with best play, by trying every
+    legal card.
+
+    Parameters:
+        hands (list) four card masks, changed during the search and
+            restored.
+        trump_mask (int) mask of the trump suit, 0 for no trumps.
+        leader (int) seat index of the player who led to the trick.
+        trick (tuple) the (seat, card) pairs played to the trick so far.
+    """
+
+    if len(trick) == 4:
+        led_mask = SUIT_MASK << 13*((trick[0][1].bit_length() - 1) // 13)
+        winner, winning_card = trick[0]
+        for seat, card in trick[1:]:
+            if card & trump_mask:
+                beats = not winning_card & trump_mask or card > winning_card
+            else:
+                beats = (card & led_mask and card > winning_card
+                        and not winning_card & trump_mask)
+            if beats:
+                winner, winning_card = seat, card
+        return (winner % 2 == 0) + minimax_tricks(hands, trump_mask, winner)
+
+    seat = (leader + len(trick)) % 4
+    holding = hands[seat]
+    if not holding:
+        return 0
+    if trick:
+        led_mask = SUIT_MASK << 13*((trick[0][1].bit_length() - 1) // 13)
+        if holding & led_mask:
+            holding &= led_mask
+
+    results = []
+    while holding:
+        card = holding & -holding
+        holding ^= card
+        hands[seat] ^= card
+        results.append(minimax_tricks(hands, trump_mask, leader,
+            trick + ((seat, card),)))
+        hands[seat] ^= card
+
+    return max(results) if seat % 2 == 0 else min(results)
+
+def random_ending(rng, tricks):
+    """Return four random hands of tricks cards each, as masks."""
+
+    cards = list(range(52))
+    rng.shuffle(cards)
+    return [sum(1 << card for card in cards[tricks*seat : tricks*(seat + 1)])
+            for seat in range(4)]
+
+def check_endings(tricks, endings, seed):
+    """
+    Compare the solver with minimax_tricks() on random endings, for the
+    whole position and for each lead, printing any disagreement.
+
+    Returns:
+        mismatches (int)
+    """
+
+    rng = random.Random(seed)
+    mismatches = 0
+    for _ in range(endings):
+        hands = random_ending(rng, tricks)
+        trump_suit = rng.choice([None, 0, 1, 2, 3])
+        leader = rng.randrange(4)
+        solver = double_dummy.DoubleDummySolver(hands, trump_suit)
+        trump_mask = solver.trump_mask
+
+        results = [("all", solver.solve(leader),
+            minimax_tricks(list(hands), trump_mask, leader))]
+        holding = hands[leader]
+        while holding:
+            card = holding & -holding
+            holding ^= card
+            after_lead = list(hands)
+            after_lead[leader] ^= card
+            results.append((double_dummy._card_string(card),
+                solver.solve_lead(leader, card),
+                minimax_tricks(after_lead, trump_mask, leader, ((leader, card),))))
+
+        # DDS, which counts the tricks of the side on lead.
+        if double_dummy.endplay_dds is not None:
+            trumps = SUITS[trump_suit] if trump_suit is not None else "N"
+            tricks_left = bin(hands[0]).count("1")
+            tricks_by_card = double_dummy.solve_leads(Deal(hands), trumps,
+                    SEATS[leader], engine="dds")
+            for lead, solved, expected in list(results):
+                lead_tricks = (max(tricks_by_card.values()) if lead == "all"
+                        else tricks_by_card[lead])
+                ns_tricks = (lead_tricks if leader % 2 == 0
+                        else tricks_left - lead_tricks)
+                results.append((lead + " (dds)", ns_tricks, expected))
+
+        for lead, solved, expected in results:
+            if solved != expected:
+                mismatches += 1
+                print("MISMATCH hands={} trumps={} leader={} lead={}: "
+                        "solver {} minimax {}".format(hands, trump_suit,
+                            SEATS[leader], lead, solved, expected))
+
+    return mismatches
+
+def time_deals(hand_jsons, leader, budget, engine="python"):
+    """
+    Time solve_deal() in every strain, and solve_leads() in notrump, for
+    each deal, printing the results.
+
+    Returns:
+        over_budget (int) the number of solves slower than budget seconds.
+    """
+
+    over_budget = 0
+    for index, hand_json in hand_jsons:
+        deal = Deal.from_hand_json(hand_json)
+        deal.validate()
+        print("deal {}: {}".format(index, deal.to_pbn()))
+
+        timings = [("solve_deal " + strain,
+            lambda strain=strain: double_dummy.solve_deal(deal, strain, leader,
+                engine)) for strain in STRAINS]
+        timings.append(("solve_leads N",
+            lambda: max(double_dummy.solve_leads(deal, "N", leader, engine).values())))
+        for name, solve in timings:
+            started = time.perf_counter()
+            tricks = solve()
+            seconds = time.perf_counter() - started
+            flag = ""
+            if seconds > budget:
+                over_budget += 1
+                flag = "  OVER BUDGET"
+            print("  {:<14} {:2d} tricks {:7.2f}s{}".format(name, tricks, seconds, flag))
+
+    return over_budget
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--json", default=HANDS_PATH, help="sample deals")
+    parser.add_argument("--deals", type=int, nargs="+", default=[0, 1, 3],
+            help="positions of the deals in --json to time")
+    parser.add_argument("--leader", default="W", help="seat on lead: N E S W")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET,
+            help="seconds allowed for each timed solve")
+    parser.add_argument("--tricks", type=int, default=3,
+            help="tricks in each random ending")
+    parser.add_argument("--endings", type=int, default=200,
+            help="random endings to check against minimax")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", choices=double_dummy.ENGINES, default="python",
+            help="solver to time; dds needs endplay")
+    parser.add_argument("--no-timing", action="store_true",
+            help="only check the random endings")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    mismatches = check_endings(args.tricks, args.endings, args.seed)
+    print("{} endings of {} tricks: {} mismatches ({:.1f}s)".format(args.endings,
+        args.tricks, mismatches, time.perf_counter() - started))
+
+    over_budget = 0
+    if not args.no_timing:
+        with open(args.json) as f:
+            hand_jsons = json.load(f)
+        over_budget = time_deals([(index, hand_jsons[index]) for index in args.deals],
+                args.leader.upper(), args.budget, args.engine)
+
+    if mismatches or over_budget:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
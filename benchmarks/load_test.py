@@ -0,0 +1,336 @@
+"""
+Load test of the quiz: many virtual users answering problems concurrently.
+
+Each virtual user is a thread with its own session and username, which
+repeats the loop session.py runs on every answer: Quiz.next_problem (look
+up the user, show a hand) and Quiz.submit_answer (grade it and update the
+player and hand elos), answering correctly with probability one half. The
+users share one Quiz, as the threads of a server or of Streamlit do.
+
+Backends (--storage):
+    sqlite      a fresh SQLite file in a temporary directory (default)
+    mongomock   an in-memory stand-in for Mongo, if mongomock is installed
+    mongo       a separate database on the db.py server, dropped afterwards
+
+Few hands (--hands) means many users answer the same hand at once, which
+is where concurrent updates of a hand's elo collide: were the new elo
+written back with a $set, of two concurrent answers to a hand the later
+write could overwrite the earlier one, a lost update. The elo changes are
+added atomically instead (see rating_updates.py), each answer at once or,
+with --flush-interval, summed per hand and written in batches.
+
+After the run two checks read the "answer" events, each of which records
+the elos its update started from:
+    lost updates    each answer's change is recomputed from its recorded
+                    elos; a hand's final elo should be its initial elo
+                    plus the sum of those changes. This verifies that no
+                    increment was lost, not that the elos are those of a
+                    serial run. The exit status is 1 if any hand is off,
+                    so it can run in CI, in both the immediate and the
+                    --flush-interval modes.
+    serial drift    the answers are replayed one at a time in timestamp
+                    order, each from the elos the previous one left. Two
+                    concurrent answers which read the same elo differ from
+                    this by design, so the drift is reported, not failed.
+
+Reported:
+    answers_per_second
+    stages              p50, p95, p99 ms and mean round trips of each
+                        stage, from instrumentation.py
+    storage_calls       calls of each Storage method
+    mongo_commands      Mongo commands by name, for --storage mongo
+    lost_updates        hands whose final elo is off, and by how much
+    serial_drift        how far final hand elos are from the serial replay
+
+Usage:
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py --users 64 --hands 5 --seconds 20
+    python benchmarks/load_test.py --storage mongomock
+    python benchmarks/load_test.py --flush-interval 0.5
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from bson import ObjectId
+
+# Shared modules live in the repository root.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import db
+import elo
+import event_sink
+import instrumentation
+import rating_updates
+import storage
+from quiz import Quiz
+
+LOAD_TEST_DATABASE = "bridge_load_test"
+HANDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+        "data", "hands.json")
+
+# A hand's final elo further than this from the replay is a lost update.
+ELO_TOLERANCE = 1e-6
+INITIAL_PLAYER_ELO = 1200.0
+
+class CountingStorage(object):
+    """Wraps a Storage, counting calls of each of its methods."""
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.wrapped, name)
+        if not callable(attribute):
+            return attribute
+
+        def counted(*args, **kwargs):
+            with self._lock:
+                self.calls[name] += 1
+            return attribute(*args, **kwargs)
+
+        return counted
+
+def open_backend(name, directory):
+    """Return a fresh, empty Storage of the named backend."""
+
+    if name == "sqlite":
+        return storage.SQLiteStorage(os.path.join(directory, "load_test.sqlite3"))
+
+    if name == "mongomock":
+        import mongomock
+        return storage.MongoStorage(mongomock.MongoClient()[LOAD_TEST_DATABASE])
+
+    db.get_client().drop_database(LOAD_TEST_DATABASE)
+    return storage.MongoStorage(db.get_client()[LOAD_TEST_DATABASE])
+
+def load_synthetic_data(app_storage, n_hands, n_users, rng):
+    """
+    Write n_hands copies of the example hands, with new _ids and elos, and
+    one user per virtual user. The correct answer of each hand is "right".
+
+    Returns:
+        initial_elos (dict) hand _id -> elo.
+    """
+
+    with open(HANDS_PATH) as f:
+        examples = json.load(f)
+
+    hands = []
+    for hand_index in range(n_hands):
+        hand_json = dict(examples[hand_index % len(examples)])
+        hand_json["_id"] = ObjectId()
+        hand_json["elo"] = rng.gauss(1200, 200)
+        hand_json["correct_answer"] = "right"
+        hands.append(hand_json)
+    users = [{"username" : "user{}".format(user_index), "elo" : INITIAL_PLAYER_ELO}
+            for user_index in range(n_users)]
+
+    # mongomock has no bulk_write, so Mongo collections are written directly.
+    if isinstance(app_storage, storage.MongoStorage):
+        app_storage.hands.insert_many(hands)
+        app_storage.users.insert_many(users)
+    else:
+        app_storage.put_hands(hands)
+        app_storage.put_users(users)
+
+    return {hand_json["_id"] : hand_json["elo"] for hand_json in hands}
+
+def run_user(quiz, user_index, deadline, rng, counts, counts_lock):
+    """One virtual user: next problem, answer, repeat until the deadline."""
+
+    username = "user{}".format(user_index)
+    session_key = ("load-test-{}".format(user_index), username)
+    metrics = instrumentation.get_metrics()
+    answers = errors = 0
+
+    while time.perf_counter() < deadline:
+        try:
+            metrics.start_rerun("next_problem")
+            quiz.next_problem(session_key, username)
+            metrics.finish_rerun()
+
+            # Answer correctly half the time.
+            metrics.start_rerun("submit_answer")
+            result = quiz.submit_answer(session_key, username,
+                    "right" if rng.random() < 0.5 else "wrong")
+            metrics.finish_rerun()
+        except storage.WRITE_ERRORS:
+            errors += 1
+            continue
+        if result is None:
+            errors += 1
+        else:
+            answers += 1
+
+    with counts_lock:
+        counts["answers"] += answers
+        counts["errors"] += errors
+
+def run_users(quiz, n_users, seconds, seed):
+    """Run n_users virtual users for seconds; return (counts, elapsed)."""
+
+    counts = collections.Counter()
+    counts_lock = threading.Lock()
+    started = time.perf_counter()
+    deadline = started + seconds
+    threads = [threading.Thread(target=run_user, args=(quiz, user_index, deadline,
+        random.Random(seed + user_index), counts, counts_lock),
+        name="user{}".format(user_index)) for user_index in range(n_users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return counts, time.perf_counter() - started
+
+def check_lost_updates(app_storage, initial_elos):
+    """
+    Check that no elo increment was lost: compare each hand's final elo
+    with its initial elo plus the changes its answer events computed, each
+    from the elos the event recorded.
+
+    Returns:
+        report (dict) answers checked, hands answered, hands whose elo is
+        off, and the largest and total absolute differences.
+    """
+
+    expected_elos = dict(initial_elos)
+    n_answers = 0
+    answered = set()
+    for event_record in app_storage.iter_events("answer"):
+        hand_id = event_record["hand_id"]
+        _, new_hand_elo = elo.get_new_elos(event_record["player_elo"],
+                event_record["hand_elo"], event_record["user_was_correct"])
+        expected_elos[hand_id] += new_hand_elo - event_record["hand_elo"]
+        answered.add(hand_id)
+        n_answers += 1
+
+    differences = [abs(app_storage.get_hand(hand_id)["elo"] - expected_elos[hand_id])
+            for hand_id in answered]
+    lost = [difference for difference in differences if difference > ELO_TOLERANCE]
+
+    return {
+        "answers_checked" : n_answers,
+        "hands_answered" : len(answered),
+        "hands_with_lost_updates" : len(lost),
+        "max_elo_difference" : max(differences, default=0.0),
+        "total_elo_difference" : sum(differences),
+    }
+
+def serial_drift(app_storage, initial_elos, initial_player_elo=INITIAL_PLAYER_ELO):
+    """
+    Replay the answers one at a time in timestamp order, each from the
+    player and hand elos the previous answers left, and compare the final
+    hand elos with the stored ones.
+
+    Returns:
+        report (dict) answers replayed, and the largest and mean absolute
+        differences of the answered hands.
+    """
+
+    hand_elos = dict(initial_elos)
+    player_elos = collections.defaultdict(lambda: initial_player_elo)
+    n_answers = 0
+    for event_record in app_storage.iter_events("answer"):
+        hand_id, username = event_record["hand_id"], event_record["username"]
+        player_elos[username], hand_elos[hand_id] = elo.get_new_elos(
+                player_elos[username], hand_elos[hand_id],
+                event_record["user_was_correct"])
+        n_answers += 1
+
+    differences = [abs(app_storage.get_hand(hand_id)["elo"] - hand_elo)
+            for hand_id, hand_elo in hand_elos.items()
+            if hand_elo != initial_elos[hand_id]]
+
+    return {
+        "answers_replayed" : n_answers,
+        "max_elo_difference" : max(differences, default=0.0),
+        "mean_elo_difference" : (sum(differences) / len(differences)
+            if differences else 0.0),
+    }
+
+def stage_report(snapshot):
+    """Return p50/p95/p99 ms and mean round trips of each stage and rerun."""
+
+    histograms = snapshot["histograms"]
+    report = {}
+    for seconds_name, round_trips_name in [
+            ("bridge_stage_seconds", "bridge_stage_db_round_trips"),
+            ("bridge_rerun_seconds", "bridge_rerun_db_round_trips")]:
+        for label, histogram in histograms.get(seconds_name, {}).items():
+            row = {"count" : histogram["count"]}
+            for quantile in ["p50", "p95", "p99"]:
+                row[quantile + "_ms"] = 1000*histogram[quantile]
+            row["round_trips_mean"] = histograms[round_trips_name][label]["mean"]
+            report[label] = row
+
+    return report
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=32)
+    parser.add_argument("--hands", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--storage", choices=["sqlite", "mongomock", "mongo"],
+            default="sqlite")
+    parser.add_argument("--flush-interval", type=float, default=0.0,
+            help="seconds elo changes are summed before writing; 0 writes each")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    backend = open_backend(args.storage, directory.name)
+    initial_elos = load_synthetic_data(backend, args.hands, args.users,
+            random.Random(args.seed))
+
+    app_storage = CountingStorage(backend)
+    sink = event_sink.EventSink(app_storage)
+    rating_updater = rating_updates.RatingUpdater(app_storage, args.flush_interval)
+    quiz = Quiz.create(app_storage, sink, rating_updater)
+    app_storage.calls.clear()
+
+    counts, elapsed = run_users(quiz, args.users, args.seconds, args.seed)
+    sink.close()
+    rating_updater.close()
+    snapshot = instrumentation.get_metrics().snapshot()
+    storage_calls = dict(app_storage.calls)
+
+    lost_updates = check_lost_updates(backend, initial_elos)
+    drift = serial_drift(backend, initial_elos)
+    if args.storage == "mongo":
+        db.get_client().drop_database(LOAD_TEST_DATABASE)
+
+    results = {
+        "users" : args.users,
+        "hands" : args.hands,
+        "storage" : args.storage,
+        "flush_interval" : args.flush_interval,
+        "seconds" : elapsed,
+        "answers" : counts["answers"],
+        "answers_per_second" : counts["answers"] / elapsed,
+        "errors" : counts["errors"],
+        "stages" : stage_report(snapshot),
+        "storage_calls" : storage_calls,
+        "rating_updater" : rating_updater.stats(),
+        "mongo_commands" : snapshot["mongo"]["commands"],
+        "lost_updates" : lost_updates,
+        "serial_drift" : drift,
+    }
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if lost_updates["hands_with_lost_updates"]:
+        sys.exit(1)
@@ -0,0 +1,232 @@
+"""
+Benchmark and offline evaluation of the rating systems in rating_systems.py.
+
+Each backend replays a sequence of answers, either per answer or in
+batched rating periods, and is scored on:
+    log_loss, brier, accuracy   how well expected_score() predicted each
+                                answer, before that answer was rated
+    us_per_answer               microseconds of rating work per answer
+    answers_to_converge         (synthetic only) answers a player needs
+                                before the mean error of player ratings
+                                drops under --tolerance
+    final_error                 (synthetic only) mean absolute error of
+                                player ratings after the last answer
+
+Answers come from the events collection (--events), as replayed by
+replay_ratings.py, or are simulated: players and hands get true ratings,
+and each answer is correct with the logistic Elo probability.
+
+Usage:
+    python benchmarks/rating_systems.py
+    python benchmarks/rating_systems.py --answers 200000 --period 500
+    python benchmarks/rating_systems.py --events
+"""
+import argparse
+import collections
+import json
+import math
+import os
+import sys
+import time
+import numpy as np
+
+# Shared modules live in the repository root.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import rating_systems
+
+def synthetic_answers(n_players=500, n_hands=2000, n_answers=50000, spread=200,
+        seed=0):
+    """
+    Simulate answers from players and hands with known ratings.
+
+    Returns:
+        (player_keys, hand_keys, outcomes, true_ratings) lists of keys and
+        outcomes, one entry per answer, and a dict key -> true rating.
+    """
+
+    rng = np.random.default_rng(seed)
+    true_players = rng.normal(rating_systems.INITIAL_RATING, spread, n_players)
+    true_hands = rng.normal(rating_systems.INITIAL_RATING, spread, n_hands)
+
+    players = rng.integers(0, n_players, n_answers)
+    hands = rng.integers(0, n_hands, n_answers)
+    probability_correct = 1.0 / (1 + np.power(10.0,
+        (true_hands[hands] - true_players[players]) / 400))
+    outcomes = rng.random(n_answers) < probability_correct
+
+    player_keys = [("player", player) for player in players.tolist()]
+    hand_keys = [("hand", hand) for hand in hands.tolist()]
+    true_ratings = {("player", player) : true_players[player]
+            for player in range(n_players)}
+    true_ratings.update({("hand", hand) : true_hands[hand] for hand in range(n_hands)})
+
+    return player_keys, hand_keys, outcomes.tolist(), true_ratings
+
+def replayed_answers():
+    """
+    Read answers from the stored events, keyed as in replay_ratings.py.
+
+    Returns:
+        (player_keys, hand_keys, outcomes, None)
+    """
+
+    import replay_ratings
+    import storage
+
+    usernames, hand_ids, outcomes = replay_ratings.load_answer_events(
+            storage.get_storage())
+
+    # Guest ratings are never stored, so every guest answer is a new player.
+    player_keys = [("player", username) if username != "guest"
+            else ("guest", position) for position, username in enumerate(usernames)]
+    hand_keys = [("hand", hand_id) for hand_id in hand_ids]
+
+    return player_keys, hand_keys, outcomes, None
+
+def evaluate(system, player_keys, hand_keys, outcomes, period=None,
+        true_ratings=None, tolerance=100):
+    """
+    Replay answers through a rating system and score it.
+
+    Parameters:
+        system (rating_systems.RatingSystem)
+        player_keys, hand_keys (list) one key per answer.
+        outcomes (bool list) whether each answer was correct.
+        period (int) answers per rating period, or None to rate each
+            answer as it arrives.
+        true_ratings (dict) key -> true rating, for synthetic answers.
+        tolerance (float) rating error counted as converged.
+
+    Returns:
+        results (dict) see the module docstring.
+    """
+
+    ratings = {}
+    n_answers = len(outcomes)
+    log_loss = 0.0
+    brier = 0.0
+    n_right = 0
+    seconds = 0.0
+
+    # Sum and count of player rating errors, by answers seen so far.
+    answers_seen = collections.Counter()
+    error_sums = collections.defaultdict(float)
+    error_counts = collections.Counter()
+
+    step = period or 1
+    for start in range(0, n_answers, step):
+        batch = list(zip(player_keys[start:start + step], hand_keys[start:start + step],
+            outcomes[start:start + step]))
+
+        # Score predictions made before the batch is rated.
+        for player_key, hand_key, user_was_correct in batch:
+            player = ratings.get(player_key) or system.initial_rating()
+            hand = ratings.get(hand_key) or system.initial_rating()
+            expected = min(max(system.expected_score(player, hand), 1e-12), 1 - 1e-12)
+            outcome = 1.0 if user_was_correct else 0.0
+            log_loss -= outcome*math.log(expected) + (1 - outcome)*math.log(1 - expected)
+            brier += (outcome - expected)**2
+            n_right += (expected >= 0.5) == bool(user_was_correct)
+
+        started = time.perf_counter()
+        if period is None:
+            player_key, hand_key, user_was_correct = batch[0]
+            player = ratings.get(player_key) or system.initial_rating()
+            hand = ratings.get(hand_key) or system.initial_rating()
+            ratings[player_key], ratings[hand_key] = system.update(player, hand,
+                    user_was_correct)
+        else:
+            ratings = system.rate_period(ratings, batch)
+        seconds += time.perf_counter() - started
+
+        if true_ratings is not None:
+            for player_key, hand_key, user_was_correct in batch:
+                answers_seen[player_key] += 1
+                n_seen = answers_seen[player_key]
+                error_sums[n_seen] += abs(ratings[player_key].rating
+                        - true_ratings[player_key])
+                error_counts[n_seen] += 1
+
+    results = {
+        "system" : system.name,
+        "period" : period,
+        "answers" : n_answers,
+        "log_loss" : log_loss / max(n_answers, 1),
+        "brier" : brier / max(n_answers, 1),
+        "accuracy" : n_right / max(n_answers, 1),
+        "us_per_answer" : 1e6*seconds / max(n_answers, 1),
+    }
+
+    if true_ratings is not None:
+        # Answer count from which the mean error stays under tolerance.
+        results["answers_to_converge"] = None
+        for n_seen in sorted(error_counts, reverse=True):
+            if error_sums[n_seen] / error_counts[n_seen] >= tolerance:
+                break
+            results["answers_to_converge"] = n_seen
+
+        player_errors = [abs(ratings[key].rating - true_ratings[key])
+                for key in answers_seen]
+        results["final_error"] = float(np.mean(player_errors)) if player_errors else None
+
+    return results
+
+def print_results(all_results):
+    """Print one line per backend and mode."""
+
+    columns = ["system", "period", "log_loss", "brier", "accuracy", "us_per_answer",
+            "answers_to_converge", "final_error"]
+    print("  ".join("{:>19}".format(column) for column in columns))
+    for results in all_results:
+        cells = []
+        for column in columns:
+            value = results.get(column)
+            if isinstance(value, float):
+                cells.append("{:>19.4f}".format(value))
+            else:
+                cells.append("{:>19}".format(str(value)))
+        print("  ".join(cells))
+
+    return None
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--events", action="store_true",
+            help="replay answers from the events collection instead of simulating")
+    parser.add_argument("--players", type=int, default=500)
+    parser.add_argument("--hands", type=int, default=2000)
+    parser.add_argument("--answers", type=int, default=50000)
+    parser.add_argument("--spread", type=float, default=200,
+            help="standard deviation of simulated true ratings")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--period", type=int, default=250,
+            help="answers per batched rating period")
+    parser.add_argument("--tolerance", type=float, default=100,
+            help="mean player rating error counted as converged")
+    parser.add_argument("--K", type=float, default=30, help="elo scaling factor")
+    parser.add_argument("--tau", type=float, default=0.5, help="Glicko-2 tau")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.events:
+        answers = replayed_answers()
+    else:
+        answers = synthetic_answers(args.players, args.hands, args.answers,
+                args.spread, args.seed)
+    player_keys, hand_keys, outcomes, true_ratings = answers
+
+    systems = [rating_systems.EloRatingSystem(K=args.K),
+            rating_systems.Glicko2RatingSystem(tau=args.tau)]
+
+    all_results = []
+    for system in systems:
+        for period in [None, args.period]:
+            all_results.append(evaluate(system, player_keys, hand_keys, outcomes,
+                period=period, true_ratings=true_ratings, tolerance=args.tolerance))
+
+    print_results(all_results)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(all_results, output_file, indent=2)
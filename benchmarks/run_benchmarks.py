@@ -0,0 +1,263 @@
+"""
+Benchmark suite for the hot paths, with a stored baseline.
+
+Each benchmark times one call of a hot path, as the best of --repeat runs
+of timeit's autorange. Covered:
+    render_single_hand, render_four_hands_with_question, render_auction,
+    render_hand_json (a render cache hit)
+    elo.get_new_elos
+    alter_database.parse_hand_string_to_list, and validate_and_parse of
+        every field of a problem entry
+    for each --sizes problem count, data/hands.json scaled to that many
+    synthetic problems:
+        elo_index_build_<n>   EloIndex over every hand, at start up
+        elo_index_update_<n>  moving a hand after its elo changes
+        select_<n>            end-to-end selection: quiz.choose_hand
+                              through a HandCache, then render_hand_json.
+                              Every problem has its own question, so
+                              renders miss the cache as they would in
+                              the app, and player elos come from a fixed
+                              sequence, so runs select the same hands.
+
+With --save-baseline the results are written to --baseline. Otherwise
+they are compared to it, and any benchmark slower than the baseline by
+more than --threshold is flagged; the exit status is 1 if one is.
+Baselines depend on the machine, so save one before comparing on a new
+machine.
+
+Usage:
+    python benchmarks/run_benchmarks.py --save-baseline
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --sizes 10000 1000000 --only select
+"""
+import argparse
+import json
+import os
+import itertools
+import random
+import sys
+import timeit
+
+# Shared modules live in the repository root.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import alter_database
+import elo
+import quiz
+import render_hand
+import storage
+from deal import SEAT_KEYS, Deal, mask_to_hand_string
+from hand_cache import HandCache
+from hand_selection import EloIndex
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+HANDS_PATH = os.path.join(BENCHMARKS_DIR, "..", "data", "hands.json")
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+DEFAULT_SIZES = [10000, 100000, 1000000]
+SELECT_ELOS = 1000
+DEFAULT_THRESHOLD = 0.25
+
+class InMemoryHands(storage.Storage):
+    """Hands held in a dict, so selection is timed without a database."""
+
+    name = "memory"
+
+    def __init__(self, hand_jsons):
+        self.hands = {hand_json["_id"] : hand_json for hand_json in hand_jsons}
+
+    def get_hand(self, hand_id):
+        return self.hands.get(hand_id)
+
+    def hand_elos(self):
+        return [(hand_json["elo"], hand_id) for hand_id, hand_json in self.hands.items()]
+
+    def read_generation(self):
+        return 0
+
+def load_examples():
+    with open(HANDS_PATH) as f:
+        return json.load(f)
+
+def synthetic_problems(examples, n_problems, rng):
+    """
+    Return n_problems copies of the examples with new ids, elos and
+    questions. The question differs per problem, so each renders to its
+    own HTML rather than sharing the render cache entry of its example.
+    """
+
+    problems = []
+    for index in range(n_problems):
+        hand_json = dict(examples[index % len(examples)])
+        hand_json.pop("rendered", None)
+        hand_json["_id"] = "synthetic-{}".format(index)
+        hand_json["elo"] = rng.gauss(1200, 200)
+        hand_json["question"] = "{} (problem {})".format(hand_json.get("question",
+            hand_json.get("context", "")), index)
+        problems.append(hand_json)
+
+    return problems
+
+def problem_entry(hand_json):
+    """Return a hand document as the strings typed into alter_database."""
+
+    entry = {key : mask_to_hand_string(mask) for key, mask in
+            zip(SEAT_KEYS, Deal.from_hand_json(hand_json).masks)}
+    entry.update({"dealer" : "S", "auction" : "1S P 2S P 4S P P P",
+        "hidden_hands" : hand_json["hidden_hands"],
+        "correct_answer" : hand_json["correct_answer"],
+        "context" : hand_json["context"]})
+
+    return entry
+
+def micro_benchmarks(examples):
+    """Return name -> zero-argument function, for the per-call hot paths."""
+
+    hand_json = examples[0]
+    list_of_hands = [hand_json["n_hand"], hand_json["w_hand"],
+            hand_json["s_hand"], hand_json["e_hand"]]
+    render_hand.render_hand_json(hand_json)
+    entry = problem_entry(hand_json)
+
+    def validate_entry():
+        for key, value in entry.items():
+            alter_database.validate_and_parse(key, value)
+
+    return {
+        "render_single_hand" : lambda: render_hand.render_single_hand(
+            hand_json["n_hand"]),
+        "render_four_hands_with_question" : lambda:
+            render_hand.render_four_hands_with_question(list_of_hands,
+                question=hand_json["context"], hidden_hands="EW",
+                dealer_string="S", auction_string="1S P 2S P 4S P P P"),
+        "render_auction" : lambda: render_hand.render_auction(
+            "1N 2S P 2N P 4S P P P", "E"),
+        "render_hand_json_cached" : lambda: render_hand.render_hand_json(hand_json),
+        "elo_get_new_elos" : lambda: elo.get_new_elos(1250.0, 1180.0, True),
+        "parse_hand_string_to_list" : lambda:
+            alter_database.parse_hand_string_to_list(entry["n_hand"]),
+        "validate_and_parse_entry" : validate_entry,
+    }
+
+def selection_benchmarks(examples, n_problems, seed):
+    """Return name -> zero-argument function, for n_problems problems."""
+
+    rng = random.Random(seed)
+    problems = synthetic_problems(examples, n_problems, rng)
+    hands = InMemoryHands(problems)
+    elo_pairs = hands.hand_elos()
+    elo_index = EloIndex(elo_pairs)
+    hand_cache = HandCache(hands)
+    hand_ids = [hand_json["_id"] for hand_json in problems]
+
+    def update():
+        elo_index.update(rng.choice(hand_ids), rng.gauss(1200, 200))
+
+    # The same player elos in every run, so timings compare like for like.
+    player_elos = itertools.cycle([rng.gauss(1200, 150) for _ in range(SELECT_ELOS)])
+
+    def select():
+        hand_json = quiz.choose_hand(hand_cache, elo_index, next(player_elos))
+        render_hand.render_hand_json(hand_json)
+
+    return {
+        "elo_index_build_{}".format(n_problems) : lambda: EloIndex(elo_pairs),
+        "elo_index_update_{}".format(n_problems) : update,
+        "select_{}".format(n_problems) : select,
+    }
+
+def time_call(function, repeat):
+    """Return the best seconds per call over repeat autoranged runs."""
+
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+def run(sizes, repeat, seed, only=None):
+    """
+    Run the benchmarks whose name contains only, if given.
+
+    Returns:
+        results (dict) name -> seconds per call.
+    """
+
+    examples = load_examples()
+    results = {}
+
+    def run_group(benchmarks):
+        for name, function in benchmarks.items():
+            if only and only not in name:
+                continue
+            results[name] = time_call(function, repeat)
+            print("{:<36} {:>14.2f} us".format(name, 1e6*results[name]))
+
+    run_group(micro_benchmarks(examples))
+    for n_problems in sizes:
+        names = ["elo_index_build", "elo_index_update", "select"]
+        if only and not any(only in "{}_{}".format(name, n_problems) for name in names):
+            continue
+        run_group(selection_benchmarks(examples, n_problems, seed))
+
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Print each result against the baseline.
+
+    Returns:
+        regressions (string []) names slower than baseline by over threshold.
+    """
+
+    regressions = []
+    print("{:<36} {:>14} {:>14} {:>9}".format("benchmark", "us", "baseline us", "change"))
+    for name, seconds in results.items():
+        if name not in baseline:
+            print("{:<36} {:>14.2f} {:>14} {:>9}".format(name, 1e6*seconds, "-", "new"))
+            continue
+        change = seconds / baseline[name] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<36} {:>14.2f} {:>14.2f} {:>+8.1%}{}".format(name, 1e6*seconds,
+            1e6*baseline[name], change, flag))
+
+    return regressions
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+            help="synthetic problem counts for the selection benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", help="run benchmarks whose name contains this")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true",
+            help="write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+            help="flag benchmarks slower than baseline by this fraction")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeat, args.seed, args.only)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("baseline written to {}".format(args.baseline))
+
+    elif not os.path.exists(args.baseline):
+        print("no baseline at {}; run with --save-baseline first".format(args.baseline))
+
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("{} regressions over {:.0%}: {}".format(len(regressions),
+                args.threshold, ", ".join(regressions)))
+            sys.exit(1)
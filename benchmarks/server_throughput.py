@@ -0,0 +1,198 @@
+"""
+Throughput test of server.py: concurrent clients answering problems.
+
+The server runs in this process, on an ephemeral port, over a fresh
+SQLite store of synthetic hands and users (or, with --storage mongo, a
+separate Mongo database which is dropped afterwards). --clients keep-alive connections then repeat GET /next and
+POST /answer for --seconds, each answering correctly with probability
+one half. The run is reproducible for a given --seed, up to timing.
+
+Reported:
+    requests_per_second   /next and /answer together
+    answers_per_second
+    <endpoint>_ms         p50, p95, p99 latency
+    errors                non-200 responses
+
+Usage:
+    python benchmarks/server_throughput.py
+    python benchmarks/server_throughput.py --clients 64 --seconds 20 --threads 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from bson import ObjectId
+
+# Shared modules live in the repository root.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import db
+import event_sink
+import server
+import storage
+from quiz import Quiz
+
+BENCHMARK_DATABASE = "bridge_server_benchmark"
+HANDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+        "data", "hands.json")
+
+def load_synthetic_data(app_storage, n_hands, n_clients, rng):
+    """
+    Write n_hands copies of the example hands, with new _ids and elos, and
+    one user per client. The correct answer of each hand is "right", so
+    clients choose whether they are correct.
+    """
+
+    with open(HANDS_PATH) as f:
+        examples = json.load(f)
+
+    hands = []
+    for hand_index in range(n_hands):
+        hand_json = dict(examples[hand_index % len(examples)])
+        hand_json["_id"] = ObjectId()
+        hand_json["elo"] = rng.gauss(1200, 200)
+        hand_json["correct_answer"] = "right"
+        hands.append(hand_json)
+    app_storage.put_hands(hands)
+    app_storage.put_users([{"username" : "user{}".format(client_index),
+        "elo" : 1200.0} for client_index in range(n_clients)])
+
+    return None
+
+async def request(reader, writer, method, path, body=b""):
+    """Send one request on a keep-alive connection; return (status, JSON)."""
+
+    writer.write("{} {} HTTP/1.1\r\nHost: benchmark\r\nContent-Length: {}\r\n\r\n".format(
+        method, path, len(body)).encode("latin-1") + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in [b"\r\n", b""]:
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            content_length = int(value)
+
+    return status, json.loads(await reader.readexactly(content_length))
+
+async def run_client(client_index, port, deadline, rng, latencies, counts):
+    """One virtual user: next, answer, repeat until the deadline."""
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    query = "?username=user{}&session=client{}".format(client_index, client_index)
+    try:
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            status, problem = await request(reader, writer, "GET", "/next" + query)
+            latencies["next"].append(time.perf_counter() - started)
+            if status != 200:
+                counts["errors"] += 1
+                continue
+
+            # Answer correctly half the time.
+            answer = "right" if rng.random() < 0.5 else "wrong"
+            started = time.perf_counter()
+            status, result = await request(reader, writer, "POST", "/answer" + query,
+                    json.dumps({"answer" : answer}).encode("utf-8"))
+            latencies["answer"].append(time.perf_counter() - started)
+            if status != 200:
+                counts["errors"] += 1
+            else:
+                counts["answers"] += 1
+    finally:
+        writer.close()
+
+async def run_clients(n_clients, port, seconds, seed):
+    latencies = {"next" : [], "answer" : []}
+    counts = {"answers" : 0, "errors" : 0}
+    deadline = time.perf_counter() + seconds
+    started = time.perf_counter()
+    await asyncio.gather(*[run_client(client_index, port, deadline,
+        random.Random(seed + client_index), latencies, counts)
+        for client_index in range(n_clients)])
+    elapsed = time.perf_counter() - started
+
+    return latencies, counts, elapsed
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+def start_server(quiz_server):
+    """Run the server's event loop in a daemon thread; return its port."""
+
+    ready = threading.Event()
+    state = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        listening = loop.run_until_complete(quiz_server.start("127.0.0.1", 0))
+        state["port"] = listening.sockets[0].getsockname()[1]
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name="server", daemon=True).start()
+    ready.wait()
+
+    return state["port"]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--threads", type=int, default=8,
+            help="server thread pool size")
+    parser.add_argument("--hands", type=int, default=10000)
+    parser.add_argument("--storage", choices=["sqlite", "mongo"], default="sqlite")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    if args.storage == "sqlite":
+        app_storage = storage.SQLiteStorage(os.path.join(directory.name,
+            "server.sqlite3"))
+    else:
+        db.get_client().drop_database(BENCHMARK_DATABASE)
+        app_storage = storage.MongoStorage(db.get_client()[BENCHMARK_DATABASE])
+    load_synthetic_data(app_storage, args.hands, args.clients,
+            random.Random(args.seed))
+
+    sink = event_sink.EventSink(app_storage)
+    quiz_server = server.QuizServer(Quiz.create(app_storage, sink), args.threads)
+    port = start_server(quiz_server)
+
+    latencies, counts, elapsed = asyncio.run(run_clients(args.clients, port,
+        args.seconds, args.seed))
+    sink.close()
+    if args.storage == "mongo":
+        db.get_client().drop_database(BENCHMARK_DATABASE)
+
+    n_requests = len(latencies["next"]) + len(latencies["answer"])
+    results = {
+        "clients" : args.clients,
+        "threads" : args.threads,
+        "storage" : args.storage,
+        "requests_per_second" : n_requests / elapsed,
+        "answers_per_second" : counts["answers"] / elapsed,
+        "errors" : counts["errors"],
+        "events_written" : sink.stats()["written"],
+    }
+    for endpoint, values in latencies.items():
+        results[endpoint + "_ms"] = {"p{}".format(int(100*fraction)) :
+                1000*percentile(values, fraction) for fraction in [0.5, 0.95, 0.99]}
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
@@ -0,0 +1,201 @@
+"""
+Benchmark of the storage backends (storage.py) on the session.py workload.
+
+A synthetic set of hands and users is written to each backend, then page
+views are replayed the way quiz.py makes them: read the user's elo, read
+the hand shown, queue a "shown" event, and for an answer read the hand's
+current elo, add the elo changes with increment_elos and queue an
+"answer" event. Events are written in batches of --event-batch, as the
+event sink does, and a --fallback-rate share of page views also reads
+the user's last shown event and any answer to it since. The hand cache
+is left out, so every page view reads its hand from the backend, and
+the rating updater writes every answer at once, its default.
+
+Reported per backend:
+    load_seconds          writing the hands and users
+    elo_index_seconds     reading the (elo, _id) pairs, done at start up
+    <operation>_us        mean and p95 microseconds per call
+    page_views_per_second
+
+The Mongo backend is only run with --mongo, against a separate
+database which is dropped afterwards.
+
+Usage:
+    python benchmarks/storage.py
+    python benchmarks/storage.py --hands 100000 --page-views 20000 --mongo
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from bson import ObjectId
+
+# Shared modules live in the repository root.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import db
+import storage
+
+BENCHMARK_DATABASE = "bridge_storage_benchmark"
+HANDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+        "data", "hands.json")
+
+OPERATIONS = ["get_user", "get_hand", "get_hand_elo", "increment_elos",
+        "insert_events", "last_shown_event", "answer_since"]
+
+def synthetic_hands(n_hands, rng):
+    """Return n_hands copies of the example hands, with new _ids and elos."""
+
+    with open(HANDS_PATH) as f:
+        examples = json.load(f)
+
+    hands = []
+    for hand_index in range(n_hands):
+        hand_json = dict(examples[hand_index % len(examples)])
+        hand_json["_id"] = ObjectId()
+        hand_json["elo"] = rng.gauss(1200, 200)
+        hand_json["updated_at"] = time.time()
+        hands.append(hand_json)
+
+    return hands
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def benchmark_backend(backend, hands, n_users, n_page_views, event_batch,
+        fallback_rate, rng):
+    """
+    Load the backend, replay page views and return the timings, as a dict.
+    """
+
+    results = {}
+    timings = {operation : [] for operation in OPERATIONS}
+
+    def timed(operation, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        timings[operation].append(time.perf_counter() - started)
+        return result
+
+    usernames = ["user{}".format(user_index) for user_index in range(n_users)]
+
+    started = time.perf_counter()
+    for start in range(0, len(hands), 1000):
+        backend.put_hands(hands[start:start + 1000])
+    backend.put_users([{"username" : username, "elo" : 1200.0}
+        for username in usernames])
+    backend.ensure_indexes()
+    results["load_seconds"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    hand_ids = [hand_id for elo, hand_id in backend.hand_elos()]
+    results["elo_index_seconds"] = time.perf_counter() - started
+
+    events = []
+    started = time.perf_counter()
+    for page_view in range(n_page_views):
+        username = rng.choice(usernames)
+        timed("get_user", backend.get_user, username)
+        hand_json = timed("get_hand", backend.get_hand, rng.choice(hand_ids))
+
+        if page_view % 2:
+            timed("get_hand_elo", backend.get_hand_elo, hand_json["_id"])
+            timed("increment_elos", backend.increment_elos,
+                    {hand_json["_id"] : rng.uniform(-15, 15)},
+                    {username : rng.uniform(-15, 15)}, time.time())
+            events.append({"_id" : ObjectId(), "event_type" : "answer",
+                "username" : username, "hand_id" : hand_json["_id"],
+                "timestamp" : time.time()})
+
+        events.append({"_id" : ObjectId(), "event_type" : "shown",
+            "username" : username, "hand_id" : hand_json["_id"],
+            "correct_answer" : hand_json["correct_answer"],
+            "timestamp" : time.time()})
+        if len(events) >= event_batch:
+            timed("insert_events", backend.insert_events, events)
+            events = []
+
+        if rng.random() < fallback_rate:
+            shown_event = timed("last_shown_event", backend.last_shown_event,
+                    username)
+            if shown_event is not None:
+                timed("answer_since", backend.answer_since, username,
+                        shown_event["hand_id"], shown_event["timestamp"])
+
+    if events:
+        timed("insert_events", backend.insert_events, events)
+    elapsed = time.perf_counter() - started
+
+    for operation in OPERATIONS:
+        if timings[operation]:
+            results[operation + "_us"] = {
+                "mean" : 1e6 * sum(timings[operation]) / len(timings[operation]),
+                "p95" : 1e6 * percentile(timings[operation], 0.95),
+            }
+    results["page_views_per_second"] = n_page_views / elapsed
+
+    return results
+
+def print_results(results):
+    """Print one column per backend."""
+
+    names = list(results)
+    print("{:<26}".format("") + "".join("{:>22}".format(name) for name in names))
+    for key in ["load_seconds", "elo_index_seconds"]:
+        print("{:<26}".format(key) + "".join("{:>22.3f}".format(results[name][key])
+            for name in names))
+    for operation in OPERATIONS:
+        key = operation + "_us"
+        row = ["{:>10.1f} / {:>9.1f}".format(results[name][key]["mean"],
+            results[name][key]["p95"]) if key in results[name] else "{:>22}".format("-")
+            for name in names]
+        print("{:<26}".format(key + " mean/p95") + "".join(row))
+    print("{:<26}".format("page_views_per_second") + "".join("{:>22,.0f}".format(
+        results[name]["page_views_per_second"]) for name in names))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--hands", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--page-views", type=int, default=5000)
+    parser.add_argument("--event-batch", type=int, default=100,
+            help="events per insert, as BRIDGE_EVENT_BATCH_SIZE")
+    parser.add_argument("--fallback-rate", type=float, default=0.05,
+            help="share of page views which read the last shown event")
+    parser.add_argument("--mongo", action="store_true",
+            help="also benchmark Mongo, in database {}".format(BENCHMARK_DATABASE))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    hands = synthetic_hands(args.hands, rng)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        backend = storage.SQLiteStorage(os.path.join(directory, "benchmark.sqlite3"))
+        results["sqlite"] = benchmark_backend(backend, hands, args.users,
+                args.page_views, args.event_batch, args.fallback_rate,
+                random.Random(args.seed))
+        backend.close()
+
+    if args.mongo:
+        client = db.get_client()
+        client.drop_database(BENCHMARK_DATABASE)
+        try:
+            backend = storage.MongoStorage(client[BENCHMARK_DATABASE])
+            results["mongo"] = benchmark_backend(backend, hands, args.users,
+                    args.page_views, args.event_batch, args.fallback_rate,
+                    random.Random(args.seed))
+        finally:
+            client.drop_database(BENCHMARK_DATABASE)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
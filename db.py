@@ -0,0 +1,160 @@
+"""
+Shared MongoDB connection for every script in this repository.
+
+One MongoClient is created per process, on first use, and handed out from
+then on. Streamlit reruns session.py top to bottom on every interaction,
+but imported modules such as this one are kept, so reruns reuse the same
+connection pool instead of reconnecting.
+
+Settings are read from environment variables:
+    BRIDGE_MONGO_URI                 default mongodb://localhost:27017
+    BRIDGE_MONGO_DATABASE            default bridge_problem_database
+    BRIDGE_MONGO_MAX_POOL_SIZE       default 50
+    BRIDGE_MONGO_MIN_POOL_SIZE       default 0
+    BRIDGE_MONGO_CONNECT_TIMEOUT_MS  default 5000
+    BRIDGE_MONGO_SERVER_SELECTION_TIMEOUT_MS  default 5000
+    BRIDGE_MONGO_SOCKET_TIMEOUT_MS   default 10000
+"""
+import os
+import threading
+import pymongo
+from pymongo import monitoring
+import instrumentation
+
+DEFAULT_DATABASE = "bridge_problem_database"
+
+_client = None
+_client_lock = threading.Lock()
+
+class PoolStatistics(monitoring.ConnectionPoolListener):
+    """
+    Count connection pool events, to check that connections are reused.
+
+    A steady connections_created count under load means the pool is doing
+    its job; a count growing with page views means connection churn.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {
+            "pools_created" : 0,
+            "connections_created" : 0,
+            "connections_closed" : 0,
+            "connections_checked_out" : 0,
+            "connections_checked_in" : 0,
+            "checkout_failures" : 0,
+        }
+
+    def _increment(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def pool_created(self, event):
+        self._increment("pools_created")
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._increment("connections_created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._increment("connections_closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._increment("checkout_failures")
+
+    def connection_checked_out(self, event):
+        self._increment("connections_checked_out")
+
+    def connection_checked_in(self, event):
+        self._increment("connections_checked_in")
+
+    def snapshot(self):
+        """Return a copy of the counts, plus connections currently open."""
+
+        with self._lock:
+            counts = dict(self.counts)
+        counts["connections_open"] = (counts["connections_created"]
+                - counts["connections_closed"])
+        counts["connections_in_use"] = (counts["connections_checked_out"]
+                - counts["connections_checked_in"])
+
+        return counts
+
+pool_statistics = PoolStatistics()
+
+def client_settings():
+    """
+    Return the MongoClient keyword arguments, from environment variables.
+    """
+
+    environ = os.environ
+    settings = {
+        "host" : environ.get("BRIDGE_MONGO_URI", "mongodb://localhost:27017"),
+        "maxPoolSize" : int(environ.get("BRIDGE_MONGO_MAX_POOL_SIZE", 50)),
+        "minPoolSize" : int(environ.get("BRIDGE_MONGO_MIN_POOL_SIZE", 0)),
+        "connectTimeoutMS" : int(environ.get("BRIDGE_MONGO_CONNECT_TIMEOUT_MS", 5000)),
+        "serverSelectionTimeoutMS" : int(environ.get(
+            "BRIDGE_MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+        "socketTimeoutMS" : int(environ.get("BRIDGE_MONGO_SOCKET_TIMEOUT_MS", 10000)),
+    }
+
+    return settings
+
+def get_client():
+    """
+    Return the process-wide MongoClient, creating it on first use.
+
+    MongoClient is thread-safe, so the same client serves every Streamlit
+    session in the process.
+    """
+
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # Commands are counted as round trips, see instrumentation.py.
+                _client = pymongo.MongoClient(event_listeners=[pool_statistics,
+                    instrumentation.command_counter], **client_settings())
+
+    return _client
+
+def close_client():
+    """Close the process-wide client; the next get_client() reconnects."""
+
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+    return None
+
+def get_database():
+    """Return the bridge problem database."""
+
+    database_name = os.environ.get("BRIDGE_MONGO_DATABASE", DEFAULT_DATABASE)
+    return get_client()[database_name]
+
+def get_hands_collection():
+    """Return the "hands" collection: one document per problem."""
+
+    return get_database()["hands"]
+
+def get_pool_statistics():
+    """Return a snapshot of connection pool counts, see PoolStatistics."""
+
+    return pool_statistics.snapshot()
@@ -0,0 +1,300 @@
+"""
+Compact bitboard representation of a bridge deal.
+
+Each seat holds a 52-bit integer mask. Bit (13 * suit_index + rank_index)
+is set when the seat holds that card, so every suit occupies its own 13-bit
+slice with the ace in the highest bit:
+
+    bits  0-12  spades     (2 ... A)
+    bits 13-25  hearts
+    bits 26-38  diamonds
+    bits 39-51  clubs
+
+Hands are converted losslessly to and from the list format stored in the
+database (["SA", "SK", ..., "C2"]) and the hand strings accepted by
+alter_database.parse_hand_string_to_list ("AKJ QJT9 752 9842").
+"""
+
+SUITS = "SHDC"
+RANKS = "23456789TJQKA"
+SEATS = "NESW" # clockwise order, as play proceeds.
+
+# Database keys of each seat, in SEATS order.
+SEAT_KEYS = ["n_hand", "e_hand", "s_hand", "w_hand"]
+
+SUIT_MASK = (1 << 13) - 1
+FULL_DECK = (1 << 52) - 1
+
+# Masks selecting one rank in all four suits, used for HCP counting.
+_ALL_SUITS_ACE = sum(1 << (13*suit_index + 12) for suit_index in range(4))
+_ALL_SUITS_KING = _ALL_SUITS_ACE >> 1
+_ALL_SUITS_QUEEN = _ALL_SUITS_ACE >> 2
+_ALL_SUITS_JACK = _ALL_SUITS_ACE >> 3
+
+# Card string <-> single bit lookups, e.g. "SA" <-> 1 << 12.
+CARD_TO_BIT = {}
+for _suit_index, _suit in enumerate(SUITS):
+    for _rank_index, _rank in enumerate(RANKS):
+        CARD_TO_BIT[_suit + _rank] = 1 << (13*_suit_index + _rank_index)
+BIT_INDEX_TO_CARD = {bit.bit_length() - 1 : card
+        for card, bit in CARD_TO_BIT.items()}
+
+def popcount(mask):
+    """Return the number of set bits (cards) in a mask."""
+
+    return bin(mask).count("1")
+
+def card_to_bit(card):
+    """
+    Return the single-bit mask of a card.
+
+    Parameters:
+        card (string) e.g. "SA" or "C2"
+
+    Returns:
+        bit (int) e.g. 1 << 12
+    """
+
+    INVALID_CARD_ERROR = "card not understood: {}".format(card)
+    assert card in CARD_TO_BIT, INVALID_CARD_ERROR
+
+    return CARD_TO_BIT[card]
+
+def hand_list_to_mask(hand_list):
+    """
+    Convert a list of cards to a mask.
+
+    Parameters:
+        hand_list (string []) e.g. ["SA", ..., "C2"]
+
+    Returns:
+        mask (int) 52-bit mask with one bit per card.
+    """
+
+    mask = 0
+    for card in hand_list:
+        bit = card_to_bit(card)
+
+        DUPLICATE_CARD_ERROR = "card appears twice: {}".format(card)
+        assert not mask & bit, DUPLICATE_CARD_ERROR
+        mask |= bit
+
+    return mask
+
+def mask_to_hand_list(mask):
+    """
+    Convert a mask to a list of cards, spades first, high cards first.
+
+    Parameters:
+        mask (int)
+
+    Returns:
+        hand_list (string []) e.g. ["SA", ..., "C2"]
+    """
+
+    hand_list = []
+    for suit_index, suit in enumerate(SUITS):
+        suit_bits = suit_slice(mask, suit_index)
+        for rank_index in range(12, -1, -1):
+            if suit_bits >> rank_index & 1:
+                hand_list.append(suit + RANKS[rank_index])
+
+    return hand_list
+
+def hand_string_to_mask(hand_str):
+    """
+    Convert a hand string to a mask.
+
+    Parameters:
+        hand_str (string) e.g. "AKJ QJT9 752 9842", suits separated by single
+        spaces in the order S H D C. A void is an empty string or "-".
+
+    Returns:
+        mask (int)
+    """
+
+    hand_strs_by_suit = hand_str.split(" ")
+    NOT_4_SUITS_ERROR_MSG = "hand cannot be parsed into 4 suits"
+    assert len(hand_strs_by_suit) == 4, NOT_4_SUITS_ERROR_MSG
+
+    hand_list = []
+    for suit, cards_str in zip(SUITS, hand_strs_by_suit):
+        hand_list += [suit + rank for rank in cards_str if rank != "-"]
+
+    return hand_list_to_mask(hand_list)
+
+def mask_to_hand_string(mask):
+    """
+    Convert a mask to a hand string.
+
+    The result round-trips through both hand_string_to_mask and
+    alter_database.parse_hand_string_to_list, so voids are written as
+    empty strings rather than "-".
+
+    Parameters:
+        mask (int)
+
+    Returns:
+        hand_str (string) e.g. "AKJ QJT9 752 9842"
+    """
+
+    return " ".join(suit_ranks(mask, suit_index) for suit_index in range(4))
+
+def suit_slice(mask, suit_index):
+    """Return the 13-bit slice of one suit, bit 12 being the ace."""
+
+    return (mask >> (13*suit_index)) & SUIT_MASK
+
+def suit_ranks(mask, suit_index):
+    """Return the ranks held in one suit, high first, e.g. "KT72"."""
+
+    suit_bits = suit_slice(mask, suit_index)
+    return "".join(RANKS[rank_index] for rank_index in range(12, -1, -1)
+            if suit_bits >> rank_index & 1)
+
+def suit_length(mask, suit_index):
+    """Return the number of cards held in one suit."""
+
+    return popcount(suit_slice(mask, suit_index))
+
+def shape(mask):
+    """Return suit lengths as a tuple in the order S H D C, e.g. (5, 3, 3, 2)."""
+
+    return tuple(suit_length(mask, suit_index) for suit_index in range(4))
+
+def hcp(mask):
+    """Return high card points (A=4, K=3, Q=2, J=1)."""
+
+    return (4*popcount(mask & _ALL_SUITS_ACE) + 3*popcount(mask & _ALL_SUITS_KING)
+            + 2*popcount(mask & _ALL_SUITS_QUEEN) + popcount(mask & _ALL_SUITS_JACK))
+
+class Deal(object):
+    """
+    Four seat masks, in the order N E S W.
+
+    A Deal is immutable and hashable, so it can key dictionaries such as
+    a solver transposition table or a render cache.
+    """
+
+    __slots__ = ("masks",)
+
+    def __init__(self, masks):
+        """
+        Parameters:
+            masks (int []) four 52-bit masks in the order N E S W.
+        """
+
+        NOT_4_SEATS_ERROR = "a deal requires exactly 4 seats"
+        assert len(masks) == 4, NOT_4_SEATS_ERROR
+        object.__setattr__(self, "masks", tuple(masks))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Deal is immutable")
+
+    def __eq__(self, other):
+        return isinstance(other, Deal) and self.masks == other.masks
+
+    def __hash__(self):
+        return hash(self.masks)
+
+    def __repr__(self):
+        return "Deal({})".format(self.to_pbn())
+
+    @classmethod
+    def from_hand_json(cls, hand_json):
+        """
+        Build a Deal from a hand document, using the keys n_hand, e_hand,
+        s_hand and w_hand. Each value may be a card list or a hand string.
+        """
+
+        masks = []
+        for key in SEAT_KEYS:
+            hand = hand_json[key]
+            if isinstance(hand, str):
+                masks.append(hand_string_to_mask(hand))
+            else:
+                masks.append(hand_list_to_mask(hand))
+
+        return cls(masks)
+
+    @classmethod
+    def from_hand_strings(cls, hand_strs):
+        """Build a Deal from four hand strings in the order N E S W."""
+
+        return cls([hand_string_to_mask(hand_str) for hand_str in hand_strs])
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Inverse of to_bytes()."""
+
+        packed = int.from_bytes(data, "big")
+        return cls([(packed >> (52*(3 - seat_index))) & FULL_DECK
+            for seat_index in range(4)])
+
+    def to_hand_json(self):
+        """
+        Return the four hands in the database layout, e.g.
+        {"n_hand" : ["SA", ...], "e_hand" : [...], ...}
+        """
+
+        return {key : mask_to_hand_list(mask)
+                for key, mask in zip(SEAT_KEYS, self.masks)}
+
+    def to_bytes(self):
+        """Pack the four 52-bit masks into 26 bytes."""
+
+        packed = 0
+        for mask in self.masks:
+            packed = (packed << 52) | mask
+        return packed.to_bytes(26, "big")
+
+    def to_pbn(self):
+        """Return the deal in PBN notation, e.g. "N:AKJ.QJT9.752.9842 ..."."""
+
+        seat_strs = [".".join(suit_ranks(mask, suit_index) for suit_index in range(4))
+                for mask in self.masks]
+        return "N:" + " ".join(seat_strs)
+
+    def hand(self, seat):
+        """Return the mask of a seat, given as "N", "E", "S" or "W"."""
+
+        return self.masks[SEATS.index(seat)]
+
+    def hand_list(self, seat):
+        """Return the card list of a seat, given as "N", "E", "S" or "W"."""
+
+        return mask_to_hand_list(self.hand(seat))
+
+    def hcp(self):
+        """Return HCP per seat, in the order N E S W."""
+
+        return tuple(hcp(mask) for mask in self.masks)
+
+    def shapes(self):
+        """Return the shape of each seat, in the order N E S W."""
+
+        return tuple(shape(mask) for mask in self.masks)
+
+    def validate(self):
+        """
+        Check the deal is complete: 13 cards per seat, and all 52 cards
+        dealt exactly once. Raises an AssertionError describing the first
+        problem found.
+        """
+
+        for seat, mask in zip(SEATS, self.masks):
+            NOT_13_CARDS_ERROR = "{} holds {} cards, not 13".format(
+                    seat, popcount(mask))
+            assert popcount(mask) == 13, NOT_13_CARDS_ERROR
+
+        combined = 0
+        for mask in self.masks:
+            DUPLICATE_CARD_ERROR = "a card is dealt to more than one seat: {}".format(
+                    mask_to_hand_list(combined & mask))
+            assert not combined & mask, DUPLICATE_CARD_ERROR
+            combined |= mask
+
+        MISSING_CARD_ERROR = "cards are missing from the deal"
+        assert combined == FULL_DECK, MISSING_CARD_ERROR
+
+        return None
@@ -0,0 +1,254 @@
+"""
+Generate random deals in bulk, filtered by HCP, suit lengths and fixed cards.
+
+Deals are made a batch at a time with NumPy: argsort of random keys gives
+one permutation of the 52 cards per row, reshaped to (N, 4, 13) as the
+hands of N, E, S and W. Card numbers follow deal.py: card = 13*suit + rank,
+suits in the order S H D C and ranks 2 ... A. Constraints are evaluated
+on whole batches, and surviving deals are returned as hand documents in
+the layout render_hand consumes.
+
+Constraints are given per seat:
+    {"S" : {"hcp" : [15, 17], "balanced" : True},
+     "N" : {"hcp" : [0, 9], "H" : [5, 13]}}
+where "S" "H" "D" "C" give suit length ranges and ranges are inclusive.
+Fixed cards are given per seat as card lists, e.g. {"S" : ["SA", "SK"]}.
+
+Usage:
+    python deal_generator.py --count 5
+    python deal_generator.py --count 100 --constraints '{"S" : {"hcp" : [15, 17], "balanced" : true}}'
+    python deal_generator.py --count 10 --fixed '{"W" : ["HK", "HQ", "HJ"]}'
+"""
+import argparse
+import json
+import numpy as np
+from deal import SEATS, SUITS, card_to_bit, Deal
+
+DEFAULT_BATCH_SIZE = 100000
+
+# High card points of each card number: J Q K A are the top four ranks.
+HCP_BY_CARD = np.tile(np.array([0]*9 + [1, 2, 3, 4], dtype=np.int8), 4)
+
+# Suit of each card number.
+SUIT_BY_CARD = np.arange(52, dtype=np.int8) // 13
+
+# Each card as one int64: a 1 in the byte of its suit (bytes 0-3, S H D C)
+# and its HCP in byte 4. Summed over a hand, this gives the four suit
+# lengths and the HCP in one pass.
+SUMMARY_BY_CARD = (np.left_shift(1, 8*SUIT_BY_CARD.astype(np.int64))
+        + np.left_shift(HCP_BY_CARD.astype(np.int64), 32))
+
+def random_deals(n_deals, rng, fixed=None):
+    """
+    Return n_deals random deals as card numbers.
+
+    Parameters:
+        n_deals (int)
+        rng (np.random.Generator)
+        fixed (dict) optional, seat -> cards that seat must hold, e.g.
+            {"S" : ["SA", "SK"]}.
+
+    Returns:
+        deals (int8 np.ndarray) shape (n_deals, 4, 13), seats in the order
+        N E S W. Cards within a hand are not sorted.
+
+    Keys are float32, so ties are possible but rare (about one deal in
+    10^4 has one); a tie only fixes the order of two cards, which biases
+    the deal distribution negligibly.
+    """
+
+    if not fixed:
+        keys = rng.random((n_deals, 52), dtype=np.float32)
+        return keys.argsort(axis=1).astype(np.int8).reshape(n_deals, 4, 13)
+
+    # Deal the fixed cards, then shuffle the rest into the empty places.
+    fixed_cards = [[card_to_bit(card).bit_length() - 1 for card in fixed.get(seat, [])]
+            for seat in SEATS]
+    all_fixed = [card for cards in fixed_cards for card in cards]
+    DUPLICATE_FIXED_ERROR = "a fixed card is given to more than one seat"
+    assert len(set(all_fixed)) == len(all_fixed), DUPLICATE_FIXED_ERROR
+    for seat, cards in zip(SEATS, fixed_cards):
+        TOO_MANY_FIXED_ERROR = "{} has more than 13 fixed cards".format(seat)
+        assert len(cards) <= 13, TOO_MANY_FIXED_ERROR
+
+    free_cards = np.array(sorted(set(range(52)) - set(all_fixed)), dtype=np.int8)
+    keys = rng.random((n_deals, len(free_cards)), dtype=np.float32)
+    shuffled = free_cards[keys.argsort(axis=1)]
+
+    deals = np.empty((n_deals, 4, 13), dtype=np.int8)
+    position = 0
+    for seat_index, cards in enumerate(fixed_cards):
+        n_free = 13 - len(cards)
+        deals[:, seat_index, :len(cards)] = cards
+        deals[:, seat_index, len(cards):] = shuffled[:, position:position + n_free]
+        position += n_free
+
+    return deals
+
+def summarize(deals):
+    """
+    Return HCP and suit lengths of every seat.
+
+    Returns:
+        (seat_hcp, lengths) int8 np.ndarrays of shapes (n_deals, 4), and
+        (n_deals, 4, 4) with suits in the order S H D C.
+    """
+
+    packed = SUMMARY_BY_CARD[deals].sum(axis=2)
+    lengths = np.stack([(packed >> (8*suit_index)) & 0xff
+        for suit_index in range(4)], axis=2).astype(np.int8)
+    seat_hcp = (packed >> 32).astype(np.int8)
+
+    return seat_hcp, lengths
+
+def hcp(deals):
+    """Return HCP per seat, shape (n_deals, 4)."""
+
+    return summarize(deals)[0]
+
+def suit_lengths(deals):
+    """Return suit lengths per seat, shape (n_deals, 4, 4), suits S H D C."""
+
+    return summarize(deals)[1]
+
+def constraint_mask(deals, constraints):
+    """
+    Return which deals meet the constraints.
+
+    Parameters:
+        deals (int8 np.ndarray) shape (n_deals, 4, 13).
+        constraints (dict) see the module docstring.
+
+    Returns:
+        accepted (bool np.ndarray) shape (n_deals,).
+    """
+
+    accepted = np.ones(len(deals), dtype=bool)
+    if not constraints:
+        return accepted
+
+    seat_hcp, lengths = summarize(deals)
+
+    for seat, seat_constraints in constraints.items():
+        INVALID_SEAT_ERROR = "seat must be one of N E S W, not {}".format(seat)
+        assert seat in SEATS, INVALID_SEAT_ERROR
+        seat_index = SEATS.index(seat)
+
+        for key, value in seat_constraints.items():
+            if key == "hcp":
+                low, high = value
+                accepted &= (seat_hcp[:, seat_index] >= low) & (
+                        seat_hcp[:, seat_index] <= high)
+
+            elif key in SUITS:
+                low, high = value
+                suit_length = lengths[:, seat_index, SUITS.index(key)]
+                accepted &= (suit_length >= low) & (suit_length <= high)
+
+            elif key == "balanced":
+                # 4333, 4432 or 5332: no suit under 2, at most one doubleton.
+                seat_lengths = lengths[:, seat_index, :]
+                balanced = (seat_lengths.min(axis=1) >= 2) & (
+                        (seat_lengths == 2).sum(axis=1) <= 1)
+                accepted &= balanced if value else ~balanced
+
+            else:
+                INVALID_CONSTRAINT_ERROR = "constraint not understood: {}".format(key)
+                raise Exception(INVALID_CONSTRAINT_ERROR)
+
+    return accepted
+
+def deals_to_masks(deals):
+    """
+    Return the hands as 52-bit masks (see deal.py), shape (n_deals, 4),
+    dtype uint64.
+    """
+
+    bits = np.left_shift(np.uint64(1), deals.astype(np.uint64))
+    return np.bitwise_or.reduce(bits, axis=2)
+
+def deal_to_hand_json(masks):
+    """
+    Return one deal, given as its 4 masks, as a hand document:
+    {"n_hand" : ["SA", ...], "e_hand" : [...], "s_hand" : [...], "w_hand" : [...]}
+    """
+
+    return Deal([int(mask) for mask in masks]).to_hand_json()
+
+def generate_deals(n_wanted, constraints=None, fixed=None, rng=None,
+        batch_size=DEFAULT_BATCH_SIZE, max_batches=None):
+    """
+    Generate deals meeting the constraints, a batch at a time.
+
+    Parameters:
+        n_wanted (int) deals to return.
+        constraints (dict) see the module docstring.
+        fixed (dict) seat -> cards that seat must hold.
+        rng (np.random.Generator) default a freshly seeded one.
+        batch_size (int) deals generated per batch.
+        max_batches (int) optional, give up after this many batches, e.g.
+            for constraints which are rarely met.
+
+    Returns:
+        masks (uint64 np.ndarray) shape (n, 4), n <= n_wanted, one row of
+        N E S W masks per accepted deal.
+    """
+
+    rng = rng or np.random.default_rng()
+
+    accepted_masks = []
+    n_accepted = 0
+    n_batches = 0
+    while n_accepted < n_wanted and (max_batches is None or n_batches < max_batches):
+        deals = random_deals(batch_size, rng, fixed)
+        deals = deals[constraint_mask(deals, constraints)]
+        deals = deals[:n_wanted - n_accepted]
+        accepted_masks.append(deals_to_masks(deals))
+        n_accepted += len(deals)
+        n_batches += 1
+
+    if not accepted_masks:
+        return np.empty((0, 4), dtype=np.uint64)
+
+    return np.concatenate(accepted_masks)
+
+def generate_problem_candidates(n_wanted, constraints=None, fixed=None, rng=None,
+        dealer=None, **kwargs):
+    """
+    Yield hand documents for deals meeting the constraints, ready to be
+    given a question and answer, e.g. with import_problems.py.
+
+    Parameters:
+        n_wanted, constraints, fixed, rng see generate_deals().
+        dealer (string) optional, N E S or W, added to every document.
+        kwargs passed on to generate_deals().
+
+    Yields:
+        hand_json (json)
+    """
+
+    masks = generate_deals(n_wanted, constraints, fixed, rng, **kwargs)
+    for deal_masks in masks:
+        hand_json = deal_to_hand_json(deal_masks)
+        if dealer is not None:
+            hand_json["dealer"] = dealer
+        yield hand_json
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--count", type=int, default=10, help="deals to generate")
+    parser.add_argument("--constraints", type=json.loads, default=None,
+            help="JSON constraints per seat, see the module docstring")
+    parser.add_argument("--fixed", type=json.loads, default=None,
+            help='JSON fixed cards per seat, e.g. {"S" : ["SA"]}')
+    parser.add_argument("--dealer", choices=list(SEATS))
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--max-batches", type=int, default=None)
+    args = parser.parse_args()
+
+    # One hand document per line, the format import_problems.py reads.
+    for hand_json in generate_problem_candidates(args.count, args.constraints,
+            args.fixed, np.random.default_rng(args.seed), dealer=args.dealer,
+            max_batches=args.max_batches):
+        print(json.dumps(hand_json))
@@ -0,0 +1,471 @@
+"""
+Duplicate and near-duplicate detection of deals.
+
+The same problem is often printed in several sources we import, e.g. an
+ACBL Bulletin column reprinted in a Kantar book, and a reprint may turn
+the table (rotate the seats), swap the suits of a notrump hand, or change
+spot cards. Each hand document holds a "deal_hashes" sub-document,
+computed by compute_deal_hashes() when alter_database.py or
+import_problems.py writes the hand:
+
+    canonical   hash of the deal in canonical form: the seat rotation which
+                sorts highest, so rotated copies hash the same
+    notrump     for a notrump contract only, otherwise None: the same with
+                the suits also put in the order which sorts highest, so
+                suit-swapped copies hash the same
+    spotless    the canonical form with the spot cards (2-9) of each suit
+                reduced to their number, so copies which differ only in
+                which spots are held hash the same
+    sketch      MinHash of the spotless deal's per seat and suit honors and
+                lengths, whose agreement estimates how alike two deals are
+    bands       the sketch in N_BANDS pieces; deals sharing a band are
+                candidates for near duplicates (locality-sensitive hashing)
+    version     DEAL_HASHES_VERSION when computed
+
+Only the notrump hash depends on the contract, whose strain is read from
+the hand's text (see hand_features.py) and so may be missing or wrong;
+two hands are compared on it only when both are notrump, and every other
+hash is of the cards alone.
+
+The spotless form, and so the sketch, is oriented by honors first, which
+moving a spot card does not change, so near duplicates are compared seat
+for seat and suit for suit.
+
+dedupe_report() groups every hand of a collection by canonical, notrump
+and spotless hash, and compares only hands sharing a band, so it runs in
+near-linear time rather than comparing every pair. find_duplicates() runs
+the same test for one new hand, with an indexed query on Mongo (see
+schema.py) and a scan of the stored hashes otherwise.
+
+Usage:
+    python deal_hashing.py backfill
+    python deal_hashing.py report --threshold 0.8 --output duplicates.json
+"""
+import argparse
+import hashlib
+import json
+import zlib
+import numpy as np
+import hand_features
+import storage
+from deal import Deal, popcount, suit_slice
+
+# Bump when a hash changes, so backfill recomputes stored hashes.
+DEAL_HASHES_VERSION = 2
+
+# MinHash sketch: N_HASHES values, in N_BANDS bands of ROWS_PER_BAND.
+N_HASHES = 64
+N_BANDS = 16
+ROWS_PER_BAND = N_HASHES // N_BANDS
+SKETCH_SEED = 52
+
+# Estimated similarity at which two deals are reported as near duplicates.
+DEFAULT_THRESHOLD = 0.6
+
+# Bands shared by more hands than this are compared against one member only.
+MAX_BUCKET_SIZE = 50
+
+# Bit of the ten in a suit slice; the ten and above are honors, the rest spots.
+HONOR_SHIFT = 8
+
+# Coefficients of the MinHash functions, multiply-shift hashes
+# ((a*x + b) mod 2**64) >> 32 with a odd.
+_SKETCH_WORDS = np.random.RandomState(SKETCH_SEED).randint(0, 1 << 32,
+        size=(4, N_HASHES)).astype(np.uint64)
+_SKETCH_A = (_SKETCH_WORDS[0] << np.uint64(32)) | _SKETCH_WORDS[1] | np.uint64(1)
+_SKETCH_B = (_SKETCH_WORDS[2] << np.uint64(32)) | _SKETCH_WORDS[3]
+
+def canonical_form(masks, permute_suits=False, spotless=False):
+    """
+    Return a deal in a form shared by its seat rotations and, optionally,
+    suit permutations.
+
+    Parameters:
+        masks (int []) four seat masks, in the order N E S W.
+        permute_suits (boolean) also make the form the same for every order
+            of the suits, for notrump deals.
+        spotless (boolean) reduce the spot cards of each suit to their
+            number.
+
+    Returns:
+        columns (int [] []) per suit, the suit held by each seat: a 13-bit
+        slice, or if spotless honors << 4 | length.
+
+    Each rotation's suits are sorted, and the rotation which sorts highest
+    is kept, comparing honors before the rest.
+    """
+
+    best_key = None
+    for rotation in range(4):
+        seat_masks = masks[rotation:] + masks[:rotation]
+
+        columns = []
+        for suit_index in range(4):
+            suit_slices = [suit_slice(mask, suit_index) for mask in seat_masks]
+            honors = tuple(suit_bits >> HONOR_SHIFT for suit_bits in suit_slices)
+            if spotless:
+                values = tuple((suit_bits >> HONOR_SHIFT) << 4 | popcount(suit_bits)
+                        for suit_bits in suit_slices)
+            else:
+                values = tuple(suit_slices)
+            columns.append((honors, values))
+        if permute_suits:
+            columns.sort(reverse=True)
+
+        key = (tuple(honors for honors, _ in columns),
+                tuple(values for _, values in columns))
+        if best_key is None or key > best_key:
+            best_key = key
+
+    return best_key[1]
+
+def contract_strain(hand_json):
+    """Return the strain of a hand's contract, e.g. "N", or None."""
+
+    features = hand_json.get("features")
+    if hand_features.needs_features(hand_json):
+        try:
+            features = hand_features.compute_features(hand_json)
+        except AssertionError:
+            return None
+
+    return features.get("contract_strain")
+
+def sketch_tokens(columns):
+    """Return the features a sketch is taken over, of a spotless form."""
+
+    tokens = []
+    for suit_index, column in enumerate(columns):
+        for seat_index, value in enumerate(column):
+            honors, length = value >> 4, value & 15
+            tokens += ["{}{}h{}".format(seat_index, suit_index, honors),
+                    "{}{}l{}".format(seat_index, suit_index, length),
+                    "{}{}h{}l{}".format(seat_index, suit_index, honors, length)]
+
+    return tokens
+
+def minhash(tokens):
+    """Return the MinHash sketch (int []) of a set of string tokens."""
+
+    values = np.array([zlib.crc32(token.encode()) for token in set(tokens)],
+            dtype=np.uint64)
+    # Products wrap around, which is the mod 2**64.
+    hashes = (_SKETCH_A[:, None]*values[None, :] + _SKETCH_B[:, None]) >> np.uint64(32)
+
+    return [int(value) for value in hashes.min(axis=1)]
+
+def band_keys(sketch):
+    """Return the band keys of a sketch, e.g. ["0:9f2c...", ...]."""
+
+    keys = []
+    for band in range(N_BANDS):
+        rows = sketch[band*ROWS_PER_BAND:(band + 1)*ROWS_PER_BAND]
+        keys.append("{}:{}".format(band, _digest(rows, digest_size=8)))
+
+    return keys
+
+def similarity(sketch, other_sketch):
+    """Return the fraction of equal values of two sketches, which
+    estimates the overlap of the honors and lengths of two deals."""
+
+    return sum(value == other for value, other in zip(sketch, other_sketch)) / N_HASHES
+
+def compute_deal_hashes(hand_json):
+    """
+    Return the deal hashes of a hand document.
+
+    Parameters:
+        hand_json (json) with the four hands, as card lists or hand strings.
+
+    Returns:
+        deal_hashes (dict) see the module docstring.
+
+    Raises an AssertionError if a card is not understood.
+    """
+
+    masks = list(Deal.from_hand_json(hand_json).masks)
+
+    spotless_columns = canonical_form(masks, spotless=True)
+    sketch = minhash(sketch_tokens(spotless_columns))
+    notrump = None
+    if contract_strain(hand_json) == "N":
+        notrump = _digest(canonical_form(masks, permute_suits=True))
+
+    return {
+        "canonical" : _digest(canonical_form(masks)),
+        "notrump" : notrump,
+        "spotless" : _digest(spotless_columns),
+        "sketch" : sketch,
+        "bands" : band_keys(sketch),
+        "version" : DEAL_HASHES_VERSION,
+    }
+
+def needs_deal_hashes(hand_json, force=False):
+    """Return True if a hand has no deal hashes, or hashes of an old version."""
+
+    deal_hashes = hand_json.get("deal_hashes")
+    return (force or not deal_hashes
+            or deal_hashes.get("version") != DEAL_HASHES_VERSION)
+
+def backfill(hand_storage, force=False):
+    """
+    Compute and store the deal hashes of every hand without current ones.
+
+    Parameters:
+        hand_storage (storage.Storage)
+        force (boolean) recompute every hand's deal hashes.
+
+    Returns:
+        summary (dict) counts "read", "updated" and "failed".
+    """
+
+    summary = {"read" : 0, "updated" : 0, "failed" : 0}
+    for hand_json in hand_storage.iter_hands():
+        summary["read"] += 1
+        if not needs_deal_hashes(hand_json, force):
+            continue
+        try:
+            deal_hashes = compute_deal_hashes(hand_json)
+        except AssertionError as error:
+            print("{}: {}".format(hand_json["_id"], error))
+            summary["failed"] += 1
+            continue
+        # Only the hashes are set, so concurrent elo updates are kept.
+        hand_storage.update_hand(hand_json["_id"], {"deal_hashes" : deal_hashes})
+        summary["updated"] += 1
+
+    # Tell running apps to reload their cached hands.
+    if summary["updated"]:
+        hand_storage.bump_generation()
+
+    return summary
+
+def match(deal_hashes, other_hashes):
+    """
+    Compare the deal hashes of two hands.
+
+    Returns:
+        (kind, similarity) kind "exact" for the same canonical deal,
+        "suits" for two notrump hands with the same deal but for the order
+        of the suits, "spots" for the same deal but for spot cards,
+        otherwise "near"; similarity the estimate of similarity(), 1.0
+        unless "near".
+    """
+
+    if deal_hashes["canonical"] == other_hashes["canonical"]:
+        return "exact", 1.0
+    if (deal_hashes["notrump"] is not None
+            and deal_hashes["notrump"] == other_hashes["notrump"]):
+        return "suits", 1.0
+    if deal_hashes["spotless"] == other_hashes["spotless"]:
+        return "spots", 1.0
+
+    return "near", similarity(deal_hashes["sketch"], other_hashes["sketch"])
+
+def duplicates_query(deal_hashes):
+    """Return the Mongo filter of hands which may duplicate a hand."""
+
+    clauses = [
+        {"deal_hashes.canonical" : deal_hashes["canonical"]},
+        {"deal_hashes.spotless" : deal_hashes["spotless"]},
+        {"deal_hashes.bands" : {"$in" : deal_hashes["bands"]}},
+    ]
+    if deal_hashes["notrump"] is not None:
+        clauses.append({"deal_hashes.notrump" : deal_hashes["notrump"]})
+
+    return {"$or" : clauses}
+
+def may_duplicate(deal_hashes, other_hashes):
+    """Return True if two hands pass duplicates_query(), without Mongo."""
+
+    if deal_hashes["notrump"] is not None and (
+            other_hashes["notrump"] == deal_hashes["notrump"]):
+        return True
+
+    return (other_hashes["canonical"] == deal_hashes["canonical"]
+            or other_hashes["spotless"] == deal_hashes["spotless"]
+            or not set(other_hashes["bands"]).isdisjoint(deal_hashes["bands"]))
+
+def find_duplicates(hand_storage, hand_json, threshold=DEFAULT_THRESHOLD):
+    """
+    Return the stored hands which duplicate a hand, or nearly.
+
+    Parameters:
+        hand_storage (storage.Storage)
+        hand_json (json) the hand, with deal_hashes, e.g. before inserting it.
+        threshold (float) least similarity of a near duplicate.
+
+    Returns:
+        duplicates ((kind, similarity, hand_json) []) most similar first;
+        see match().
+    """
+
+    deal_hashes = hand_json["deal_hashes"]
+    if hand_storage.name == "mongo":
+        candidates = hand_storage.hands.find(duplicates_query(deal_hashes))
+    else:
+        # Hands without current hashes are not matched, as on Mongo; run
+        # "deal_hashing.py backfill" to hash them.
+        candidates = (other_json for other_json in hand_storage.iter_hands()
+                if not needs_deal_hashes(other_json)
+                and may_duplicate(deal_hashes, other_json["deal_hashes"]))
+
+    duplicates = []
+    for other_json in candidates:
+        if other_json["_id"] == hand_json.get("_id"):
+            continue
+        kind, score = match(deal_hashes, other_json["deal_hashes"])
+        if kind != "near" or score >= threshold:
+            duplicates.append((kind, score, other_json))
+
+    duplicates.sort(key=lambda duplicate: -duplicate[1])
+
+    return duplicates
+
+def dedupe_report(hand_jsons, threshold=DEFAULT_THRESHOLD):
+    """
+    Group hands which duplicate each other, or nearly.
+
+    Parameters:
+        hand_jsons (json iterable) e.g. hand_storage.iter_hands(); stored
+            deal hashes are used, and missing or old ones computed.
+        threshold (float) least similarity of near duplicates.
+
+    Returns:
+        report (dict) "hands", "failed", "pairs_compared", and "groups":
+        per group "kind" (the loosest match joining it, see match()),
+        "similarity" (the least of its matches), and its "hands", each
+        {"_id", "source", "question"}.
+
+    Hands sharing a canonical, notrump or spotless hash are grouped by
+    dictionary lookups; other hands are compared only when they share a
+    band.
+    """
+
+    hands = []
+    failed = 0
+    for hand_json in hand_jsons:
+        deal_hashes = hand_json.get("deal_hashes")
+        if needs_deal_hashes(hand_json):
+            try:
+                deal_hashes = compute_deal_hashes(hand_json)
+            except AssertionError as error:
+                print("{}: {}".format(hand_json["_id"], error))
+                failed += 1
+                continue
+        hands.append((hand_json, deal_hashes))
+
+    # Union-find over hand positions, remembering how each group was joined.
+    parents = list(range(len(hands)))
+    links = []
+
+    def find(position):
+        while parents[position] != position:
+            parents[position] = parents[parents[position]]
+            position = parents[position]
+        return position
+
+    def join(position, other_position, kind, score):
+        root, other_root = find(position), find(other_position)
+        if root != other_root:
+            parents[other_root] = root
+        links.append((position, kind, score))
+
+    # Same canonical, notrump or spotless hash.
+    for hash_name, kind in [("canonical", "exact"), ("notrump", "suits"),
+            ("spotless", "spots")]:
+        first_position = {}
+        for position, (_, deal_hashes) in enumerate(hands):
+            key = deal_hashes[hash_name]
+            if key is None:
+                continue
+            if key in first_position:
+                if find(first_position[key]) != find(position):
+                    join(first_position[key], position, kind, 1.0)
+            else:
+                first_position[key] = position
+
+    # Shared bands: candidates for near duplicates.
+    buckets = {}
+    for position, (_, deal_hashes) in enumerate(hands):
+        for band_key in deal_hashes["bands"]:
+            buckets.setdefault(band_key, []).append(position)
+
+    pairs_compared = 0
+    for positions in buckets.values():
+        if len(positions) > MAX_BUCKET_SIZE:
+            pairs = [(positions[0], other) for other in positions[1:]]
+        else:
+            pairs = [(position, other) for index, position in enumerate(positions)
+                    for other in positions[index + 1:]]
+        for position, other_position in pairs:
+            if find(position) == find(other_position):
+                continue
+            pairs_compared += 1
+            kind, score = match(hands[position][1], hands[other_position][1])
+            if score >= threshold:
+                join(position, other_position, kind, score)
+
+    # Collect the groups, with the loosest match in each.
+    kinds = ["exact", "suits", "spots", "near"]
+    groups = {}
+    for position, kind, score in links:
+        group = groups.setdefault(find(position), {"kind" : "exact",
+            "similarity" : 1.0})
+        group["kind"] = max(group["kind"], kind, key=kinds.index)
+        group["similarity"] = min(group["similarity"], score)
+    for position, (hand_json, _) in enumerate(hands):
+        group = groups.get(find(position))
+        if group is not None:
+            group.setdefault("hands", []).append({"_id" : str(hand_json["_id"]),
+                "source" : hand_json.get("source"),
+                "question" : (hand_json.get("question")
+                    or hand_json.get("context") or "")[:80]})
+
+    return {
+        "hands" : len(hands),
+        "failed" : failed,
+        "pairs_compared" : pairs_compared,
+        "groups" : sorted(groups.values(), key=lambda group: (kinds.index(group["kind"]),
+            -len(group["hands"]))),
+    }
+
+def _digest(value, digest_size=16):
+    """Return a hex hash of a JSON-serializable value."""
+
+    return hashlib.blake2b(json.dumps(value).encode(),
+            digest_size=digest_size).hexdigest()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["backfill", "report"])
+    parser.add_argument("--storage", choices=["mongo", "sqlite"], default=None,
+            help="backend, default BRIDGE_STORAGE")
+    parser.add_argument("--force", action="store_true",
+            help="backfill: recompute every hand's deal hashes")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+            help="report: least similarity of near duplicates")
+    parser.add_argument("--output", help="report: also write it to this JSON file")
+    args = parser.parse_args()
+
+    hand_storage = (storage.open_storage(args.storage) if args.storage
+            else storage.get_storage())
+
+    if args.command == "backfill":
+        print(json.dumps(backfill(hand_storage, args.force)))
+
+    else:
+        report = dedupe_report(hand_storage.iter_hands(), args.threshold)
+        for group in report["groups"]:
+            print("{} {:.2f}".format(group["kind"], group["similarity"]))
+            for hand in group["hands"]:
+                print("    {} {} {}".format(hand["_id"], hand["source"],
+                    json.dumps(hand["question"])))
+        print("{} hands, {} failed, {} groups, {} pairs compared".format(
+            report["hands"], report["failed"], len(report["groups"]),
+            report["pairs_compared"]))
+
+        if args.output:
+            with open(args.output, "w") as output_file:
+                json.dump(report, output_file, indent=2)
@@ -0,0 +1,913 @@
+"""
+Double-dummy solver, used to check a problem's correct answer when all four
+hands are visible.
+
+The search works on the bitboard masks of deal.py. A position is solved by
+a series of null-window searches ("can North-South take at least k more
+tricks?"), starting between bounds from the tricks each side surely wins,
+combined with:
+
+    * a transposition table of lower/upper trick bounds at trick
+      boundaries, each entry covering every position which differs only
+      in cards whose ranks did not matter (see DoubleDummySolver), kept
+      across the null-window probes and the leads solve_leads() solves,
+    * move ordering (win cheaply, second hand low, duck when partner is
+      winning, discard low), and the lead which last decided a position
+      tried first,
+    * equivalent-card pruning: cards in sequence, counting cards already
+      played as gone, are interchangeable, so only one of them is searched,
+    * cut-offs from the top winners the side on lead can cash, top trumps
+      and trump length, and suits whose top card the opponents hold.
+
+Limits: this search does not solve a full deal in under a second. Its
+search trees for a 13-trick deal hold 10^5 to a few 10^6 nodes, at about
+6 microseconds a node in CPython, so on the sample deals solve_deal()
+takes from half a second, mostly in notrump, to a quarter of a minute in
+a trump contract on a misfit, and solve_leads() a few times that.
+Endings of a few tricks solve at once. That suits checking one problem,
+not a whole database.
+
+For bulk checks pass engine="dds" to solve_deal() and solve_leads(),
+which solves with Bo Haglund's DDS library, through the optional endplay
+package (pip install endplay), in milliseconds a deal. It is never used
+unless asked for. benchmarks/double_dummy.py times the sample deals with
+either engine, and checks both against a plain minimax on small endings.
+
+Usage, from the command line:
+
+    python double_dummy.py --hand-id 5f0c... --trumps S --leader W
+    python double_dummy.py --json data/hands.json --index 3 --trumps N --leader W
+    python double_dummy.py --json data/hands.json --trumps H --leader W --engine dds
+"""
+import argparse
+import json
+from deal import Deal, SEATS, SUITS, SUIT_MASK, mask_to_hand_list
+
+try:
+    from endplay import dds as endplay_dds
+    from endplay import types as endplay_types
+except ImportError:
+    endplay_dds = None
+
+# Solvers solve_deal() and solve_leads() can use: the search of this
+# module, or DDS through endplay, see the module docstring.
+ENGINES = ["python", "dds"]
+
+# Trump arguments understood by the solver, e.g. "S" or "NT".
+NO_TRUMP = None
+TRUMP_STRINGS = {"S" : 0, "H" : 1, "D" : 2, "C" : 3, "N" : NO_TRUMP, "NT" : NO_TRUMP}
+
+def parse_trumps(trumps):
+    """
+    Parse a trump string to a suit index, or None for no trumps.
+
+    Parameters:
+        trumps (string) one of S H D C N NT (case insensitive).
+
+    Returns:
+        trump_suit (int or None) e.g. 0 for spades.
+    """
+
+    INVALID_TRUMPS_ERROR = "trumps must be one of {}".format(list(TRUMP_STRINGS))
+    assert trumps.upper() in TRUMP_STRINGS, INVALID_TRUMPS_ERROR
+
+    return TRUMP_STRINGS[trumps.upper()]
+
+def _bit_suit(bit):
+    """Return the suit index of a single-bit card mask."""
+
+    return (bit.bit_length() - 1) // 13
+
+def _high_bit(mask):
+    """Return the highest set bit of a non-zero mask."""
+
+    return 1 << (mask.bit_length() - 1)
+
+def _suit_representatives(holding, live):
+    """
+    Return one card from each run of equivalent cards in a suit holding.
+
+    Parameters:
+        holding (int) the player's cards in one suit, as a 52-bit mask.
+        live (int) every card of that suit still in play (in any hand or in
+            the current trick), a superset of holding.
+
+    Returns:
+        representatives (int []) the lowest card of each run, as single-bit
+            masks, high to low.
+
+    Two cards are equivalent when every live card ranked between them is
+    also held by the player, e.g. with the Q played, KJ are a sequence.
+    """
+
+    representatives = []
+    previous = 0
+    remaining = holding
+    while remaining:
+        card = _high_bit(remaining)
+        remaining ^= card
+        # Live cards strictly between this card and the previous one.
+        between = live & (previous - 1) & ~((card << 1) - 1)
+        if previous and not between & ~holding:
+            # Same run: keep the lowest card as the representative.
+            representatives[-1] = card
+        else:
+            representatives.append(card)
+        previous = card
+
+    return representatives
+
+class DoubleDummySolver(object):
+    """
+    Solve a position for the number of tricks North-South can take.
+
+    Each search answers one question, "can North-South take at least
+    target more tricks?", and returns with its answer the cards whose
+    ranks decided it, e.g. the ace which won a trick by rank; the cards
+    below the lowest of those in each suit acted only as small cards.
+    The transposition table stores each answer at trick boundaries for
+    every position sharing the suit lengths of each hand and the holders
+    of the deciding cards and those above them (partition search), so one
+    entry covers many positions.
+
+    The table is kept between calls, so solving every opening lead of a
+    deal reuses the work of earlier leads.
+    """
+
+    def __init__(self, hands, trump_suit):
+        """
+        Parameters:
+            hands (int []) four masks in the order N E S W, all holding the
+                same number of cards.
+            trump_suit (int or None) suit index, or None for no trumps.
+        """
+
+        lengths = set(bin(mask).count("1") for mask in hands)
+        UNEQUAL_HANDS_ERROR = "all four hands must hold the same number of cards"
+        assert len(lengths) == 1, UNEQUAL_HANDS_ERROR
+
+        self.hands = list(hands)
+        self.trump_suit = trump_suit
+        self.trump_mask = (0 if trump_suit is None
+                else SUIT_MASK << (13*trump_suit))
+        self.suit_masks = [SUIT_MASK << (13*suit_index) for suit_index in range(4)]
+
+        # (leader, suit lengths of every hand) -> entries, each the holders
+        # of the deciding cards of every suit and bounds on North-South
+        # tricks, see _store().
+        self.transposition_table = {}
+        # (leader, suit codes) -> suit of the lead which last decided the
+        # position, tried first when it is searched again.
+        self._best_leads = {}
+        self._suit_codes = {}
+        self._representatives = {}
+        self.nodes = 0
+
+    def solve(self, leader, guess=None):
+        """
+        Return the number of tricks North-South take with best play.
+
+        Parameters:
+            leader (int) seat index (0=N, 1=E, 2=S, 3=W) of the player on lead.
+            guess (int) optional, an estimate of the result; the search
+                starts there and steps towards the result.
+        """
+
+        low, high = self._sure_trick_bounds(leader)
+        return self._probe_tricks(lambda target: self._search_trick(leader, target)[0],
+                low, high, guess)
+
+    def solve_lead(self, leader, card, guess=None):
+        """
+        Return the number of tricks North-South take after leader leads card.
+
+        Parameters:
+            leader (int) seat index of the player on lead.
+            card (int) single-bit mask of a card held by leader.
+            guess (int) optional, an estimate of the result, e.g. the result
+                of another lead.
+        """
+
+        CARD_NOT_HELD_ERROR = "the leader does not hold this card"
+        assert self.hands[leader] & card, CARD_NOT_HELD_ERROR
+
+        tricks_left = bin(self.hands[0]).count("1")
+        led_mask = self.suit_masks[_bit_suit(card)]
+        self.hands[leader] ^= card
+        try:
+            tricks = self._probe_tricks(lambda target: self._search_card(leader,
+                led_mask, card, leader, card, 1, target)[0], 0, tricks_left, guess)
+        finally:
+            self.hands[leader] ^= card
+
+        return tricks
+
+    def _probe_tricks(self, can_take, low, high, guess=None):
+        """
+        Return the trick count, between low and high, from null-window
+        results: stepping from guess if given, as it is usually within a
+        trick of the result, otherwise bisecting.
+        """
+
+        while low < high:
+            if guess is None:
+                target = (low + high + 1) // 2
+            else:
+                target = min(max(guess, low + 1), high)
+            if can_take(target):
+                low = target
+                guess = None if guess is None else target + 1
+            else:
+                high = target - 1
+                guess = None if guess is None else target - 1
+
+        return low
+
+    def _sure_trick_bounds(self, leader):
+        """Return (low, high) bounds on North-South tricks from the cards
+        each side surely wins, see _quick_tricks() and _top_trumps()."""
+
+        tricks_left = bin(self.hands[leader]).count("1")
+        live = self.hands[0] | self.hands[1] | self.hands[2] | self.hands[3]
+        quick_tricks = self._quick_tricks(leader, live)[0]
+        top_trumps, top_trump_side, _ = self._top_trumps(live)
+
+        low, high = 0, tricks_left
+        if leader % 2 == 0:
+            low = quick_tricks
+        else:
+            high = tricks_left - quick_tricks
+        if top_trump_side == 0:
+            low = max(low, top_trumps)
+        elif top_trump_side == 1:
+            high = min(high, tricks_left - top_trumps)
+
+        return low, high
+
+    def _quick_tricks(self, leader, live):
+        """
+        Count top winners the leader's side can cash without losing the
+        lead: either the leader's own winners, or partner's winners in a
+        suit the leader can cross to with a low card. A side suit winner
+        is counted only while each opponent holding trumps still follows.
+
+        Returns:
+            (quick_tricks, ranks) the count, and the lowest winner counted
+            in each suit.
+        """
+
+        hands = self.hands
+        holding = hands[leader]
+        partner_holding = hands[(leader + 2) % 4]
+        left_holding = hands[(leader + 1) % 4]
+        right_holding = hands[(leader + 3) % 4]
+        trump_mask = self.trump_mask
+        left_trumps = left_holding & trump_mask
+        right_trumps = right_holding & trump_mask
+
+        own_tricks = own_ranks = 0
+        crossing_tricks = crossing_ranks = 0
+        for suit_mask in self.suit_masks:
+            holding_in_suit = holding & suit_mask
+            if not holding_in_suit:
+                continue
+
+            # Rounds before an opponent may ruff.
+            safe_rounds = 13
+            if not suit_mask & trump_mask:
+                if left_trumps:
+                    safe_rounds = bin(left_holding & suit_mask).count("1")
+                if right_trumps:
+                    safe_rounds = min(safe_rounds,
+                            bin(right_holding & suit_mask).count("1"))
+                if not safe_rounds:
+                    continue
+
+            live_in_suit = live & suit_mask
+            top = _high_bit(live_in_suit)
+            winner_holding = (holding_in_suit if top & holding
+                    else partner_holding & suit_mask if top & partner_holding else 0)
+            if not winner_holding:
+                continue
+
+            # Consecutive top cards in one hand.
+            count = 0
+            card = top
+            while count < safe_rounds and card & winner_holding:
+                count += 1
+                lowest = card
+                live_in_suit ^= card
+                if not live_in_suit:
+                    break
+                card = _high_bit(live_in_suit)
+
+            # The leader keeps the lead with their own winners; partner's
+            # are reached in one suit only.
+            if winner_holding is holding_in_suit:
+                own_tricks += count
+                own_ranks |= lowest
+            elif count > crossing_tricks:
+                crossing_tricks, crossing_ranks = count, lowest
+
+        if own_tricks >= crossing_tricks:
+            return own_tricks, own_ranks
+        return crossing_tricks, crossing_ranks
+
+    def _top_trumps(self, live):
+        """
+        Count the top trumps held in one hand, each of which wins a trick
+        whenever it is played, or, if one side holds every trump, the
+        length of its longer trump hand, if that is more.
+
+        Returns:
+            (count, side, ranks) side 0 for North-South, 1 for East-West,
+            None if there are no trumps left; ranks the lowest top trump
+            counted, or 0 for a count from lengths.
+        """
+
+        live_trumps = live & self.trump_mask
+        if not live_trumps:
+            return 0, None, 0
+
+        hands = self.hands
+        trump_mask = self.trump_mask
+        top = _high_bit(live_trumps)
+        seat = 0
+        while not hands[seat] & top:
+            seat += 1
+        side = seat % 2
+
+        # A side holding every trump wins a trick with each trump of its
+        # longer trump hand, whatever the ranks.
+        if not (hands[side + 1] | hands[(side + 3) % 4]) & trump_mask:
+            length = max(bin(hands[side] & trump_mask).count("1"),
+                    bin(hands[side + 2] & trump_mask).count("1"))
+        else:
+            length = 0
+
+        count = 0
+        card = top
+        while card & hands[seat]:
+            count += 1
+            lowest = card
+            live_trumps ^= card
+            if not live_trumps:
+                break
+            card = _high_bit(live_trumps)
+
+        if length >= count:
+            return length, side, 0
+        return count, side, lowest
+
+    def _opponents_win_trick(self, leader, live):
+        """
+        Return (True, ranks) if the opponents can win the next trick
+        whatever is led: in every suit the leader holds, an opponent holds
+        the top card and partner cannot ruff it. ranks are those top cards.
+        """
+
+        hands = self.hands
+        holding = hands[leader]
+        partner_holding = hands[(leader + 2) % 4]
+        opponents_holding = hands[(leader + 1) % 4] | hands[(leader + 3) % 4]
+        partner_trumps = partner_holding & self.trump_mask
+
+        ranks = 0
+        for suit_mask in self.suit_masks:
+            if not holding & suit_mask:
+                continue
+            top = _high_bit(live & suit_mask)
+            if not top & opponents_holding:
+                return False, 0
+            if partner_trumps and not partner_holding & suit_mask:
+                return False, 0
+            ranks |= top
+
+        return True, ranks
+
+    def _suit_descriptions(self):
+        """
+        Return, per suit, (code, live cards, lengths): the seats holding
+        its live cards from the top down, as base-4 digits after a leading
+        1, the number of live cards, and each seat's length in 4 bits.
+
+        Cards are replaced by their rank among the cards still in play, so
+        positions that differ only in which spot cards are gone share a
+        code.
+        """
+
+        h0, h1, h2, h3 = self.hands
+        suit_codes = self._suit_codes
+        descriptions = []
+        for suit_mask, shift in zip(self.suit_masks, (0, 13, 26, 39)):
+            # The four holdings of the suit, as one key.
+            key = (h0 & suit_mask) | (h1 & suit_mask) << 52 \
+                    | (h2 & suit_mask) << 104 | (h3 & suit_mask) << 156
+            description = suit_codes.get(key)
+            if description is None:
+                holdings = ((h0 >> shift) & SUIT_MASK, (h1 >> shift) & SUIT_MASK,
+                        (h2 >> shift) & SUIT_MASK, (h3 >> shift) & SUIT_MASK)
+                code = 1 # sentinel marking the length of the sequence.
+                n_live = lengths = 0
+                for rank_index in range(12, -1, -1):
+                    bit = 1 << rank_index
+                    for seat in range(4):
+                        if holdings[seat] & bit:
+                            code = code*4 + seat
+                            n_live += 1
+                for seat in range(4):
+                    lengths |= bin(holdings[seat]).count("1") << (4*seat)
+                description = suit_codes[key] = (code, n_live, lengths)
+            descriptions.append(description)
+
+        return descriptions
+
+    def _search_trick(self, leader, target):
+        """
+        Search a position at a trick boundary, leader to lead.
+
+        Returns:
+            (result, ranks) whether North-South can take at least target of
+            the remaining tricks, and a mask of the cards whose ranks
+            decided it.
+        """
+
+        hands = self.hands
+        tricks_left = bin(hands[leader]).count("1")
+        if target <= 0:
+            return True, 0
+        if target > tricks_left:
+            return False, 0
+        self.nodes += 1
+        live = hands[0] | hands[1] | hands[2] | hands[3]
+
+        # Look up bounds stored for a position matching this one.
+        descriptions = self._suit_descriptions()
+        (code0, _, lengths0), (code1, _, lengths1), (code2, _, lengths2), \
+                (code3, _, lengths3) = descriptions
+        bucket_key = (leader, lengths0, lengths1, lengths2, lengths3)
+        bucket = self.transposition_table.get(bucket_key)
+        if bucket is not None:
+            for entry in bucket:
+                if (code0 >> entry[0] == entry[1] and code1 >> entry[2] == entry[3]
+                        and code2 >> entry[4] == entry[5]
+                        and code3 >> entry[6] == entry[7]):
+                    if entry[8] >= target:
+                        return True, self._entry_ranks(entry, live)
+                    if entry[9] < target:
+                        return False, self._entry_ranks(entry, live)
+
+        # The last trick plays itself.
+        if tricks_left == 1:
+            led_mask = self.suit_masks[_bit_suit(hands[leader])]
+            winner, winning_card = leader, hands[leader]
+            for position in (1, 2, 3):
+                seat = (leader + position) % 4
+                if self._beats(hands[seat], winning_card, led_mask):
+                    winner, winning_card = seat, hands[seat]
+            ranks = winning_card if ((live ^ winning_card)
+                    & self.suit_masks[_bit_suit(winning_card)]) else 0
+            return (winner % 2 == 0) >= target, ranks
+
+        # Cards each side surely wins bound the result.
+        quick_tricks, ranks = self._quick_tricks(leader, live)
+        if leader % 2 == 0:
+            if quick_tricks >= target:
+                return True, ranks
+        elif tricks_left - quick_tricks < target:
+            return False, ranks
+        top_trumps, top_trump_side, ranks = self._top_trumps(live)
+        if top_trump_side == 0:
+            if top_trumps >= target:
+                return True, ranks
+        elif top_trump_side == 1 and tricks_left - top_trumps < target:
+            return False, ranks
+        lost_trick, ranks = self._opponents_win_trick(leader, live)
+        if lost_trick:
+            if leader % 2 == 0:
+                if tricks_left - 1 < target:
+                    return False, ranks
+            elif target <= 1:
+                return True, ranks
+
+        # Search the leads, the one which last decided this position first.
+        maximizing = leader % 2 == 0
+        position_key = (leader, code0, code1, code2, code3)
+        all_ranks = 0
+        for card in self._lead_moves(leader, live, self._best_leads.get(position_key)):
+            led_mask = self.suit_masks[_bit_suit(card)]
+            hands[leader] ^= card
+            result, ranks = self._search_card(leader, led_mask, card, leader, card,
+                    1, target)
+            hands[leader] ^= card
+
+            if result == maximizing:
+                self._best_leads[position_key] = led_mask
+                self._store(bucket_key, descriptions, live, ranks, target, result,
+                        tricks_left)
+                return result, ranks
+            all_ranks |= ranks
+
+        self._store(bucket_key, descriptions, live, all_ranks, target, not maximizing,
+                tricks_left)
+        return not maximizing, all_ranks
+
+    def _search_card(self, leader, led_mask, trick_cards, winner, winning_card,
+            position, target):
+        """
+        Search a position within a trick, with the player at position in
+        the trick to play.
+
+        Parameters:
+            leader (int) seat index of the player who led to this trick.
+            led_mask (int) mask of the suit led.
+            trick_cards (int) mask of the cards played to this trick so far.
+            winner, winning_card (int) the seat winning the trick so far,
+                and its card.
+            position (int) 1-3, the number of cards played to this trick.
+            target (int) North-South tricks required, counting this trick.
+
+        Returns:
+            (result, ranks) as for _search_trick().
+        """
+
+        self.nodes += 1
+        hands = self.hands
+        seat = (leader + position) % 4
+        maximizing = seat % 2 == 0
+
+        trump_mask = self.trump_mask
+        all_ranks = 0
+        for card in self._follow_moves(seat, led_mask, trick_cards, winner,
+                winning_card, position):
+            # _beats(), inlined.
+            if (card & trump_mask and (not winning_card & trump_mask
+                    or card > winning_card)) or (card & led_mask
+                    and card > winning_card and not winning_card & trump_mask):
+                next_winner, next_winning_card = seat, card
+            else:
+                next_winner, next_winning_card = winner, winning_card
+
+            hands[seat] ^= card
+            if position == 3:
+                # The winning card's rank decided the trick if another
+                # card of its suit was played.
+                won_by_rank = ((trick_cards | card) & ~next_winning_card
+                        & self.suit_masks[_bit_suit(next_winning_card)])
+                result, ranks = self._search_trick(next_winner,
+                        target - 1 if next_winner % 2 == 0 else target)
+                if won_by_rank:
+                    ranks |= next_winning_card
+            else:
+                result, ranks = self._search_card(leader, led_mask, trick_cards | card,
+                        next_winner, next_winning_card, position + 1, target)
+            hands[seat] ^= card
+
+            if result == maximizing:
+                return result, ranks
+            all_ranks |= ranks
+
+        return not maximizing, all_ranks
+
+    def _beats(self, card, winning_card, led_mask):
+        """Return True if card beats winning_card, the best card so far of
+        a trick to which led_mask was led."""
+
+        if card & self.trump_mask:
+            return not winning_card & self.trump_mask or card > winning_card
+        return (card & led_mask and card > winning_card
+                and not winning_card & self.trump_mask)
+
+    def _store(self, bucket_key, descriptions, live, ranks, target, result,
+            tricks_left):
+        """
+        Store the result of a search at a trick boundary.
+
+        The entry matches every position, with the same leader and suit
+        lengths, whose live cards from the top down to the lowest card of
+        ranks in each suit are held by the same seats. Per suit it keeps a
+        shift and the code of the position shifted by it: the top of the
+        code, covering those cards.
+        """
+
+        entry = []
+        for suit_index, (code, n_live, _) in enumerate(descriptions):
+            suit_ranks = (ranks >> (13*suit_index)) & SUIT_MASK
+            if suit_ranks:
+                lowest = suit_ranks & -suit_ranks
+                live_in_suit = (live >> (13*suit_index)) & SUIT_MASK
+                n_covered = bin(live_in_suit & ~(lowest - 1)).count("1")
+            else:
+                n_covered = 0
+            shift = 2*(n_live - n_covered)
+            entry += [shift, code >> shift]
+
+        low, high = (target, tricks_left) if result else (0, target - 1)
+        bucket = self.transposition_table.setdefault(bucket_key, [])
+        for other in bucket:
+            if other[:8] == entry:
+                other[8] = max(other[8], low)
+                other[9] = min(other[9], high)
+                return None
+        bucket.append(entry + [low, high])
+
+        return None
+
+    def _entry_ranks(self, entry, live):
+        """Return the cards of the current position an entry covers, as the
+        lowest covered card of each suit."""
+
+        ranks = 0
+        for suit_index in range(4):
+            live_in_suit = (live >> (13*suit_index)) & SUIT_MASK
+            # Skip the live cards below the entry's cards.
+            for _ in range(entry[2*suit_index] // 2):
+                live_in_suit &= live_in_suit - 1
+            ranks |= (live_in_suit & -live_in_suit) << (13*suit_index)
+
+        return ranks
+
+    def _representatives_of(self, holding_in_suit, live_in_suit):
+        """_suit_representatives(), cached, high to low."""
+
+        key = (holding_in_suit, live_in_suit)
+        representatives = self._representatives.get(key)
+        if representatives is None:
+            representatives = self._representatives[key] = tuple(
+                    _suit_representatives(holding_in_suit, live_in_suit))
+
+        return representatives
+
+    def _lead_moves(self, seat, live, best_suit):
+        """
+        Return the leads worth searching, best guesses first: the suit of
+        best_suit (a suit mask, or None), then winners, then low towards
+        partner's winners, then low from the longest other suit.
+        """
+
+        holding = self.hands[seat]
+        partner_holding = self.hands[(seat + 2) % 4]
+        first, winners, to_partner, others = [], [], [], []
+        for suit_mask in self.suit_masks:
+            holding_in_suit = holding & suit_mask
+            if not holding_in_suit:
+                continue
+            live_in_suit = live & suit_mask
+            cards = self._representatives_of(holding_in_suit, live_in_suit)
+            top = _high_bit(live_in_suit)
+            if top & holding_in_suit:
+                moves = list(cards)
+            else:
+                moves = list(reversed(cards))
+            if suit_mask == best_suit:
+                first = moves
+            elif top & holding_in_suit:
+                winners += moves
+            elif top & partner_holding:
+                to_partner += moves
+            else:
+                others.append((-bin(holding_in_suit).count("1"), moves))
+
+        others.sort()
+        for length, moves in others:
+            to_partner += moves
+
+        return first + winners + to_partner
+
+    def _follow_moves(self, seat, led_mask, trick_cards, winner, winning_card,
+            position):
+        """
+        Return the cards worth searching for seat, best guesses first, with
+        equivalent cards removed: second hand plays low, third and fourth
+        hand win as cheaply as possible, everyone plays low under partner,
+        and a player void in the suit ruffs as cheaply as possible when
+        that wins the trick, else discards low from the longest suit.
+        """
+
+        hands = self.hands
+        holding = hands[seat]
+        live = hands[0] | hands[1] | hands[2] | hands[3] | trick_cards
+        trump_mask = self.trump_mask
+        partner_winning = winner == (seat + 2) % 4
+
+        holding_in_suit = holding & led_mask
+        if holding_in_suit:
+            cards = self._representatives_of(holding_in_suit, live & led_mask)[::-1]
+            if partner_winning or winning_card & trump_mask & ~led_mask:
+                return cards
+            if position == 1:
+                # Second hand plays low, unless it can win the trick
+                # against every card of the hands to come, and fourth hand
+                # (partner) cannot.
+                third_holding = hands[(seat + 1) % 4]
+                fourth_holding = hands[(seat + 2) % 4]
+                if (third_holding & led_mask or not third_holding & trump_mask) \
+                        and not fourth_holding & _high_bit(live & led_mask):
+                    third_top = third_holding & led_mask
+                    third_top = _high_bit(third_top) if third_top else 0
+                    winning = [card for card in cards
+                            if card > winning_card and card > third_top]
+                    if winning:
+                        return [winning[0]] + [card for card in cards
+                                if card != winning[0]]
+                return cards
+            beating = [card for card in cards if card > winning_card]
+            ducking = [card for card in cards if card < winning_card]
+            return beating + ducking
+
+        ruffs, discards = [], []
+        for suit_mask in self.suit_masks:
+            holding_in_suit = holding & suit_mask
+            if not holding_in_suit:
+                continue
+            cards = self._representatives_of(holding_in_suit, live & suit_mask)[::-1]
+            if suit_mask & trump_mask and not partner_winning:
+                for card in cards:
+                    if not winning_card & trump_mask or card > winning_card:
+                        ruffs.append(card)
+                    else:
+                        discards.append((0, card))
+            else:
+                length = bin(holding_in_suit).count("1")
+                discards += [(-length, card) for card in cards]
+
+        discards.sort()
+        return ruffs + [card for length, card in discards]
+
+def _card_string(card):
+    """Return the card string of a single-bit mask, e.g. "SA"."""
+
+    return mask_to_hand_list(card)[0]
+
+def use_dds(engine="python"):
+    """Return True if engine, one of ENGINES, means solving with DDS."""
+
+    UNKNOWN_ENGINE_ERROR = "engine must be one of {}".format(ENGINES)
+    assert engine in ENGINES, UNKNOWN_ENGINE_ERROR
+    NO_DDS_ERROR = "the dds engine needs the endplay package: pip install endplay"
+    assert engine != "dds" or endplay_dds is not None, NO_DDS_ERROR
+
+    return engine == "dds"
+
+def dds_solve_leads(deal, trumps, leader):
+    """solve_leads() with DDS, through endplay."""
+
+    parse_trumps(trumps)
+    # DDS rejects a deal without cards, writing dump.txt.
+    if not deal.hand(leader):
+        return {}
+
+    board = endplay_types.Deal(deal.to_pbn())
+    board.first = endplay_types.Player.find(leader)
+    board.trump = endplay_types.Denom.find(trumps)
+    tricks_by_dds_card = {SUITS[card.suit] + card.rank.abbr : tricks
+            for card, tricks in endplay_dds.solve_board(board)}
+
+    return {card : tricks_by_dds_card[card]
+            for card in mask_to_hand_list(deal.hand(leader))}
+
+def solve_deal(deal, trumps, leader, engine="python"):
+    """
+    Return the tricks the side on lead takes with best play.
+
+    Parameters:
+        deal (deal.Deal) four complete hands.
+        trumps (string) S H D C or N/NT.
+        leader (string) seat on lead: N E S or W.
+        engine (string) one of ENGINES.
+
+    Returns:
+        tricks (int) tricks for the side on lead.
+    """
+
+    if use_dds(engine):
+        return max(dds_solve_leads(deal, trumps, leader).values(), default=0)
+
+    leader_index = SEATS.index(leader)
+    solver = DoubleDummySolver(deal.masks, parse_trumps(trumps))
+    ns_tricks = solver.solve(leader_index)
+    tricks_left = bin(deal.masks[0]).count("1")
+
+    return ns_tricks if leader_index % 2 == 0 else tricks_left - ns_tricks
+
+def solve_leads(deal, trumps, leader, engine="python"):
+    """
+    Return the tricks the side on lead takes after each card the leader
+    could lead.
+
+    Parameters:
+        deal (deal.Deal) four complete hands.
+        trumps (string) S H D C or N/NT.
+        leader (string) seat on lead: N E S or W.
+        engine (string) one of ENGINES.
+
+    Returns:
+        tricks_by_card (dict) card string -> tricks for the side on lead,
+        e.g. {"SA" : 5, "SK" : 5, ...}, in the order of the leader's hand.
+    """
+
+    if use_dds(engine):
+        return dds_solve_leads(deal, trumps, leader)
+
+    leader_index = SEATS.index(leader)
+    solver = DoubleDummySolver(deal.masks, parse_trumps(trumps))
+    tricks_left = bin(deal.masks[0]).count("1")
+    holding = deal.masks[leader_index]
+
+    # Solve one card per run of equivalent cards, and copy its result to
+    # the rest of the run.
+    tricks_by_card = {}
+    ns_tricks = None
+    for suit_mask in solver.suit_masks:
+        holding_in_suit = holding & suit_mask
+        if not holding_in_suit:
+            continue
+        representatives = _suit_representatives(holding_in_suit, holding_in_suit
+                | ((deal.masks[0] | deal.masks[1] | deal.masks[2] | deal.masks[3]) & suit_mask))
+        # Runs are contiguous from the top, each ending with its
+        # representative.
+        run = []
+        remaining = holding_in_suit
+        while remaining:
+            card = _high_bit(remaining)
+            remaining ^= card
+            run.append(card)
+            if card in representatives:
+                # Leads mostly differ by a trick or so, so the last result
+                # is a good first guess.
+                ns_tricks = solver.solve_lead(leader_index, card, ns_tricks)
+                tricks = (ns_tricks if leader_index % 2 == 0
+                        else tricks_left - ns_tricks)
+                for run_card in run:
+                    tricks_by_card[_card_string(run_card)] = tricks
+                run = []
+
+    return tricks_by_card
+
+def load_hand(hand_id=None, json_path=None, index=None):
+    """
+    Load one hand document, either by _id from the configured storage
+    backend (see storage.py) or by position from a JSON backup such as
+    data/hands.json.
+    """
+
+    if json_path is not None:
+        with open(json_path) as f:
+            hands = json.load(f)
+        return hands[index]
+
+    import bson
+    import storage
+    hand_json = storage.get_storage().get_hand(bson.objectid.ObjectId(hand_id))
+
+    INVALID_HAND_ID_ERROR = "hand id does not exist"
+    assert hand_json is not None, INVALID_HAND_ID_ERROR
+
+    return hand_json
+
+def main():
+    """Print the double-dummy result of every lead for one stored hand."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--hand-id", help="_id of a hand in the hands collection")
+    parser.add_argument("--json", help="read hands from a JSON file instead")
+    parser.add_argument("--index", type=int, default=0,
+            help="position of the hand in the JSON file")
+    parser.add_argument("--trumps", required=True, help="S H D C or NT")
+    parser.add_argument("--leader", required=True, help="seat on lead: N E S W")
+    parser.add_argument("--engine", choices=ENGINES, default="python",
+            help="solver; dds needs endplay, see the module docstring")
+    args = parser.parse_args()
+
+    hand_json = load_hand(hand_id=args.hand_id, json_path=args.json,
+            index=args.index)
+    deal = Deal.from_hand_json(hand_json)
+    deal.validate()
+    leader = args.leader.upper()
+
+    print(deal.to_pbn())
+    print("Trumps: {} Leader: {}".format(args.trumps.upper(), leader))
+    tricks_by_card = solve_leads(deal, args.trumps, leader, args.engine)
+    best = max(tricks_by_card.values())
+    for card, tricks in tricks_by_card.items():
+        marker = "*" if tricks == best else " "
+        print("{} {}  {:2d} tricks for the side on lead".format(marker, card, tricks))
+
+    # Check the stored answer against the solver: a card, or a suit,
+    # which is best if its best card is.
+    correct_answer = hand_json.get("correct_answer", "").upper()
+    if correct_answer in tricks_by_card:
+        answer_tricks = tricks_by_card[correct_answer]
+    elif len(correct_answer) == 1 and correct_answer in "SHDC":
+        answer_tricks = max([tricks for card, tricks in tricks_by_card.items()
+            if card[0] == correct_answer], default=None)
+    else:
+        print("Stored correct answer {} is not a card or suit, so was not "
+                "checked.".format(correct_answer))
+        return None
+    verdict = "best" if answer_tricks == best else "NOT best"
+    print("Stored correct answer {} is {} double dummy.".format(
+        correct_answer, verdict))
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 def get_new_elos(old_player_elo, old_hand_elo, user_was_correct, K=30):
     """
@@ -15,7 +16,8 @@ def get_new_elos(old_player_elo, old_hand_elo, user_was_correct, K=30):
     """
 
     # Calculate expected win probabilities for the player and hand.
-    player_win_probability = 1.0 * 1.0 / (1 + 1.0 * math.pow(10, 1.0 * (old_player_elo - old_hand_elo) / 400)) 
+    # A player rated above the hand is expected to be correct.
+    player_win_probability = 1.0 * 1.0 / (1 + 1.0 * math.pow(10, 1.0 * (old_hand_elo - old_player_elo) / 400)) 
     hand_win_probability = (1 - player_win_probability)
 
     # Calculate (outcome - expected) for the player and hand.
@@ -30,3 +32,27 @@ def get_new_elos(old_player_elo, old_hand_elo, user_was_correct, K=30):
     new_hand_elo = old_hand_elo + K*(hand_outcome_minus_expected)
 
     return (new_player_elo, new_hand_elo)
+
+def get_new_elos_array(old_player_elos, old_hand_elos, user_was_correct, K=30):
+    """
+    Vectorized get_new_elos(), for many player-hand pairs at once.
+
+    parameters:
+        old_player_elos (float np.ndarray) shape (n,)
+        old_hand_elos (float np.ndarray) shape (n,)
+        user_was_correct (bool np.ndarray) shape (n,)
+        K: scaling factor (default 30).
+    return tuple of:
+        new_player_elos (float np.ndarray) shape (n,)
+        new_hand_elos (float np.ndarray) shape (n,)
+    """
+
+    # Same update as get_new_elos(), one element per pair.
+    player_win_probability = 1.0 / (1 + np.power(10.0, (old_hand_elos - old_player_elos) / 400))
+    hand_win_probability = 1 - player_win_probability
+
+    outcomes = np.asarray(user_was_correct, dtype=np.float64)
+    new_player_elos = old_player_elos + K*(outcomes - player_win_probability)
+    new_hand_elos = old_hand_elos + K*((1 - outcomes) - hand_win_probability)
+
+    return (new_player_elos, new_hand_elos)
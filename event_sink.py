@@ -0,0 +1,284 @@
+"""
+Buffered, background writer for events.
+
+Logging an event used to cost one insert_one round trip per page view.
+EventSink queues event records in memory and a worker thread writes them
+with one insert_events call (see storage.py) when max_batch records are
+waiting, or flush_interval seconds after the first one was queued,
+whichever comes first. The queue is flushed when the process exits.
+
+Each record gets its _id when queued, and the storage backends skip
+records already stored, so writing a batch twice is harmless. That makes
+retries safe: with a spool file configured, a batch which cannot be
+written (e.g. Mongo is down) is appended to the file as JSON lines, and
+re-inserted after the next successful write, or when the process starts
+again.
+
+Settings for the process-wide sink are read from environment variables:
+    BRIDGE_EVENT_BATCH_SIZE      default 100
+    BRIDGE_EVENT_FLUSH_INTERVAL  default 1.0 (seconds)
+    BRIDGE_EVENT_SPOOL           default none, e.g. events_spool.jsonl
+"""
+import atexit
+import logging
+import os
+import threading
+import bson
+from bson import json_util
+import storage
+
+logger = logging.getLogger(__name__)
+
+_event_sink = None
+_event_sink_lock = threading.Lock()
+
+class EventSink(object):
+    """
+    Queue of event records, written to storage in batches by a worker thread.
+
+    Counters (see stats()):
+        queued             records passed to put()
+        written            records inserted into storage
+        batches            insert_events calls which succeeded
+        failures           insert_events calls which failed; their records
+                           were spooled or dropped
+        spooled            records appended to the spool file
+        replayed           spooled records inserted into storage
+        dropped            records lost: write failed and no spool file
+        worker_errors      unexpected errors the worker thread logged and
+                           survived
+    """
+
+    def __init__(self, event_storage, max_batch=100, flush_interval=1.0,
+            spool_path=None):
+        """
+        Parameters:
+            event_storage (storage.Storage)
+            max_batch (int) records queued before the worker writes at once.
+            flush_interval (float) seconds a record may wait to be written.
+            spool_path (string) optional, append-only JSON lines file for
+                records which could not be written.
+        """
+
+        self.event_storage = event_storage
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+
+        self._buffer = []
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock() # keeps batches in order.
+        self._closed = False
+
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.worker_errors = 0
+
+        # Re-insert records spooled by an earlier run before new ones.
+        self._spool_pending = bool(spool_path and os.path.exists(spool_path)
+                and os.path.getsize(spool_path) > 0)
+
+        self._worker = threading.Thread(target=self._run, name="event-sink",
+                daemon=True)
+        self._worker.start()
+
+    def put(self, event_record):
+        """
+        Queue an event record, returning immediately.
+
+        An _id is added to event_record if it has none.
+        """
+
+        if "_id" not in event_record:
+            event_record["_id"] = bson.ObjectId()
+
+        with self._condition:
+            CLOSED_ERROR = "the event sink is closed"
+            assert not self._closed, CLOSED_ERROR
+
+            self._buffer.append(event_record)
+            self.queued += 1
+
+            # Wake the worker to start the flush interval, or to write a
+            # full batch now.
+            if len(self._buffer) == 1 or len(self._buffer) >= self.max_batch:
+                self._condition.notify()
+
+        return None
+
+    def flush(self):
+        """Write every queued record now, in the calling thread."""
+
+        self._write_pending()
+
+        return None
+
+    def close(self):
+        """Write every queued record and stop the worker thread."""
+
+        with self._condition:
+            if self._closed:
+                return None
+            self._closed = True
+            self._condition.notify()
+
+        self._worker.join()
+        self._write_pending()
+
+        return None
+
+    def stats(self):
+        """Return the counters and the number of records waiting, as a dict."""
+
+        with self._condition:
+            return {
+                "queued" : self.queued,
+                "written" : self.written,
+                "batches" : self.batches,
+                "failures" : self.failures,
+                "spooled" : self.spooled,
+                "replayed" : self.replayed,
+                "dropped" : self.dropped,
+                "worker_errors" : self.worker_errors,
+                "pending" : len(self._buffer),
+            }
+
+    def _run(self):
+        """Worker thread: write batches on the size or time threshold."""
+
+        while True:
+            with self._condition:
+                # Sleep until a record arrives.
+                if not self._buffer and not self._closed:
+                    self._condition.wait()
+
+                # Give the batch up to flush_interval to fill.
+                if (self._buffer and len(self._buffer) < self.max_batch
+                        and not self._closed):
+                    self._condition.wait(self.flush_interval)
+
+                closed = self._closed
+
+            # Any other error, e.g. a bug in a storage driver, is logged
+            # rather than stopping the thread, which would leave every
+            # later record unwritten.
+            try:
+                self._write_pending()
+            except Exception:
+                logger.exception("event sink: worker error")
+                with self._condition:
+                    self.worker_errors += 1
+
+            if closed:
+                return None
+
+    def _write_pending(self):
+        """Write the queued records, and the spool file if it has any."""
+
+        with self._write_lock:
+            with self._condition:
+                batch = self._buffer
+                self._buffer = []
+
+            if batch:
+                try:
+                    written = self._insert(batch)
+                except Exception:
+                    # Keep the records, as for a failed write, then report.
+                    self._spool(batch)
+                    raise
+                if not written:
+                    self._spool(batch)
+                    return None
+
+            if self._spool_pending:
+                self._replay_spool()
+
+        return None
+
+    def _insert(self, records):
+        """
+        Insert records, ignoring ones already written.
+
+        Returns:
+            written (boolean) False if the batch could not be written.
+        """
+
+        try:
+            self.event_storage.insert_events(records)
+        except storage.WRITE_ERRORS as error:
+            logger.warning("event sink: could not write %d events: %s",
+                    len(records), error)
+            with self._condition:
+                self.failures += 1
+            return False
+
+        with self._condition:
+            self.written += len(records)
+            self.batches += 1
+
+        return True
+
+    def _spool(self, records):
+        """Append records which could not be written to the spool file."""
+
+        if not self.spool_path:
+            with self._condition:
+                self.dropped += len(records)
+            return None
+
+        with open(self.spool_path, "a") as spool_file:
+            for record in records:
+                spool_file.write(json_util.dumps(record) + "\n")
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+
+        with self._condition:
+            self.spooled += len(records)
+        self._spool_pending = True
+
+        return None
+
+    def _replay_spool(self):
+        """Insert the records in the spool file, then empty it."""
+
+        with open(self.spool_path) as spool_file:
+            records = [json_util.loads(line) for line in spool_file if line.strip()]
+
+        for start in range(0, len(records), self.max_batch):
+            if not self._insert(records[start:start + self.max_batch]):
+                return None
+
+        with open(self.spool_path, "w"):
+            pass
+        self._spool_pending = False
+
+        with self._condition:
+            self.replayed += len(records)
+
+        return None
+
+def get_event_sink():
+    """
+    Return the process-wide EventSink for the storage backend, creating
+    it on first use. It is closed, and so flushed, when the process exits.
+    """
+
+    global _event_sink
+    if _event_sink is None:
+        with _event_sink_lock:
+            if _event_sink is None:
+                environ = os.environ
+                _event_sink = EventSink(storage.get_storage(),
+                        max_batch=int(environ.get("BRIDGE_EVENT_BATCH_SIZE", 100)),
+                        flush_interval=float(environ.get(
+                            "BRIDGE_EVENT_FLUSH_INTERVAL", 1.0)),
+                        spool_path=environ.get("BRIDGE_EVENT_SPOOL"))
+                atexit.register(_event_sink.close)
+
+    return _event_sink
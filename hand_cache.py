@@ -0,0 +1,225 @@
+"""
+In-process, read-through cache of hand documents.
+
+Hand documents are only rewritten when alter_database adds or edits a
+hand, which bumps a generation counter stored in the "meta" collection.
+HandCache reads that counter at most once every check_interval seconds and
+empties itself when it has moved, so edits show up without a restart while
+page views are served from memory.
+
+Elo changes do not bump the generation: the serving path writes the
+change to storage and patches the cached copy with add_elo() or
+update_elo(). Other processes' changes are not seen that way, so an
+answer is graded against the elo read_elo() reads from storage, which
+also refreshes the cached copy.
+
+HandCache reads through a storage backend (see storage.py); the functions
+below work on the Mongo "meta" collection directly, for scripts which
+write hands with pymongo.
+"""
+import collections
+import threading
+import time
+
+GENERATION_ID = "hands_generation"
+
+def read_generation(meta_collection):
+    """Return the current hands generation, 0 if never bumped."""
+
+    document = meta_collection.find_one({"_id" : GENERATION_ID})
+    return document["value"] if document else 0
+
+def bump_generation(meta_collection):
+    """
+    Record that hand documents changed, so every HandCache reloads them.
+    Call this after inserting or editing hands.
+    """
+
+    meta_collection.update_one({"_id" : GENERATION_ID},
+            {"$inc" : {"value" : 1}}, upsert=True)
+
+    return None
+
+class HandCache(object):
+    """
+    LRU cache of hand documents keyed by _id.
+
+    Counters (see stats()):
+        hits, misses       lookups served from memory / from storage
+        evictions          documents dropped to stay within max_size
+        invalidations      times the cache was emptied by a generation bump
+    """
+
+    def __init__(self, storage, max_size=4096, check_interval=5.0):
+        """
+        Parameters:
+            storage (storage.Storage) holds the hands and the generation.
+            max_size (int) documents kept before evicting the least recently
+                used one.
+            check_interval (float) seconds between generation checks.
+        """
+
+        self.storage = storage
+        self.max_size = max_size
+        self.check_interval = check_interval
+
+        self._hands = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = storage.read_generation()
+        self._last_check = time.time()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, hand_id):
+        """
+        Return the hand document with this _id, or None if there is none.
+
+        The returned document is shared with the cache: do not modify it.
+        """
+
+        self._check_generation()
+
+        with self._lock:
+            hand_json = self._hands.get(hand_id)
+            if hand_json is not None:
+                self._hands.move_to_end(hand_id)
+                self.hits += 1
+                return hand_json
+            self.misses += 1
+            generation = self._generation
+
+        # If the generation moved during the read, the document may be from
+        # before the edit, so it is returned but not cached.
+        hand_json = self.storage.get_hand(hand_id)
+        if hand_json is not None:
+            self._store(hand_id, hand_json, generation)
+
+        return hand_json
+
+    def read_elo(self, hand_id, pending_delta=0.0):
+        """
+        Read the current elo of a hand from storage, which other processes
+        may have changed, and patch the cached copy with it.
+
+        Parameters:
+            hand_id (hand _id)
+            pending_delta (float) change of the elo made in this process
+                but not yet written, see RatingUpdater.pending_hand_delta().
+
+        Returns:
+            elo (float), or None if the hand is gone, which also drops it
+            from the cache.
+        """
+
+        stored_elo = self.storage.get_hand_elo(hand_id)
+        if stored_elo is None:
+            self.invalidate(hand_id)
+            return None
+        elo = stored_elo + pending_delta
+        self.update_elo(hand_id, elo)
+
+        return elo
+
+    def preload(self, hand_jsons):
+        """Add already loaded hand documents, e.g. to warm the cache."""
+
+        generation = self._generation
+        for hand_json in hand_jsons:
+            self._store(hand_json["_id"], hand_json, generation)
+
+        return None
+
+    def update_elo(self, hand_id, new_elo):
+        """Patch the elo of a cached hand after writing it to storage."""
+
+        with self._lock:
+            hand_json = self._hands.get(hand_id)
+            if hand_json is not None:
+                hand_json["elo"] = new_elo
+
+        return None
+
+    def add_elo(self, hand_id, delta):
+        """
+        Add delta to the elo of a cached hand, atomically.
+
+        Returns:
+            new_elo (float), or None if the hand is not cached.
+        """
+
+        with self._lock:
+            hand_json = self._hands.get(hand_id)
+            if hand_json is None:
+                return None
+            hand_json["elo"] += delta
+
+            return hand_json["elo"]
+
+    def invalidate(self, hand_id=None):
+        """Drop one hand, or with no argument every hand, from the cache."""
+
+        with self._lock:
+            if hand_id is None:
+                self._hands.clear()
+            else:
+                self._hands.pop(hand_id, None)
+
+        return None
+
+    @property
+    def generation(self):
+        """The hands generation the cached documents belong to."""
+
+        return self._generation
+
+    def stats(self):
+        """Return the cache counters and size, as a dict."""
+
+        with self._lock:
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "invalidations" : self.invalidations,
+                "size" : len(self._hands),
+                "max_size" : self.max_size,
+                "generation" : self._generation,
+            }
+
+    def _store(self, hand_id, hand_json, generation):
+        """
+        Insert a document read at generation, evicting the least recently
+        used if full. Nothing is stored if the cache has since moved to a
+        new generation.
+        """
+
+        with self._lock:
+            if generation != self._generation:
+                return None
+            self._hands[hand_id] = hand_json
+            self._hands.move_to_end(hand_id)
+            while len(self._hands) > self.max_size:
+                self._hands.popitem(last=False)
+                self.evictions += 1
+
+        return None
+
+    def _check_generation(self):
+        """Empty the cache if hands were edited since the last check."""
+
+        now = time.time()
+        if now - self._last_check < self.check_interval:
+            return None
+        self._last_check = now
+
+        generation = self.storage.read_generation()
+        if generation != self._generation:
+            with self._lock:
+                self._hands.clear()
+                self._generation = generation
+                self.invalidations += 1
+
+        return None
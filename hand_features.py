@@ -0,0 +1,486 @@
+"""
+Features of each problem, computed once when it is stored.
+
+Filtering problems by declarer strength, shape, contract or kind used to
+mean loading every document and parsing its card lists. Instead each hand
+document holds a "features" sub-document, computed by compute_features()
+when alter_database.py or import_problems.py writes the hand:
+
+    hcp, shape, pattern, longest_suit, longest_length, ltc
+                        per seat, keyed N E S W; shape is the S H D C
+                        lengths, pattern the sorted lengths e.g. "5332",
+                        ltc the losing-trick count
+    contract_level, contract_strain, contract_doubled, declarer
+                        the contract reached by the auction, or for hands
+                        entered without one, the first contract named in
+                        the question, e.g. "Against 3NT, ..." (declarer
+                        None); contract_source says which. None for a
+                        bidding problem, whose contract is not yet known
+    declarer_side, declarer_side_hcp
+                        the partnership playing the hand and its HCP
+    hidden_hands, visible_seats
+                        in N E S W order, e.g. "EW" and "NS"
+    problem_type        bidding (the auction ends "?"), lead (the question
+                        asks for a lead), declarer (the visible hands are
+                        one partnership) or defense
+    version             FEATURES_VERSION when computed
+
+schema.py indexes the fields queries filter on, so find_problems() of
+e.g. a 1400-rated 3NT opening-lead problem reads only matching index
+keys. FeatureMatrix holds the numeric features of every hand as one NumPy
+array for scans any backend can run, cached in a .npz file which is
+rebuilt when hands are added or edited.
+
+Usage:
+    python hand_features.py backfill
+    python hand_features.py find --type lead --contract 3N --elo 1400
+    python hand_features.py find --type declarer --min-hcp 24 --matrix
+"""
+import argparse
+import json
+import os
+import re
+import numpy as np
+from bson import json_util
+import auction
+import storage
+from deal import SEATS, SUITS, Deal, shape, suit_slice
+
+# Bump when a feature changes, so backfill recomputes stored features.
+FEATURES_VERSION = 2
+
+DEFAULT_MATRIX_PATH = "hand_features.npz"
+PROBLEM_TYPES = ["bidding", "lead", "declarer", "defense"]
+STRAINS = auction.STRAINS
+
+# A contract named in a question, e.g. "3NT", "6S" or "4 spades", and one
+# after words which say it is the contract played, e.g. "Against 3NT".
+TEXT_CONTRACT = (r"\b([1-7])\s*(NT|N|S|H|D|C|no\s*trumps?|notrumps?|spades?|"
+        r"hearts?|diamonds?|clubs?)\b")
+TEXT_CONTRACT_PATTERN = re.compile(TEXT_CONTRACT, re.IGNORECASE)
+PLAYED_CONTRACT_PATTERN = re.compile(r"\b(?:in|against|defending|declare|play|"
+        r"playing|contract:)\s+" + TEXT_CONTRACT, re.IGNORECASE)
+LEAD_QUESTION_PATTERN = re.compile(r"\b(opening lead|what do you lead|"
+        r"which card do you lead|what would you lead|your lead)\b", re.IGNORECASE)
+
+# Numeric columns of FeatureMatrix.
+MATRIX_COLUMNS = (["elo"] + ["hcp_" + seat for seat in SEATS]
+        + ["length_{}_{}".format(seat, suit) for seat in SEATS for suit in SUITS]
+        + ["ltc_" + seat for seat in SEATS]
+        + ["hidden_" + seat for seat in SEATS]
+        + ["contract_level", "contract_strain", "declarer", "problem_type",
+            "declarer_side_hcp"])
+
+# find_problems() condition -> stored field.
+FILTER_FIELDS = {
+    "problem_type" : "features.problem_type",
+    "contract_level" : "features.contract_level",
+    "contract_strain" : "features.contract_strain",
+    "declarer" : "features.declarer",
+    "declarer_side" : "features.declarer_side",
+    "declarer_side_hcp" : "features.declarer_side_hcp",
+}
+
+def losing_trick_count(mask):
+    """
+    Return the losing-trick count of a hand: in each suit, the number of
+    its first three cards (or fewer, in a short suit) which are not the
+    ace, king or queen in the matching position.
+    """
+
+    losers = 0
+    for suit_index in range(4):
+        suit_bits = suit_slice(mask, suit_index)
+        n_counted = min(bin(suit_bits).count("1"), 3)
+        # The ace is bit 12, the king 11 and the queen 10.
+        honours = sum(suit_bits >> (12 - position) & 1 for position in range(n_counted))
+        losers += n_counted - honours
+
+    return losers
+
+def contract_from_text(text):
+    """
+    Return the contract named in a question, e.g. "Against 3NT" ->
+    (3, "N"), or None. A contract said to be played is preferred to e.g.
+    an opening bid.
+    """
+
+    match = (PLAYED_CONTRACT_PATTERN.search(text or "")
+            or TEXT_CONTRACT_PATTERN.search(text or ""))
+    if match is None:
+        return None
+
+    strain = match.group(2).upper()
+    strain = "N" if strain.startswith("N") else strain[0]
+
+    return int(match.group(1)), strain
+
+def problem_type(hand_json, calls, visible_seats):
+    """Return the kind of problem: bidding, lead, declarer or defense."""
+
+    question = hand_json.get("question") or hand_json.get("context") or ""
+    if calls and calls[-1] == "?":
+        return "bidding"
+    if LEAD_QUESTION_PATTERN.search(question):
+        return "lead"
+    if visible_seats in ["NS", "EW"]:
+        return "declarer"
+    return "defense"
+
+def compute_features(hand_json):
+    """
+    Return the features of a hand document.
+
+    Parameters:
+        hand_json (json) with the four hands, as card lists or hand strings.
+
+    Returns:
+        features (dict) see the module docstring.
+
+    Raises an AssertionError if a card or the auction is not understood.
+    """
+
+    deal = Deal.from_hand_json(hand_json)
+    features = {"version" : FEATURES_VERSION}
+
+    # Per seat.
+    seat_hcp = dict(zip(SEATS, deal.hcp()))
+    features["hcp"] = seat_hcp
+    features["shape"] = {}
+    features["pattern"] = {}
+    features["longest_suit"] = {}
+    features["longest_length"] = {}
+    features["ltc"] = {}
+    for seat, mask in zip(SEATS, deal.masks):
+        lengths = shape(mask)
+        longest = max(range(4), key=lambda suit_index: lengths[suit_index])
+        features["shape"][seat] = list(lengths)
+        features["pattern"][seat] = "".join(str(length) for length in
+                sorted(lengths, reverse=True))
+        features["longest_suit"][seat] = SUITS[longest]
+        features["longest_length"][seat] = lengths[longest]
+        features["ltc"][seat] = losing_trick_count(mask)
+
+    # Hidden and visible seats.
+    hidden = (hand_json.get("hidden_hands") or "").upper()
+    features["hidden_hands"] = "".join(seat for seat in SEATS if seat in hidden)
+    features["visible_seats"] = "".join(seat for seat in SEATS if seat not in hidden)
+
+    # The contract, from the auction if there is one. An auction ending
+    # "?" is a bidding problem, whose contract is still to be found.
+    auction_string = hand_json.get("auction") or ""
+    dealer = hand_json.get("dealer")
+    calls = auction.parse_auction(auction_string) if auction_string else []
+    is_bidding = bool(calls) and calls[-1] == "?"
+    contract = (auction.final_contract(auction_string, dealer)
+            if calls and dealer and not is_bidding else None)
+    if contract is not None:
+        features.update({"contract_level" : contract["level"],
+            "contract_strain" : contract["strain"],
+            "contract_doubled" : contract["doubled"],
+            "declarer" : contract["declarer"], "contract_source" : "auction"})
+    else:
+        text_contract = None if is_bidding else contract_from_text(
+                hand_json.get("question") or hand_json.get("context"))
+        level, strain = text_contract if text_contract else (None, None)
+        features.update({"contract_level" : level, "contract_strain" : strain,
+            "contract_doubled" : "", "declarer" : None,
+            "contract_source" : "text" if text_contract else None})
+
+    features["problem_type"] = problem_type(hand_json, calls,
+            features["visible_seats"])
+
+    # The declaring partnership: the declarer's, or in a declarer problem
+    # without an auction, the visible one.
+    declarer_side = None
+    if features["declarer"] is not None:
+        declarer_side = "NS" if features["declarer"] in "NS" else "EW"
+    elif features["problem_type"] == "declarer":
+        declarer_side = features["visible_seats"]
+    features["declarer_side"] = declarer_side
+    features["declarer_side_hcp"] = (sum(seat_hcp[seat] for seat in declarer_side)
+            if declarer_side else None)
+
+    return features
+
+def needs_features(hand_json, force=False):
+    """Return True if a hand has no features, or features of an old version."""
+
+    features = hand_json.get("features")
+    return force or not features or features.get("version") != FEATURES_VERSION
+
+def backfill(hand_storage, force=False):
+    """
+    Compute and store the features of every hand without current ones.
+
+    Parameters:
+        hand_storage (storage.Storage)
+        force (boolean) recompute every hand's features.
+
+    Returns:
+        summary (dict) counts "read", "updated" and "failed".
+    """
+
+    summary = {"read" : 0, "updated" : 0, "failed" : 0}
+    for hand_json in hand_storage.iter_hands():
+        summary["read"] += 1
+        if not needs_features(hand_json, force):
+            continue
+        try:
+            features = compute_features(hand_json)
+        except AssertionError as error:
+            print("{}: {}".format(hand_json["_id"], error))
+            summary["failed"] += 1
+            continue
+        # Only features are set, so concurrent elo updates are kept.
+        hand_storage.update_hand(hand_json["_id"], {"features" : features})
+        summary["updated"] += 1
+
+    # Tell running apps to reload their cached hands.
+    if summary["updated"]:
+        hand_storage.bump_generation()
+
+    return summary
+
+def features_query(conditions, elo=None, window=100):
+    """
+    Return the Mongo filter for find_problems().
+
+    Parameters:
+        conditions (dict) keys of FILTER_FIELDS -> a value, or a
+            (low, high) tuple for a range.
+        elo (float) optional, rating at the centre of the range.
+        window (float) half-width of the rating range.
+    """
+
+    query = {}
+    for name, value in conditions.items():
+        if value is None:
+            continue
+        if isinstance(value, tuple):
+            low, high = value
+            value = {}
+            if low is not None:
+                value["$gte"] = low
+            if high is not None:
+                value["$lte"] = high
+        query[FILTER_FIELDS[name]] = value
+    if elo is not None:
+        query["elo"] = {"$gte" : elo - window, "$lte" : elo + window}
+
+    return query
+
+def find_problems(hands_collection, conditions, elo=None, window=100, limit=20):
+    """
+    Return hand documents matching conditions, rated within window of elo,
+    using the feature indexes of schema.py.
+    """
+
+    cursor = hands_collection.find(features_query(conditions, elo, window))
+    return list(cursor.limit(limit))
+
+class FeatureMatrix(object):
+    """
+    Numeric features of every hand, one row per hand, for vectorized
+    filtering.
+
+    Attributes:
+        matrix (np.ndarray) float64, one column per MATRIX_COLUMNS entry;
+            missing values are NaN, strings are stored as their index in
+            STRAINS, SEATS or PROBLEM_TYPES.
+        hand_ids (list) the _id of each row.
+        generation (int) hands generation the matrix was built at.
+    """
+
+    def __init__(self, matrix, hand_ids, generation=0):
+        self.matrix = matrix
+        self.hand_ids = hand_ids
+        self.generation = generation
+        self._row_by_id = {hand_id : row for row, hand_id in enumerate(hand_ids)}
+
+    @classmethod
+    def from_hands(cls, hand_jsons, generation=0):
+        """Build the matrix, computing features where they are not current."""
+
+        rows = []
+        hand_ids = []
+        for hand_json in hand_jsons:
+            features = (compute_features(hand_json) if needs_features(hand_json)
+                    else hand_json["features"])
+            rows.append(feature_row(hand_json.get("elo"), features))
+            hand_ids.append(hand_json["_id"])
+
+        matrix = np.array(rows, dtype=np.float64).reshape(len(rows), len(MATRIX_COLUMNS))
+        return cls(matrix, hand_ids, generation)
+
+    def save(self, path):
+        """Write the matrix to a .npz file, atomically."""
+
+        temporary_path = path + ".tmp.npz"
+        np.savez(temporary_path, matrix=self.matrix, generation=self.generation,
+                version=FEATURES_VERSION, columns=np.array(MATRIX_COLUMNS),
+                hand_ids=np.array([json_util.dumps(hand_id) for hand_id in self.hand_ids]))
+        os.replace(temporary_path, path)
+
+        return None
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a matrix written by save().
+
+        Returns:
+            feature_matrix (FeatureMatrix), or None if the file is missing or
+            was written with other features.
+        """
+
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if (int(data["version"]) != FEATURES_VERSION
+                    or list(data["columns"]) != MATRIX_COLUMNS):
+                return None
+            hand_ids = [json_util.loads(hand_id) for hand_id in data["hand_ids"]]
+            return cls(data["matrix"], hand_ids, int(data["generation"]))
+
+    def update_elos(self, elos_and_ids):
+        """Set the elo column from (elo, _id) pairs, e.g. storage.hand_elos()."""
+
+        column = MATRIX_COLUMNS.index("elo")
+        for hand_elo, hand_id in elos_and_ids:
+            row = self._row_by_id.get(hand_id)
+            if row is not None:
+                self.matrix[row, column] = hand_elo
+
+        return None
+
+    def select(self, conditions, elo=None, window=100):
+        """
+        Return the _ids of hands matching conditions, as find_problems().
+
+        Conditions may name any of MATRIX_COLUMNS, e.g. {"hcp_S" : (15, 17)}.
+        """
+
+        selected = np.ones(len(self.hand_ids), dtype=bool)
+        if elo is not None:
+            conditions = dict(conditions, elo=(elo - window, elo + window))
+        for name, value in conditions.items():
+            if value is None:
+                continue
+            column = self.matrix[:, MATRIX_COLUMNS.index(name)]
+            if isinstance(value, tuple):
+                low, high = value
+                if low is not None:
+                    selected &= column >= low
+                if high is not None:
+                    selected &= column <= high
+            else:
+                selected &= column == encode(name, value)
+
+        return [self.hand_ids[row] for row in np.flatnonzero(selected)]
+
+def encode(name, value):
+    """Return a feature value as stored in FeatureMatrix."""
+
+    if value is None:
+        return np.nan
+    if name == "contract_strain":
+        return STRAINS.index(value)
+    if name == "declarer":
+        return SEATS.index(value)
+    if name == "problem_type":
+        return PROBLEM_TYPES.index(value)
+    return value
+
+def feature_row(hand_elo, features):
+    """Return the MATRIX_COLUMNS values of one hand."""
+
+    row = [np.nan if hand_elo is None else hand_elo]
+    row += [features["hcp"][seat] for seat in SEATS]
+    row += [length for seat in SEATS for length in features["shape"][seat]]
+    row += [features["ltc"][seat] for seat in SEATS]
+    row += [float(seat in features["hidden_hands"]) for seat in SEATS]
+    row += [encode(name, features[name]) for name in ["contract_level",
+        "contract_strain", "declarer", "problem_type", "declarer_side_hcp"]]
+
+    return row
+
+def load_feature_matrix(hand_storage, path=DEFAULT_MATRIX_PATH):
+    """
+    Return the FeatureMatrix of every hand, from the cache file at path if
+    it is of the current hands generation and number of hands, otherwise
+    built and saved. Elos change without a new generation, so they are
+    always read afresh.
+    """
+
+    generation = hand_storage.read_generation()
+    feature_matrix = FeatureMatrix.load(path)
+    if (feature_matrix is None or feature_matrix.generation != generation
+            or len(feature_matrix.hand_ids) != hand_storage.count_hands()):
+        feature_matrix = FeatureMatrix.from_hands(hand_storage.iter_hands(), generation)
+        feature_matrix.save(path)
+
+    feature_matrix.update_elos(hand_storage.hand_elos())
+
+    return feature_matrix
+
+def parse_contract(contract):
+    """Return (level, strain) of e.g. "3N" or "3NT", or (None, None)."""
+
+    if not contract:
+        return None, None
+    call = auction.normalize_call(contract)
+    INVALID_CONTRACT_ERROR = "contract not understood: {}".format(contract)
+    assert call[0] in "1234567", INVALID_CONTRACT_ERROR
+
+    return int(call[0]), call[1]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["backfill", "find"])
+    parser.add_argument("--storage", choices=["mongo", "sqlite"], default=None,
+            help="backend, default BRIDGE_STORAGE")
+    parser.add_argument("--force", action="store_true",
+            help="backfill: recompute every hand's features")
+    parser.add_argument("--type", choices=PROBLEM_TYPES, help="find: problem type")
+    parser.add_argument("--contract", help="find: e.g. 3N or 4S")
+    parser.add_argument("--declarer", choices=list(SEATS))
+    parser.add_argument("--min-hcp", type=int,
+            help="find: least HCP of the declaring side")
+    parser.add_argument("--max-hcp", type=int)
+    parser.add_argument("--elo", type=float, help="find: rating of the problem")
+    parser.add_argument("--window", type=float, default=100)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--matrix", action="store_true",
+            help="find: scan the cached feature matrix instead of querying Mongo")
+    parser.add_argument("--matrix-path", default=DEFAULT_MATRIX_PATH)
+    args = parser.parse_args()
+
+    hand_storage = (storage.open_storage(args.storage) if args.storage
+            else storage.get_storage())
+
+    if args.command == "backfill":
+        print(json.dumps(backfill(hand_storage, args.force)))
+
+    else:
+        level, strain = parse_contract(args.contract)
+        conditions = {"problem_type" : args.type, "contract_level" : level,
+                "contract_strain" : strain, "declarer" : args.declarer}
+        if args.min_hcp is not None or args.max_hcp is not None:
+            conditions["declarer_side_hcp"] = (args.min_hcp, args.max_hcp)
+
+        if args.matrix or hand_storage.name != "mongo":
+            feature_matrix = load_feature_matrix(hand_storage, args.matrix_path)
+            hand_ids = feature_matrix.select(conditions, args.elo, args.window)
+            hand_jsons = [hand_storage.get_hand(hand_id)
+                    for hand_id in hand_ids[:args.limit]]
+        else:
+            hand_jsons = find_problems(hand_storage.hands, conditions,
+                    args.elo, args.window, args.limit)
+
+        for hand_json in hand_jsons:
+            features = hand_json.get("features") or compute_features(hand_json)
+            print(hand_json["_id"], round(hand_json["elo"]), features["problem_type"],
+                    features["contract_level"], features["contract_strain"],
+                    (hand_json.get("question") or hand_json.get("context", ""))[:60])
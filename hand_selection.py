@@ -0,0 +1,166 @@
+"""
+Select hands near a player's rating without loading the hand documents.
+
+EloIndex keeps every hand id in a list sorted by hand elo, built once per
+process from Storage.hand_elos(), which reads only elo and _id (a covered
+query on the (elo, _id) index in Mongo, see storage.py). Choosing a hand
+is a bisect into that list plus one lookup by _id, so the cost per page
+view does not grow with the number of hands.
+"""
+import bisect
+import random
+import threading
+
+# Default half-width of the rating window around the player, in elo points.
+DEFAULT_WINDOW = 200
+
+def _id_key(hand_id):
+    """Return a sort key for a hand id: ids may be ObjectIds or strings,
+    which do not compare with each other."""
+
+    return str(hand_id)
+
+class EloIndex(object):
+    """
+    Hand ids sorted by hand elo.
+
+    Attributes:
+        elos (float []) hand elos, ascending.
+        hand_ids (list) hand ids, in the same order as elos.
+        keys (tuple []) (elo, id key) pairs, in the same order: hands of
+            equal elo are ordered by id, so a hand is found by bisection
+            even when many share an elo, as new hands all do.
+        generation (int) hands generation the index was read at.
+
+    The index is thread-safe: concurrent answers move hands while other
+    threads sample.
+    """
+
+    def __init__(self, elos_and_ids):
+        """
+        Parameters:
+            elos_and_ids (iterable) (elo, hand_id) pairs, in any order.
+        """
+
+        self._lock = threading.Lock()
+        self._load(elos_and_ids)
+
+        # Hands generation (see hand_cache.py) the index was read at, kept
+        # up to date by the caller.
+        self.generation = 0
+
+    def _load(self, elos_and_ids):
+        """Replace the contents of the index."""
+
+        pairs = sorted(elos_and_ids, key=lambda pair: (pair[0], _id_key(pair[1])))
+        elos = [elo for elo, hand_id in pairs]
+        hand_ids = [hand_id for elo, hand_id in pairs]
+        keys = [(elo, _id_key(hand_id)) for elo, hand_id in pairs]
+        elo_by_id = {hand_id : elo for elo, hand_id in pairs}
+
+        with self._lock:
+            self.elos, self.hand_ids, self.keys, self.elo_by_id = (elos, hand_ids,
+                    keys, elo_by_id)
+
+        return None
+
+    @classmethod
+    def from_storage(cls, storage):
+        """Build the index from a storage backend, see storage.py."""
+
+        return cls(storage.hand_elos())
+
+    def reload_from_storage(self, storage):
+        """Rebuild the index in place from a storage backend, e.g. after
+        hands were added."""
+
+        self._load(storage.hand_elos())
+
+        return None
+
+    def __len__(self):
+        return len(self.hand_ids)
+
+    def sample(self, player_elo, window=DEFAULT_WINDOW, exclude=None, rng=random):
+        """
+        Return the id of a random hand rated within window of player_elo.
+
+        Parameters:
+            player_elo (float) e.g. 1200
+            window (float) half-width of the rating window. If no hand is
+                rated inside it, the window is doubled until one is.
+            exclude (hand id) optional, a hand not to return, e.g. the hand
+                just shown. Ignored if it is the only candidate.
+            rng (random.Random) source of randomness.
+
+        Returns:
+            hand_id, or None if the index is empty.
+        """
+
+        with self._lock:
+            return self._sample(player_elo, window, exclude, rng)
+
+    def _sample(self, player_elo, window, exclude, rng):
+        NONPOSITIVE_WINDOW_ERROR = "window must be positive, or it never widens"
+        assert window > 0, NONPOSITIVE_WINDOW_ERROR
+
+        if not self.hand_ids:
+            return None
+
+        # Widen the window until it holds a hand other than exclude.
+        while True:
+            low = bisect.bisect_left(self.elos, player_elo - window)
+            high = bisect.bisect_right(self.elos, player_elo + window)
+            n_candidates = high - low
+            if exclude in self.elo_by_id and low <= self._position(exclude) < high:
+                n_candidates -= 1
+            if n_candidates > 0 or high - low == len(self.hand_ids):
+                break
+            window *= 2
+
+        hand_id = self.hand_ids[rng.randrange(low, high)]
+        if hand_id == exclude and high - low > 1:
+            while hand_id == exclude:
+                hand_id = self.hand_ids[rng.randrange(low, high)]
+
+        return hand_id
+
+    def update(self, hand_id, new_elo):
+        """
+        Move a hand to its new position after its elo changes, or add it
+        if it is new.
+        """
+
+        with self._lock:
+            if hand_id in self.elo_by_id:
+                position = self._position(hand_id)
+                del self.elos[position]
+                del self.hand_ids[position]
+                del self.keys[position]
+
+            key = (new_elo, _id_key(hand_id))
+            position = bisect.bisect_left(self.keys, key)
+            self.elos.insert(position, new_elo)
+            self.hand_ids.insert(position, hand_id)
+            self.keys.insert(position, key)
+            self.elo_by_id[hand_id] = new_elo
+
+        return None
+
+    def remove(self, hand_id):
+        """Remove a hand from the index, if present."""
+
+        with self._lock:
+            if hand_id in self.elo_by_id:
+                position = self._position(hand_id)
+                del self.elos[position]
+                del self.hand_ids[position]
+                del self.keys[position]
+                del self.elo_by_id[hand_id]
+
+        return None
+
+    def _position(self, hand_id):
+        """Return the position of a hand in the sorted lists."""
+
+        return bisect.bisect_left(self.keys, (self.elo_by_id[hand_id], _id_key(hand_id)))
@@ -0,0 +1,604 @@
+"""
+CLI to import whole files of problems into the stored hands.
+
+Supported formats, chosen by file extension or --format:
+    pbn     Portable Bridge Notation (.pbn)
+    lin     BBO LIN (.lin)
+    jsonl   our own format, one hand document per line (.jsonl, .json),
+            as written by the backups. A JSON array is also accepted,
+            and is read one element at a time too.
+
+Files are read one record at a time and written in batches, through the
+configured storage backend (see storage.py), so memory use does not grow
+with the file. Each problem is rendered as it is imported, and its HTML
+stored with it (see render_hand.prerender_hands), and journaled for the
+search index, which adds it when next opened (see search_index.py).
+Every record is checked with alter_database.validate_and_parse, plus a
+check that the four hands are the 52 cards. Bad records are reported and
+skipped; the rest of their batch is still written.
+
+PBN records use the standard Deal, Dealer and Auction tags, plus these
+problem tags:
+    [Question "Which card do you lead?"]
+    [Answer "H9"]              (also CorrectAnswer)
+    [Explanation "..."]        (else the {commentary} of the record)
+    [HiddenHands "EW"]
+    [Source "..."]             (else Event and Board)
+    [Notes "..."]
+
+LIN records use md (deal and dealer), mb (calls) and ah (board title).
+Problem text comes from nt notes: a note starting "Answer:" gives the
+correct answer, one starting "Explanation:" the explanation, and any
+other notes make up the question. Boards in one file are separated by
+qx, or are on separate lines.
+
+Usage:
+    python import_problems.py becoming_a_bridge_expert.pbn --hidden-hands EW
+    python import_problems.py quiz.lin --source "BBO quiz" --dry-run
+    python import_problems.py database_backup/hands_backup_6_14.json --report failed.jsonl
+"""
+import argparse
+import json
+import os
+import re
+import time
+import bson
+import auction
+import deal_hashing
+import hand_features
+import search_index
+import storage
+from alter_database import validate_and_parse
+from render_hand import prerender_hands
+from audit_hands import iter_hands_from_file
+from deal import SEATS, SEAT_KEYS, FULL_DECK, Deal, hand_list_to_mask, \
+        hand_string_to_mask, mask_to_hand_string
+
+DEFAULT_ELO = 1200
+DEFAULT_BATCH_SIZE = 500
+
+FORMATS = {".pbn" : "pbn", ".lin" : "lin", ".jsonl" : "jsonl", ".json" : "jsonl"}
+
+# Keys every imported hand needs.
+REQUIRED_KEYS = SEAT_KEYS + ["correct_answer"]
+
+PBN_TAG_PATTERN = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$')
+
+# LIN deals start with South and go clockwise; dealer digits 1-4 are S W N E.
+LIN_SEATS = "SWNE"
+
+####################################################################
+########################## Parsers #################################
+####################################################################
+
+def iter_pbn_records(lines):
+    """
+    Yield the records of a PBN file, one at a time.
+
+    Parameters:
+        lines (iterable of strings) e.g. an open file.
+
+    Yields:
+        record (dict) tag -> value, plus "auction_calls" (string []) the
+        tokens of the auction section and "commentary" (string []).
+    """
+
+    def new_record():
+        return {"auction_calls" : [], "commentary" : []}
+
+    record = new_record()
+    section = None
+    in_commentary = False
+    commentary = []
+    for line in lines:
+        line = line.rstrip("\n")
+
+        # Commentary may span lines: { ... }.
+        if in_commentary:
+            if "}" in line:
+                commentary.append(line[:line.index("}")])
+                record["commentary"].append(" ".join(commentary).strip())
+                line = line[line.index("}") + 1:]
+                in_commentary = False
+            else:
+                commentary.append(line.strip())
+                continue
+
+        stripped = line.strip()
+
+        # Escaped lines and comments to the end of the line.
+        if stripped.startswith("%") or stripped.startswith(";"):
+            continue
+
+        # An empty line ends a record.
+        if not stripped:
+            if len(record) > 2:
+                yield record
+                record = new_record()
+            section = None
+            continue
+
+        match = PBN_TAG_PATTERN.match(stripped)
+        if match:
+            tag, value = match.groups()
+
+            # A repeated tag starts a new record even without a blank line.
+            if tag in record and tag in ["Event", "Board", "Deal"]:
+                yield record
+                record = new_record()
+            record[tag] = value
+            section = tag
+            continue
+
+        # Commentary starting on this line.
+        if "{" in stripped:
+            before, after = stripped.split("{", 1)
+            if "}" in after:
+                record["commentary"].append(after[:after.index("}")].strip())
+            else:
+                in_commentary = True
+                commentary = [after.strip()]
+            stripped = before.strip()
+
+        # Section data; only the auction section is used.
+        if section == "Auction" and stripped:
+            record["auction_calls"].extend(stripped.split())
+
+    if len(record) > 2:
+        yield record
+
+def pbn_deal_to_hand_strings(deal_value):
+    """
+    Convert a PBN Deal tag to hand strings by seat.
+
+    Parameters:
+        deal_value (string) e.g. "N:AKJ.QJT9.752.9842 ...", first seat then
+        the hands clockwise, suits in the order S H D C. "-" is an unknown
+        hand.
+
+    Returns:
+        hand_strs (dict) seat key -> hand string, e.g.
+        {"n_hand" : "AKJ QJT9 752 9842", ...}
+    """
+
+    INVALID_DEAL_ERROR = "Deal not understood: {}".format(deal_value)
+    assert len(deal_value) > 2 and deal_value[1] == ":", INVALID_DEAL_ERROR
+    first_seat = SEATS.index(deal_value[0].upper())
+
+    seat_strs = deal_value[2:].split()
+    assert len(seat_strs) == 4, INVALID_DEAL_ERROR
+
+    hand_strs = {}
+    for offset, seat_str in enumerate(seat_strs):
+        key = SEAT_KEYS[(first_seat + offset) % 4]
+        if seat_str == "-":
+            continue
+        suits = seat_str.split(".")
+        assert len(suits) == 4, INVALID_DEAL_ERROR
+        hand_strs[key] = " ".join(suit.upper().replace("10", "T") for suit in suits)
+
+    return fill_missing_hand(hand_strs)
+
+def fill_missing_hand(hand_strs):
+    """If exactly one hand is missing, give it the remaining 13 cards."""
+
+    missing = [key for key in SEAT_KEYS if key not in hand_strs]
+    if len(missing) == 1:
+        dealt = 0
+        for hand_str in hand_strs.values():
+            dealt |= hand_string_to_mask(hand_str)
+        hand_strs[missing[0]] = mask_to_hand_string(FULL_DECK & ~dealt)
+
+    return hand_strs
+
+def complete_all_pass(calls):
+    """Return calls with "AP" (all pass) replaced by the closing passes."""
+
+    calls = [call for call in calls if call != "AP"]
+    if any(call not in ["P", "X", "XX"] for call in calls):
+        n_passes = 3
+    else:
+        n_passes = 4
+    while len(calls) < n_passes or calls[-n_passes:] != ["P"]*n_passes:
+        calls.append("P")
+
+    return calls
+
+def pbn_auction_to_string(tokens):
+    """
+    Convert the tokens of a PBN auction section to our auction string.
+
+    Note references (=1=), annotations ($1), suffixes (! ?) and the
+    incomplete-auction markers (* and -) are dropped.
+    """
+
+    calls = []
+    for token in tokens:
+        if re.match(r"^=\d+=$", token) or token.startswith("$") or token in ["*", "-", "+"]:
+            continue
+        token = token.rstrip("!?")
+        if not token:
+            continue
+        if token.upper() == "AP":
+            calls.append("AP")
+        else:
+            calls.append(auction.normalize_call(token))
+
+    if "AP" in calls:
+        calls = complete_all_pass(calls)
+
+    return " ".join(calls)
+
+def pbn_record_to_problem(record):
+    """
+    Convert a PBN record to an unvalidated problem dict, see
+    record_to_hand_json for the layout.
+    """
+
+    NO_DEAL_ERROR = "record has no Deal tag"
+    assert "Deal" in record, NO_DEAL_ERROR
+
+    problem = pbn_deal_to_hand_strings(record["Deal"])
+
+    if "Dealer" in record:
+        problem["dealer"] = record["Dealer"].upper()
+
+    if "Auction" in record:
+        AUCTION_NOT_FROM_DEALER_ERROR = "the auction must start with the dealer"
+        assert record["Auction"].upper() == problem.get("dealer"), \
+                AUCTION_NOT_FROM_DEALER_ERROR
+        problem["auction"] = pbn_auction_to_string(record["auction_calls"])
+
+    tags = {
+        "Question" : "question",
+        "Answer" : "correct_answer",
+        "CorrectAnswer" : "correct_answer",
+        "Explanation" : "explanation",
+        "HiddenHands" : "hidden_hands",
+        "Source" : "source",
+        "Notes" : "notes",
+    }
+    for tag, key in tags.items():
+        if tag in record:
+            problem[key] = record[tag]
+
+    if "explanation" not in problem and record["commentary"]:
+        problem["explanation"] = "\n".join(record["commentary"])
+
+    if "source" not in problem and record.get("Event", "") not in ["", "?"]:
+        problem["source"] = record["Event"]
+        if record.get("Board"):
+            problem["source"] += " board {}".format(record["Board"])
+
+    return problem
+
+def iter_lin_pairs(line):
+    """Yield the (key, value) pairs of one LIN line, e.g. "md|3S...|"."""
+
+    fields = line.strip().split("|")
+    for position in range(0, len(fields) - 1, 2):
+        yield fields[position].strip().lower(), fields[position + 1]
+
+def iter_lin_records(lines):
+    """
+    Yield the boards of a LIN file, one at a time.
+
+    Yields:
+        record (dict) with "md" (string), "mb" (string []), "nt"
+        (string []) and "ah" (string) when present.
+    """
+
+    def new_record():
+        return {"mb" : [], "nt" : []}
+
+    for line in lines:
+        record = new_record()
+        for key, value in iter_lin_pairs(line):
+            if key == "qx" and "md" in record:
+                yield record
+                record = new_record()
+            if key in ["mb", "nt"]:
+                record[key].append(value)
+            elif key in ["md", "ah"]:
+                record[key] = value
+
+        if "md" in record:
+            yield record
+
+def lin_deal_to_hand_strings(md_value):
+    """
+    Convert a LIN md value to the dealer and hand strings by seat.
+
+    Parameters:
+        md_value (string) e.g. "3SAKQHT9DJ52C9842,S...,S...,", the dealer
+        digit then the hands from South clockwise. The last hand may be
+        left out.
+
+    Returns:
+        (dealer, hand_strs) e.g. ("N", {"n_hand" : "AKQ T9 J52 9842", ...})
+    """
+
+    INVALID_DEAL_ERROR = "md not understood: {}".format(md_value)
+    assert md_value and md_value[0] in "1234", INVALID_DEAL_ERROR
+    dealer = LIN_SEATS[int(md_value[0]) - 1]
+
+    hand_strs = {}
+    for seat, seat_str in zip(LIN_SEATS, md_value[1:].split(",")):
+        seat_str = seat_str.strip().upper().replace("10", "T")
+        if not seat_str:
+            continue
+        suits = {}
+        for suit_match in re.finditer(r"([SHDC])([^SHDC]*)", seat_str):
+            suits[suit_match.group(1)] = suit_match.group(2)
+        hand_strs[SEAT_KEYS[SEATS.index(seat)]] = " ".join(
+                suits.get(suit, "") for suit in "SHDC")
+
+    return dealer, fill_missing_hand(hand_strs)
+
+def lin_record_to_problem(record):
+    """
+    Convert a LIN record to an unvalidated problem dict, see
+    record_to_hand_json for the layout.
+    """
+
+    dealer, problem = lin_deal_to_hand_strings(record["md"])
+    problem["dealer"] = dealer
+
+    calls = [auction.normalize_call(call.strip().rstrip("!")) for call in record["mb"]
+            if call.strip().rstrip("!")]
+    problem["auction"] = " ".join(calls)
+
+    questions = []
+    for note in record["nt"]:
+        note = note.strip()
+        if note.lower().startswith("answer:"):
+            problem["correct_answer"] = note[len("answer:"):].strip()
+        elif note.lower().startswith("explanation:"):
+            problem["explanation"] = note[len("explanation:"):].strip()
+        elif note:
+            questions.append(note)
+    if questions:
+        problem["question"] = " ".join(questions)
+
+    if record.get("ah"):
+        problem["source"] = record["ah"]
+
+    return problem
+
+def jsonl_record_to_problem(record):
+    """
+    Convert a hand document to an unvalidated problem dict. Hands may be
+    card lists or hand strings; _id is kept, as an ObjectId if it is one.
+    """
+
+    problem = dict(record)
+    for key in SEAT_KEYS:
+        if isinstance(problem.get(key), list):
+            problem[key] = mask_to_hand_string(hand_list_to_mask(problem[key]))
+
+    hand_id = problem.get("_id")
+    if isinstance(hand_id, dict) and "$oid" in hand_id:
+        hand_id = hand_id["$oid"]
+    if isinstance(hand_id, str) and bson.ObjectId.is_valid(hand_id):
+        hand_id = bson.ObjectId(hand_id)
+    if hand_id is not None:
+        problem["_id"] = hand_id
+
+    return problem
+
+def iter_problems(path, file_format):
+    """
+    Yield (record_number, problem) for each record of a file, or
+    (record_number, exception) for records which cannot be parsed.
+    Record numbers start at 1.
+    """
+
+    if file_format == "jsonl":
+        records = iter_hands_from_file(path)
+        to_problem = jsonl_record_to_problem
+        f = None
+    else:
+        f = open(path, encoding="utf-8", errors="replace")
+        if file_format == "pbn":
+            records = iter_pbn_records(f)
+            to_problem = pbn_record_to_problem
+        else:
+            records = iter_lin_records(f)
+            to_problem = lin_record_to_problem
+
+    try:
+        for record_number, record in enumerate(records, 1):
+            try:
+                yield record_number, to_problem(record)
+            except (AssertionError, ValueError, KeyError) as e:
+                yield record_number, e
+    finally:
+        if f is not None:
+            f.close()
+
+####################################################################
+########################## Validation ##############################
+####################################################################
+
+def record_to_hand_json(problem, defaults=None):
+    """
+    Validate a problem and return it as a hand document.
+
+    Parameters:
+        problem (dict) hands as hand strings by seat key, e.g.
+            {"n_hand" : "AKJ QJT9 752 9842", ..., "dealer" : "N",
+             "auction" : "1N P P P", "question" : "...",
+             "correct_answer" : "H9"}
+        defaults (dict) optional values for missing keys, e.g.
+            {"hidden_hands" : "EW", "source" : "..."}
+
+    Returns:
+        hand_json (json) in the layout of alter_database.ask_for_hand.
+
+    Raises an AssertionError (or Exception for an unknown key) describing
+    the first problem found, as validate_and_parse does.
+    """
+
+    problem = dict(problem)
+    for key, value in (defaults or {}).items():
+        problem.setdefault(key, value)
+
+    for key in REQUIRED_KEYS:
+        MISSING_KEY_ERROR = "{}: missing".format(key)
+        assert key in problem, MISSING_KEY_ERROR
+    MISSING_QUESTION_ERROR = "question: missing"
+    assert "question" in problem or "context" in problem, MISSING_QUESTION_ERROR
+
+    hand_json = {}
+    for key, value in problem.items():
+
+        # Ids, ratings and change times are stored as they are; ratings
+        # written by the app are floats. Features, deal hashes and the
+        # rendering are recomputed.
+        if key in ["features", "deal_hashes", "rendered"]:
+            continue
+        if key in ["_id", "updated_at"]:
+            hand_json[key] = value
+            continue
+        if key == "elo":
+            NOT_NUMBER_ERROR = "elo: a number is required"
+            assert isinstance(value, (int, float)), NOT_NUMBER_ERROR
+            hand_json[key] = value
+            continue
+
+        try:
+            hand_json[key] = validate_and_parse(key, value)
+        except AssertionError as e:
+            raise AssertionError("{}: {}".format(key, e))
+
+    # The four hands together are the 52 cards.
+    Deal.from_hand_json(hand_json).validate()
+
+    hand_json.setdefault("elo", DEFAULT_ELO)
+    hand_json["features"] = hand_features.compute_features(hand_json)
+    hand_json["deal_hashes"] = deal_hashing.compute_deal_hashes(hand_json)
+
+    return hand_json
+
+####################################################################
+########################## Import ##################################
+####################################################################
+
+def import_file(path, file_format=None, hand_storage=None,
+        batch_size=DEFAULT_BATCH_SIZE, defaults=None, dry_run=False,
+        report_path=None):
+    """
+    Import every problem in a file.
+
+    Parameters:
+        path (string)
+        file_format (string) pbn, lin or jsonl; default from the extension.
+        hand_storage (storage.Storage) default storage.get_storage().
+        batch_size (int) documents per write.
+        defaults (dict) values for keys a record leaves out.
+        dry_run (boolean) validate only, without writing.
+        report_path (string) optional, a JSON line per failed record is
+            appended here.
+
+    Returns:
+        summary (dict) with counts "read", "valid", "inserted", "failed".
+    """
+
+    if file_format is None:
+        extension = os.path.splitext(path)[1].lower()
+        UNKNOWN_FORMAT_ERROR = "cannot tell the format of {}, use --format".format(path)
+        assert extension in FORMATS, UNKNOWN_FORMAT_ERROR
+        file_format = FORMATS[extension]
+
+    if hand_storage is None and not dry_run:
+        hand_storage = storage.get_storage()
+
+    report_file = open(report_path, "a") if report_path else None
+    summary = {"read" : 0, "valid" : 0, "inserted" : 0, "failed" : 0}
+
+    def report_failure(record_number, message):
+        summary["failed"] += 1
+        print("record {}: {}".format(record_number, message))
+        if report_file is not None:
+            report_file.write(json.dumps({"file" : path, "record" : record_number,
+                "error" : message}) + "\n")
+
+    batch, record_numbers = [], []
+
+    # The search index journals these hands as one change, from the
+    # generation before any of them was written (see search_index.py).
+    generation = hand_storage.read_generation() if not dry_run else None
+
+    def write_batch():
+        # Store each problem's HTML with it, so the app serves it without
+        # rendering (see render_hand.py).
+        prerender_hands(batch, store=True)
+        if batch and not dry_run:
+            n_inserted, failures = hand_storage.insert_hands(batch)
+            summary["inserted"] += n_inserted
+            failed_positions = set()
+            for position, message in failures:
+                failed_positions.add(position)
+                report_failure(record_numbers[position], message)
+            for position, hand_json in enumerate(batch):
+                if position not in failed_positions:
+                    search_index.record_change(hand_json, generation=generation)
+        del batch[:]
+        del record_numbers[:]
+
+    try:
+        for record_number, problem in iter_problems(path, file_format):
+            summary["read"] += 1
+            if isinstance(problem, Exception):
+                report_failure(record_number, str(problem))
+                continue
+
+            try:
+                hand_json = record_to_hand_json(problem, defaults)
+            except Exception as e:
+                report_failure(record_number, str(e))
+                continue
+
+            summary["valid"] += 1
+            hand_json["updated_at"] = time.time()
+            batch.append(hand_json)
+            record_numbers.append(record_number)
+            if len(batch) >= batch_size:
+                write_batch()
+
+        write_batch()
+    finally:
+        if report_file is not None:
+            report_file.close()
+
+    # Tell running apps to reload their cached hands.
+    if summary["inserted"]:
+        hand_storage.bump_generation()
+
+    return summary
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("paths", nargs="+", help="files to import")
+    parser.add_argument("--format", choices=["pbn", "lin", "jsonl"],
+            help="file format, default from the extension")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--hidden-hands", help="hidden hands for records without any, e.g. EW")
+    parser.add_argument("--source", help="source for records without one")
+    parser.add_argument("--report", help="append failed records to this JSON lines file")
+    parser.add_argument("--dry-run", action="store_true",
+            help="parse and validate without writing")
+    args = parser.parse_args()
+
+    defaults = {}
+    if args.hidden_hands is not None:
+        defaults["hidden_hands"] = args.hidden_hands
+    if args.source is not None:
+        defaults["source"] = args.source
+
+    for path in args.paths:
+        summary = import_file(path, file_format=args.format,
+                batch_size=args.batch_size, defaults=defaults,
+                dry_run=args.dry_run, report_path=args.report)
+        print("{}: {}".format(path, summary))
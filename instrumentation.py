@@ -0,0 +1,409 @@
+"""
+Per-request stage timing, database round-trip counts and profiling hooks.
+
+Code marks its stages with the stage() context manager or the timed()
+decorator:
+
+    with get_metrics().stage("render"):
+        ...
+
+    @timed("lookup_user")
+    def lookup_user_elo(...):
+
+Each stage records its wall time and the database round trips made in the
+calling thread into histograms; a rerun of session.py (or any request) is
+recorded the same way between start_rerun() and finish_rerun(). Round
+trips are Mongo commands, counted by a pymongo CommandListener which db.py
+registers, and SQLite statements, counted when storage.py opens a
+connection.
+
+Components with their own counters, such as the hand cache or the event
+sink, register a function returning them with register_counters(); they
+are included in every snapshot and dump.
+
+The histograms are dumped, at most every BRIDGE_METRICS_INTERVAL seconds,
+to BRIDGE_METRICS_PATH: Prometheus text format if the path ends in
+".prom", JSON otherwise. With BRIDGE_PROFILE=1 each rerun is run under
+cProfile, and its stats are saved to BRIDGE_PROFILE_DIR for pstats or
+snakeviz. Only one profiler can be active in a process (from Python
+3.12), so one rerun is profiled at a time; reruns in other threads
+meanwhile are timed but not profiled.
+
+Settings are read from environment variables:
+    BRIDGE_METRICS_PATH      default none, e.g. metrics.prom or metrics.json
+    BRIDGE_METRICS_INTERVAL  default 10 (seconds)
+    BRIDGE_PROFILE           default 0
+    BRIDGE_PROFILE_DIR       default profiles
+"""
+import bisect
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import random
+import threading
+import time
+from pymongo import monitoring
+
+# Histogram bucket upper bounds.
+SECONDS_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+        0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+ROUND_TRIP_BUCKETS = [0, 1, 2, 3, 5, 8, 13, 21, 50, 100]
+
+# Samples kept per histogram for quantiles.
+RESERVOIR_SIZE = 1024
+QUANTILES = [0.5, 0.95, 0.99]
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+# Round trips made by each thread so far.
+_thread_state = threading.local()
+
+def count_round_trip(*args):
+    """
+    Count one database round trip in the calling thread. Takes and ignores
+    any arguments, so it can be a sqlite3 trace callback.
+    """
+
+    _thread_state.round_trips = getattr(_thread_state, "round_trips", 0) + 1
+
+def round_trips():
+    """Return the round trips the calling thread has made so far."""
+
+    return getattr(_thread_state, "round_trips", 0)
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Count Mongo commands: per thread as round trips, and per command name.
+
+    pymongo publishes command events in the thread running the command.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = {}
+        self.failures = 0
+
+    def started(self, event):
+        count_round_trip()
+        with self._lock:
+            self.commands[event.command_name] = self.commands.get(
+                    event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        with self._lock:
+            self.failures += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {"commands" : dict(self.commands), "failures" : self.failures}
+
+command_counter = CommandCounter()
+
+class Histogram(object):
+    """
+    Bucketed counts of observed values, Prometheus style, plus a uniform
+    reservoir sample of them for quantiles.
+    """
+
+    def __init__(self, buckets, rng=None):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1) # the last is +Inf.
+        self.count = 0
+        self.sum = 0.0
+        self.reservoir = []
+        self._rng = rng or random.Random(0)
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+        # Algorithm R: every value seen is in the sample with equal chance.
+        if len(self.reservoir) < RESERVOIR_SIZE:
+            self.reservoir.append(value)
+        else:
+            position = self._rng.randrange(self.count)
+            if position < RESERVOIR_SIZE:
+                self.reservoir[position] = value
+
+    def quantile(self, fraction):
+        """Return a quantile estimated from the reservoir, or None."""
+
+        if not self.reservoir:
+            return None
+        ordered = sorted(self.reservoir)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def to_dict(self):
+        result = {
+            "count" : self.count,
+            "sum" : self.sum,
+            "mean" : self.sum / self.count if self.count else None,
+            "buckets" : {str(bound) : count for bound, count in
+                zip(self.buckets + ["+Inf"], self.bucket_counts)},
+        }
+        for fraction in QUANTILES:
+            result["p{}".format(int(100*fraction))] = self.quantile(fraction)
+
+        return result
+
+class Rerun(object):
+    """A request being timed, see Metrics.start_rerun()."""
+
+    def __init__(self, name, profiler=None):
+        self.name = name
+        self.profiler = profiler
+        self.started = time.perf_counter()
+        self.round_trips = round_trips()
+
+class Metrics(object):
+    """
+    Histograms of stage and rerun timings, keyed by metric name and label.
+
+    Histograms:
+        bridge_stage_seconds{stage}          wall time of each stage
+        bridge_stage_db_round_trips{stage}   round trips made in each stage
+        bridge_rerun_seconds{name}           wall time of each rerun
+        bridge_rerun_db_round_trips{name}    round trips made in each rerun
+    """
+
+    def __init__(self, metrics_path=None, dump_interval=10.0, profile=False,
+            profile_dir="profiles"):
+        """
+        Parameters:
+            metrics_path (string) optional, file dump() writes; ".prom" for
+                Prometheus text format, otherwise JSON.
+            dump_interval (float) minimum seconds between maybe_dump() writes.
+            profile (boolean) run each rerun under cProfile.
+            profile_dir (string) where profile stats are saved.
+        """
+
+        self.metrics_path = metrics_path
+        self.dump_interval = dump_interval
+        self.profile = profile
+        self.profile_dir = profile_dir
+
+        self._histograms = {}
+        # name -> function returning a dict of counters.
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._last_dump = time.time()
+        self._reruns = threading.local()
+        # Held by the rerun being profiled.
+        self._profile_lock = threading.Lock()
+
+    def observe(self, name, label_name, label, value, buckets):
+        """Add one value to a histogram, creating it on first use."""
+
+        key = (name, label_name, label)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+        return None
+
+    def register_counters(self, name, counters_function):
+        """
+        Include counters_function(), a dict of counters, under name in every
+        snapshot and dump. Registering a name again replaces its function.
+        """
+
+        with self._lock:
+            self._counters[name] = counters_function
+
+        return None
+
+    def counters(self):
+        """Return the registered counters, as a dict of dicts by name."""
+
+        with self._lock:
+            counters_functions = sorted(self._counters.items())
+
+        return {name : counters_function() for name, counters_function
+                in counters_functions}
+
+    @contextlib.contextmanager
+    def stage(self, stage_name):
+        """Time a stage of the current request."""
+
+        started = time.perf_counter()
+        started_round_trips = round_trips()
+        try:
+            yield
+        finally:
+            self.observe("bridge_stage_seconds", "stage", stage_name,
+                    time.perf_counter() - started, SECONDS_BUCKETS)
+            self.observe("bridge_stage_db_round_trips", "stage", stage_name,
+                    round_trips() - started_round_trips, ROUND_TRIP_BUCKETS)
+
+    def start_rerun(self, name="session"):
+        """
+        Start timing a rerun in the calling thread, profiling it if enabled.
+
+        A rerun which was never finished, e.g. because Streamlit stopped the
+        script, is discarded.
+        """
+
+        self._discard_rerun()
+
+        profiler = None
+        if self.profile and self._profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler, not ours, is active.
+                profiler = None
+                self._profile_lock.release()
+        self._reruns.current = Rerun(name, profiler)
+
+        return None
+
+    def finish_rerun(self):
+        """Record the calling thread's rerun, and save its profile."""
+
+        rerun = getattr(self._reruns, "current", None)
+        if rerun is None:
+            return None
+        self._reruns.current = None
+
+        if rerun.profiler is not None:
+            rerun.profiler.disable()
+            self._profile_lock.release()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            rerun.profiler.dump_stats(os.path.join(self.profile_dir,
+                "{}-{:.6f}-{}.prof".format(rerun.name, time.time(),
+                    threading.get_ident())))
+
+        self.observe("bridge_rerun_seconds", "name", rerun.name,
+                time.perf_counter() - rerun.started, SECONDS_BUCKETS)
+        self.observe("bridge_rerun_db_round_trips", "name", rerun.name,
+                round_trips() - rerun.round_trips, ROUND_TRIP_BUCKETS)
+
+        return None
+
+    def _discard_rerun(self):
+        rerun = getattr(self._reruns, "current", None)
+        if rerun is not None and rerun.profiler is not None:
+            rerun.profiler.disable()
+            self._profile_lock.release()
+        self._reruns.current = None
+
+    def snapshot(self):
+        """Return every histogram, the registered counters and the Mongo
+        command counts, as a dict."""
+
+        with self._lock:
+            histograms = {}
+            for (name, label_name, label), histogram in sorted(self._histograms.items()):
+                histograms.setdefault(name, {})[label] = histogram.to_dict()
+
+        return {"histograms" : histograms, "counters" : self.counters(),
+                "mongo" : command_counter.snapshot(), "time" : time.time()}
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, label_name, label), histogram in sorted(self._histograms.items()):
+                if name not in seen:
+                    lines.append("# TYPE {} histogram".format(name))
+                    seen.add(name)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ["+Inf"],
+                        histogram.bucket_counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(name,
+                        label_name, label, bound, cumulative))
+                lines.append('{}_sum{{{}="{}"}} {}'.format(name, label_name, label,
+                    histogram.sum))
+                lines.append('{}_count{{{}="{}"}} {}'.format(name, label_name, label,
+                    histogram.count))
+
+        mongo = command_counter.snapshot()
+        lines.append("# TYPE bridge_mongo_commands_total counter")
+        for command_name, count in sorted(mongo["commands"].items()):
+            lines.append('bridge_mongo_commands_total{{command="{}"}} {}'.format(
+                command_name, count))
+        lines.append("# TYPE bridge_mongo_command_failures_total counter")
+        lines.append("bridge_mongo_command_failures_total {}".format(mongo["failures"]))
+
+        # Registered counters are exported as gauges, as some, such as a
+        # cache size, go down as well as up.
+        lines.append("# TYPE bridge_counter gauge")
+        for name, counters in self.counters().items():
+            for counter_name, value in sorted(counters.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('bridge_counter{{source="{}",counter="{}"}} {}'.format(
+                        name, counter_name, value))
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path=None):
+        """Write the metrics to path, default metrics_path, atomically."""
+
+        path = path or self.metrics_path
+        NO_PATH_ERROR = "no metrics path; set BRIDGE_METRICS_PATH"
+        assert path, NO_PATH_ERROR
+
+        if path.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=2)
+
+        # Each thread has its own temporary file, so dumps do not collide.
+        temporary_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(temporary_path, "w") as f:
+            f.write(text)
+        os.replace(temporary_path, path)
+        self._last_dump = time.time()
+
+        return None
+
+    def maybe_dump(self):
+        """Dump if a metrics path is set and dump_interval has passed."""
+
+        if self.metrics_path and time.time() - self._last_dump >= self.dump_interval:
+            self.dump()
+
+        return None
+
+def get_metrics():
+    """
+    Return the process-wide Metrics, configured from environment variables,
+    creating it on first use.
+    """
+
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                environ = os.environ
+                _metrics = Metrics(metrics_path=environ.get("BRIDGE_METRICS_PATH"),
+                        dump_interval=float(environ.get("BRIDGE_METRICS_INTERVAL", 10)),
+                        profile=environ.get("BRIDGE_PROFILE") == "1",
+                        profile_dir=environ.get("BRIDGE_PROFILE_DIR", "profiles"))
+
+    return _metrics
+
+def timed(stage_name):
+    """Decorator timing every call of a function as a stage."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with get_metrics().stage(stage_name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
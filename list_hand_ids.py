@@ -3,16 +3,14 @@ CLI to add new hands to the dataset efficienctly.
 """
 import json
 import os
-import pymongo
 import bson
+import db
 
 def list_hand_ids():
     """ wrapper function to enter hands """
 
     # Load existing hands.
-    client = pymongo.MongoClient()
-    db = client["bridge_problem_database"]
-    hands_collection = db["hands"]
+    hands_collection = db.get_hands_collection()
 
     for hand in hands_collection.find():
 
@@ -0,0 +1,89 @@
+"""
+CLI to copy hands, users and events from one storage backend to another.
+
+Documents are streamed from the source and written to the destination in
+batches. Hands and users replace documents with the same _id or username,
+and events already in the destination are skipped, so a migration can be
+run again, e.g. after it was interrupted. The destination's hands
+generation is bumped, so running apps re-read their hands.
+
+Usage:
+    python migrate_storage.py --from mongo --to sqlite
+    python migrate_storage.py --from sqlite --to mongo --sqlite-path /data/bridge.sqlite3
+"""
+import argparse
+import storage
+
+DEFAULT_BATCH_SIZE = 1000
+KINDS = ["hands", "users", "events"]
+
+def iter_batches(documents, batch_size):
+    """Yield lists of up to batch_size documents."""
+
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def migrate(source, destination, kinds=KINDS, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Copy documents between backends.
+
+    Parameters:
+        source (storage.Storage)
+        destination (storage.Storage)
+        kinds (string []) any of hands, users, events.
+        batch_size (int) documents per write.
+
+    Returns:
+        counts (dict) kind -> documents copied.
+    """
+
+    operations = {
+        "hands" : (source.iter_hands, destination.put_hands),
+        "users" : (source.iter_users, destination.put_users),
+        "events" : (source.iter_events, destination.insert_events),
+    }
+
+    destination.ensure_indexes()
+
+    counts = {}
+    for kind in kinds:
+        read, write = operations[kind]
+        counts[kind] = 0
+        for batch in iter_batches(read(), batch_size):
+            write(batch)
+            counts[kind] += len(batch)
+        print("{}: {} documents".format(kind, counts[kind]))
+
+    if counts.get("hands"):
+        destination.bump_generation()
+
+    return counts
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--from", dest="source", required=True,
+            choices=["mongo", "sqlite"])
+    parser.add_argument("--to", dest="destination", required=True,
+            choices=["mongo", "sqlite"])
+    parser.add_argument("--sqlite-path", default=None,
+            help="SQLite file, default BRIDGE_SQLITE_PATH or {}".format(
+                storage.DEFAULT_SQLITE_PATH))
+    parser.add_argument("--kinds", nargs="+", default=KINDS, choices=KINDS)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    SAME_BACKEND_ERROR = "--from and --to must be different backends"
+    assert args.source != args.destination, SAME_BACKEND_ERROR
+
+    source = storage.open_storage(args.source, args.sqlite_path)
+    destination = storage.open_storage(args.destination, args.sqlite_path)
+    migrate(source, destination, args.kinds, args.batch_size)
+    source.close()
+    destination.close()
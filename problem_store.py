@@ -0,0 +1,294 @@
+"""
+Read-only binary problem store, compiled from the database for serving.
+
+Exporting writes every problem to one file:
+
+    header     HEADER_DTYPE: magic, version, counts and section offsets.
+    records    NumPy structured array of RECORD_DTYPE, one fixed-width
+               record per problem: the four seat masks of deal.py (N E S W),
+               elo, dealer and flags. Records are sorted by elo.
+    elos       float64 array of the record elos, contiguous, so sample()
+               searches the mapped file without copying a strided field.
+    offsets    uint64 array of len(TEXT_FIELDS) * n_problems + 1 offsets
+               into the blob; text field j of problem i is
+               blob[offsets[i*F + j] : offsets[i*F + j + 1]].
+    blob       the text fields, UTF-8, one after another.
+
+ProblemStore maps the file with mmap and reads its sections as NumPy
+arrays over the mapping (np.frombuffer), so opening is O(1), any
+problem is read by index without parsing the rest, and worker processes
+on one machine share a single page-cached copy. hand_json() rebuilds the
+document render_hand.render_hand_json() takes, without JSON or a database
+round trip, and sample() chooses a problem near a rating with a binary
+search of the sorted elos.
+
+The store is a snapshot: elo changes made while serving are not written
+back to it. Export again to refresh it; the file is replaced atomically,
+and processes which opened the old file keep reading it.
+
+Usage:
+    python problem_store.py export problems.store
+    python problem_store.py export problems.store --storage sqlite
+    python problem_store.py show problems.store --index 0
+"""
+import argparse
+import json
+import mmap
+import os
+import random
+import numpy as np
+from bson import ObjectId
+from deal import SEATS, Deal, mask_to_hand_list
+import storage
+
+MAGIC = b"BRIDGEPS"
+VERSION = 1
+
+# Text fields, in blob order. Absent fields are flagged in "present".
+TEXT_FIELDS = ["_id", "question", "context", "auction", "correct_answer",
+        "explanation", "notes", "source", "hidden_hands"]
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("n_fields", "<u4"),
+    ("n_problems", "<u8"),
+    ("records_offset", "<u8"),
+    ("elos_offset", "<u8"),
+    ("offsets_offset", "<u8"),
+    ("blob_offset", "<u8"),
+    ("blob_size", "<u8"),
+])
+
+RECORD_DTYPE = np.dtype([
+    ("masks", "<u8", (4,)), # N E S W, see deal.py.
+    ("elo", "<f8"),
+    ("dealer", "u1"), # index into SEATS, NO_DEALER if none.
+    ("object_id", "u1"), # 1 if _id is an ObjectId, stored as hex.
+    ("present", "<u2"), # bit j set if TEXT_FIELDS[j] is in the document.
+])
+
+NO_DEALER = 255
+
+# Sections start on 8-byte boundaries, so mapped arrays are aligned.
+ALIGNMENT = 8
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def problem_to_record(hand_json):
+    """
+    Return (record, texts) for one hand document.
+
+    Returns:
+        record (tuple) fields of RECORD_DTYPE.
+        texts (bytes []) UTF-8 text fields, in TEXT_FIELDS order.
+    """
+
+    masks = Deal.from_hand_json(hand_json).masks
+    dealer = hand_json.get("dealer")
+    dealer_index = SEATS.index(dealer) if dealer in list(SEATS) else NO_DEALER
+
+    texts = []
+    present = 0
+    for field_index, field in enumerate(TEXT_FIELDS):
+        value = hand_json.get(field)
+        if value is not None:
+            present |= 1 << field_index
+            value = str(value)
+        texts.append((value or "").encode("utf-8"))
+
+    record = (masks, float(hand_json.get("elo", 1200)), dealer_index,
+            int(isinstance(hand_json.get("_id"), ObjectId)), present)
+
+    return record, texts
+
+def export(hand_jsons, path):
+    """
+    Write hand documents to a problem store file.
+
+    Parameters:
+        hand_jsons (iterable of json) e.g. storage.get_storage().iter_hands().
+        path (string) written to path + ".tmp", then moved into place.
+
+    Returns:
+        n_problems (int)
+    """
+
+    records = []
+    texts = []
+    for hand_json in hand_jsons:
+        record, problem_texts = problem_to_record(hand_json)
+        records.append(record)
+        texts.append(problem_texts)
+
+    records = np.array(records, dtype=RECORD_DTYPE)
+    order = np.argsort(records["elo"], kind="stable")
+    records = records[order]
+
+    # Offsets of every text field, in the sorted order.
+    lengths = np.array([[len(text) for text in texts[index]] for index in order],
+            dtype=np.uint64).reshape(-1)
+    offsets = np.zeros(len(lengths) + 1, dtype="<u8")
+    np.cumsum(lengths, out=offsets[1:])
+
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header["magic"] = MAGIC
+    header["version"] = VERSION
+    header["n_fields"] = len(TEXT_FIELDS)
+    header["n_problems"] = len(records)
+    header["records_offset"] = _aligned(HEADER_DTYPE.itemsize)
+    elos = np.ascontiguousarray(records["elo"], dtype="<f8")
+    header["elos_offset"] = _aligned(int(header["records_offset"][0]) + records.nbytes)
+    header["offsets_offset"] = _aligned(int(header["elos_offset"][0]) + elos.nbytes)
+    header["blob_offset"] = _aligned(int(header["offsets_offset"][0]) + offsets.nbytes)
+    header["blob_size"] = int(offsets[-1])
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        for section, offset in [(header, 0),
+                (records, header["records_offset"][0]),
+                (elos, header["elos_offset"][0]),
+                (offsets, header["offsets_offset"][0])]:
+            f.seek(int(offset))
+            f.write(section.tobytes())
+        f.seek(int(header["blob_offset"][0]))
+        for index in order:
+            f.write(b"".join(texts[index]))
+    os.replace(temporary_path, path)
+
+    return len(records)
+
+class ProblemStore(object):
+    """
+    A problem store file, memory-mapped read-only.
+
+    Attributes:
+        records (np.ndarray) RECORD_DTYPE, sorted by elo, over the mapping.
+        elos (np.ndarray) float64 record elos, ascending, over the mapping.
+    """
+
+    def __init__(self, path):
+        """
+        Parameters:
+            path (string) file written by export().
+        """
+
+        self.path = path
+        header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+        NOT_A_STORE_ERROR = "{} is not a problem store".format(path)
+        assert len(header) == 1 and header["magic"][0] == MAGIC, NOT_A_STORE_ERROR
+        VERSION_ERROR = "{} has version {}, expected {}".format(path,
+                header["version"][0], VERSION)
+        assert header["version"][0] == VERSION, VERSION_ERROR
+        header = header[0]
+
+        n_problems = int(header["n_problems"])
+        self.n_fields = int(header["n_fields"])
+        # One read-only mapping of the whole file, which always holds at
+        # least the header; the sections are arrays over it.
+        with open(path, "rb") as f:
+            self._mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.records = np.frombuffer(self._mapping, dtype=RECORD_DTYPE,
+                count=n_problems, offset=int(header["records_offset"]))
+        self.elos = np.frombuffer(self._mapping, dtype="<f8",
+                count=n_problems, offset=int(header["elos_offset"]))
+        self.offsets = np.frombuffer(self._mapping, dtype="<u8",
+                count=n_problems*self.n_fields + 1,
+                offset=int(header["offsets_offset"]))
+        self.blob = np.frombuffer(self._mapping, dtype=np.uint8,
+                count=int(header["blob_size"]), offset=int(header["blob_offset"]))
+
+    def __len__(self):
+        return len(self.records)
+
+    def text(self, index, field):
+        """Return one text field of a problem, None if it is absent."""
+
+        field_index = TEXT_FIELDS.index(field)
+        if not self.records[index]["present"] >> field_index & 1:
+            return None
+
+        position = index*self.n_fields + field_index
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+    def hand_json(self, index):
+        """
+        Return problem index as a hand document, in the layout of the hands
+        collection.
+        """
+
+        record = self.records[index]
+        hand_json = {key : mask_to_hand_list(int(mask))
+                for key, mask in zip(["n_hand", "e_hand", "s_hand", "w_hand"],
+                    record["masks"])}
+        hand_json["elo"] = float(record["elo"])
+        if record["dealer"] != NO_DEALER:
+            hand_json["dealer"] = SEATS[record["dealer"]]
+
+        # One slice of the blob covers every text field of the problem.
+        field_offsets = self.offsets[index*self.n_fields:
+                (index + 1)*self.n_fields + 1].tolist()
+        start = field_offsets[0]
+        data = self.blob[start:field_offsets[-1]].tobytes()
+        present = int(record["present"])
+        for field_index, field in enumerate(TEXT_FIELDS):
+            if present >> field_index & 1:
+                hand_json[field] = data[field_offsets[field_index] - start:
+                        field_offsets[field_index + 1] - start].decode("utf-8")
+
+        if record["object_id"]:
+            hand_json["_id"] = ObjectId(hand_json["_id"])
+
+        return hand_json
+
+    def sample(self, player_elo, window=200, rng=random):
+        """
+        Return the index of a random problem rated within window of
+        player_elo, or of the nearest rated one if there is none.
+        """
+
+        EMPTY_STORE_ERROR = "the problem store is empty"
+        assert len(self), EMPTY_STORE_ERROR
+
+        low = int(np.searchsorted(self.elos, player_elo - window, side="left"))
+        high = int(np.searchsorted(self.elos, player_elo + window, side="right"))
+        if low < high:
+            return rng.randrange(low, high)
+
+        nearest = min(low, len(self) - 1)
+        if nearest > 0 and (player_elo - self.elos[nearest - 1]
+                < self.elos[nearest] - player_elo):
+            nearest -= 1
+        return nearest
+
+    def close(self):
+        """
+        Unmap the file. Raises BufferError, and leaves the file mapped, if
+        arrays read from the store, e.g. a record, are still referenced.
+        """
+
+        self.records = self.offsets = self.blob = self.elos = None
+        self._mapping.close()
+
+        return None
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["export", "show"])
+    parser.add_argument("path", help="problem store file")
+    parser.add_argument("--storage", choices=["mongo", "sqlite"], default=None,
+            help="export: backend to read, default BRIDGE_STORAGE")
+    parser.add_argument("--index", type=int, default=0, help="show: problem index")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        source = (storage.open_storage(args.storage) if args.storage
+                else storage.get_storage())
+        n_problems = export(source.iter_hands(), args.path)
+        print("{} problems, {} bytes".format(n_problems, os.path.getsize(args.path)))
+    else:
+        problem_store = ProblemStore(args.path)
+        print(json.dumps(problem_store.hand_json(args.index), default=str, indent=2))
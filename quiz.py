@@ -0,0 +1,435 @@
+"""
+The quiz, independent of the frontend.
+
+A session is shown a problem rated near the player, answers it, and the
+answer is graded against the hand that was shown; the player and hand elos
+are then updated. session.py (Streamlit) and server.py (HTTP) both drive
+these functions, and Quiz bundles them with the process-wide objects they
+need for a frontend which keeps sessions server-side.
+"""
+import datetime
+import threading
+import elo
+import event_sink
+import rating_updates
+import storage
+from hand_cache import HandCache
+from hand_selection import EloIndex
+from instrumentation import get_metrics, timed
+from render_hand import render_hand_json
+from session_state import ShownHandStore, shown_record
+
+N_SESSION_LOCKS = 64
+
+def test_if_correct_answer(user_answer, correct_answer):
+    """Return True if user gave the correect answer
+
+    Parameters:
+    -----------
+    user_answer (string)
+    correct_answer (string)
+
+    Returns:
+    correct (Boolean)
+
+    Currently, we validate by checking for an exact but case-insensitive
+    string match. As a future direction we should consider cases where
+    more flexibility may be desired, for example allowing "F" (false) to
+    count when "N" (no) is the correct answer.
+    """
+
+    return user_answer.lower() == correct_answer.lower()
+
+@timed("lookup_user")
+def lookup_user_elo(username, user_storage, rating_updater=None):
+    """Lookup a user's ELO rating.
+
+    Parameters:
+    -----------
+    username (string)
+    user_storage (storage.Storage)
+    rating_updater (rating_updates.RatingUpdater) optional, whose changes
+        not yet written are added.
+
+    Returns:
+    ----------
+    player_elo (numeric) e.g. 1200
+    """
+
+    pending_delta = 0.0
+    if rating_updater is None:
+        query_result = user_storage.get_user(username)
+    else:
+        # Read the stored elo and the change not yet written with no
+        # write in between, so the change counts once.
+        with rating_updater.paused_writes():
+            query_result = user_storage.get_user(username)
+            pending_delta = rating_updater.pending_user_delta(username)
+
+    if query_result:
+        player_elo = query_result["elo"]
+    else:
+        player_elo = 1200
+
+    player_elo += pending_delta
+
+    return player_elo
+
+@timed("lookup_shown")
+def lookup_shown_record(shown_hand_store, session_key, username,
+        event_storage, sink):
+    """Return the record of the hand on screen for this session, or None.
+
+    Parameters:
+    -----------
+    shown_hand_store (session_state.ShownHandStore)
+    session_key (hashable) identifies the session, e.g. (session id, username).
+    username (string)
+    event_storage (storage.Storage)
+    sink (event_sink.EventSink)
+
+    Returns:
+    ----------
+    record (dict) with hand_id, correct_answer and answer_key, or None.
+
+    The record is normally in the store. Otherwise, the user's most recent
+    "shown" event is read with the indexed fallback query, and the record
+    is marked answered if the user answered that hand since, e.g. in
+    another session. Guests share one username, so there is no fallback
+    for them.
+    """
+
+    record = shown_hand_store.get(session_key)
+    if record is not None or username == "guest":
+        return record
+
+    # The shown event may still be queued in the event sink.
+    sink.flush()
+    shown_event = event_storage.last_shown_event(username)
+    if shown_event is None:
+        return None
+
+    answer_event = event_storage.answer_since(username, shown_event["hand_id"],
+            shown_event["timestamp"])
+    record = shown_record(shown_event, answered=answer_event is not None)
+    shown_hand_store.set(session_key, record)
+
+    return record
+
+@timed("log_shown")
+def log_showing_hand(hand_json, username, sink):
+    """Log that a hand was shown to the user as an event.
+
+    Parameters:
+    -----------
+    hand_json (json)
+    username (string)
+    sink (event_sink.EventSink) buffered writer for events.
+
+    Returns:
+    ------------
+    event_record (json)
+
+    Queues an event with
+    event_type "shown", username, hand_id, correct_answer, timestamp.
+    The page does not wait for it to be written.
+
+    Returns the event record, including its _id.
+    """
+
+    event_record = {
+        "event_type" : "shown",
+        "username" : username,
+        "hand_id" : hand_json["_id"],
+        "correct_answer" : hand_json["correct_answer"],
+        "timestamp" : datetime.datetime.now().timestamp()
+    }
+    sink.put(event_record)
+
+    return event_record
+
+def log_answer(hand_id, username, user_answer, user_was_correct, sink,
+        player_elo=None, hand_elo=None):
+    """Log a user's answer to a hand as an event.
+
+    Parameters:
+    -----------
+    hand_id (hand _id) the hand that was answered.
+    username (string)
+    user_answer (string)
+    user_was_correct (boolean)
+    sink (event_sink.EventSink) buffered writer for events.
+    player_elo, hand_elo (float) optional, the ratings the elo update was
+        computed from.
+
+    Returns:
+    ------------
+    None
+
+    Queues an event with event_type "answer",
+    username, hand_id, user_answer, user_was_correct, timestamp, and the
+    ratings if given. These rows are the history replay_ratings.py
+    recomputes ratings from.
+    """
+
+    event_record = {
+        "event_type" : "answer",
+        "username" : username,
+        "hand_id" : hand_id,
+        "user_answer" : user_answer,
+        "user_was_correct" : bool(user_was_correct),
+        "timestamp" : datetime.datetime.now().timestamp()
+    }
+    if player_elo is not None:
+        event_record["player_elo"] = player_elo
+    if hand_elo is not None:
+        event_record["hand_elo"] = hand_elo
+    sink.put(event_record)
+
+    return None
+
+@timed("grade_answer")
+def grade_answer(shown, username, user_answer, player_elo, rating_updater,
+        hand_cache, elo_index, sink):
+    """Grade an answer against the hand shown, and update both elos.
+
+    Parameters:
+    -----------
+    shown (dict) the shown hand record, see session_state.py.
+    username (string)
+    user_answer (string)
+    player_elo (float)
+    rating_updater (rating_updates.RatingUpdater)
+    hand_cache (hand_cache.HandCache)
+    elo_index (hand_selection.EloIndex)
+    sink (event_sink.EventSink)
+
+    Returns:
+    ----------
+    (user_was_correct, new_player_elo, new_hand_elo), or None if the hand
+    was deleted since it was shown; it is then dropped from the elo index,
+    and nothing is logged or rated.
+
+    The answer is logged, so ratings can be recomputed from the event
+    history. The elo changes are added to the stored elos rather than
+    overwriting them, so concurrent answers to a hand all count. Guests
+    share one username, so their elo is not stored.
+    """
+
+    user_was_correct = test_if_correct_answer(user_answer, shown["correct_answer"])
+    hand_id = shown["hand_id"]
+
+    # Calculate new player and hand ELO scores, from the hand's current
+    # elo: other processes' answers change it without telling this cache.
+    # The stored elo and this process's pending change are read with no
+    # write in between, so the change counts once.
+    with rating_updater.paused_writes():
+        hand_elo = hand_cache.read_elo(hand_id,
+                rating_updater.pending_hand_delta(hand_id))
+    if hand_elo is None:
+        elo_index.remove(hand_id)
+        return None
+    new_player_elo, new_hand_elo = elo.get_new_elos(player_elo, hand_elo,
+            user_was_correct)
+
+    log_answer(hand_id=hand_id, username=username, user_answer=user_answer,
+            user_was_correct=user_was_correct, sink=sink,
+            player_elo=player_elo, hand_elo=hand_elo)
+
+    # Add the changes to the stored player and hand ELO, and to the
+    # in-process copies, which other threads may have changed since.
+    hand_delta = new_hand_elo - hand_elo
+    rating_updater.add(hand_id, hand_delta,
+            username if username != "guest" else None,
+            new_player_elo - player_elo)
+    cached_elo = hand_cache.add_elo(hand_id, hand_delta)
+    if cached_elo is not None:
+        new_hand_elo = cached_elo
+    elo_index.update(hand_id, new_hand_elo)
+
+    return user_was_correct, new_player_elo, new_hand_elo
+
+@timed("choose_hand")
+def choose_hand(hand_cache, elo_index, player_elo, exclude=None):
+    """Return the next hand document, rated near the player, or None if
+    there are no hands.
+
+    The hand document comes from the in-process cache, which is only read
+    from storage on a miss or after hands were added or edited. Hands
+    deleted since the index was read are dropped from it.
+    """
+
+    while True:
+        hand_id = elo_index.sample(player_elo, exclude=exclude)
+        if hand_id is None:
+            return None
+        hand_json = hand_cache.get(hand_id)
+        if hand_json is not None:
+            return hand_json
+        elo_index.remove(hand_id)
+
+@timed("refresh_elo_index")
+def refresh_elo_index(elo_index, hand_cache, app_storage):
+    """Re-read the elo index if hands were added or edited since it was read."""
+
+    if elo_index.generation != hand_cache.generation:
+        elo_index.reload_from_storage(app_storage)
+        elo_index.generation = hand_cache.generation
+
+    return None
+
+def show_hand(hand_json, username, session_key, shown_hand_store, sink):
+    """Log that a hand is shown, and remember it for grading the answer.
+
+    Returns:
+    ----------
+    shown (dict) the shown hand record.
+    """
+
+    shown_event = log_showing_hand(hand_json=hand_json, username=username,
+            sink=sink)
+    shown = shown_record(shown_event)
+    shown_hand_store.set(session_key, shown)
+
+    return shown
+
+class Quiz(object):
+    """
+    The quiz for a frontend which keeps sessions server-side.
+
+    Every method is blocking and thread-safe; requests of one user (of one
+    session, for guests) are handled one at a time, so an answer submitted
+    twice, from one session or several, is graded once.
+    """
+
+    def __init__(self, app_storage, hand_cache, elo_index, shown_hand_store, sink,
+            rating_updater):
+        """
+        Parameters:
+            app_storage (storage.Storage)
+            hand_cache (hand_cache.HandCache)
+            elo_index (hand_selection.EloIndex)
+            shown_hand_store (session_state.ShownHandStore)
+            sink (event_sink.EventSink)
+            rating_updater (rating_updates.RatingUpdater)
+        """
+
+        self.storage = app_storage
+        self.hand_cache = hand_cache
+        self.elo_index = elo_index
+        self.shown_hand_store = shown_hand_store
+        self.sink = sink
+        self.rating_updater = rating_updater
+        self._session_locks = [threading.Lock() for _ in range(N_SESSION_LOCKS)]
+
+    @classmethod
+    def create(cls, app_storage=None, sink=None, rating_updater=None):
+        """
+        Build the quiz on a storage backend, default storage.get_storage(),
+        an event sink, default event_sink.get_event_sink(), and a rating
+        updater, default rating_updates.get_rating_updater() or, for a
+        storage backend passed in, one writing every answer at once.
+        """
+
+        if rating_updater is None:
+            rating_updater = (rating_updates.get_rating_updater() if app_storage is None
+                    else rating_updates.RatingUpdater(app_storage))
+        app_storage = app_storage or storage.get_storage()
+        app_storage.ensure_indexes()
+        hand_cache = HandCache(app_storage)
+        elo_index = EloIndex.from_storage(app_storage)
+        elo_index.generation = hand_cache.generation
+
+        return cls(app_storage, hand_cache, elo_index, ShownHandStore(),
+                sink or event_sink.get_event_sink(), rating_updater)
+
+    def _session_lock(self, session_key, username):
+        # Lock per user, so the sessions of one user see each other's
+        # answers; guests share one username, so lock per session.
+        lock_key = session_key if username == "guest" else username
+        return self._session_locks[hash(lock_key) % N_SESSION_LOCKS]
+
+    def next_problem(self, session_key, username):
+        """
+        Return the problem for this session: the hand on screen if it is
+        unanswered, otherwise a new hand rated near the player.
+
+        Returns:
+            problem (dict) hand_id, html, question, player_elo, hand_elo;
+            None if there are no hands to show.
+        """
+
+        with self._session_lock(session_key, username):
+            player_elo = lookup_user_elo(username, self.storage,
+                    self.rating_updater)
+            shown = lookup_shown_record(self.shown_hand_store, session_key,
+                    username, self.storage, self.sink)
+
+            hand_json = None
+            if shown is not None and not shown.get("answered"):
+                hand_json = self.hand_cache.get(shown["hand_id"])
+            if hand_json is None:
+                exclude = shown["hand_id"] if shown is not None else None
+                hand_json = choose_hand(self.hand_cache, self.elo_index,
+                        player_elo, exclude)
+                if hand_json is None:
+                    return None
+                show_hand(hand_json, username, session_key,
+                        self.shown_hand_store, self.sink)
+
+            refresh_elo_index(self.elo_index, self.hand_cache, self.storage)
+
+        with get_metrics().stage("render"):
+            html = render_hand_json(hand_json)
+
+        return {
+            "hand_id" : str(hand_json["_id"]),
+            "html" : html,
+            "question" : hand_json.get("question", hand_json.get("context", "")),
+            "player_elo" : player_elo,
+            "hand_elo" : hand_json["elo"],
+        }
+
+    def submit_answer(self, session_key, username, user_answer):
+        """
+        Grade an answer to the hand on screen.
+
+        Returns:
+            result (dict) correct, correct_answer, player_elo, hand_elo; or
+            None if the session has no unanswered hand, including when the
+            hand on screen was deleted, so next_problem() shows a new one.
+        """
+
+        with self._session_lock(session_key, username):
+            shown = lookup_shown_record(self.shown_hand_store, session_key,
+                    username, self.storage, self.sink)
+            if shown is None or shown.get("answered"):
+                return None
+
+            player_elo = lookup_user_elo(username, self.storage,
+                    self.rating_updater)
+            graded = grade_answer(shown, username, user_answer, player_elo,
+                    self.rating_updater, self.hand_cache, self.elo_index, self.sink)
+            if graded is None:
+                self.shown_hand_store.pop(session_key)
+                return None
+            user_was_correct, new_player_elo, new_hand_elo = graded
+            self.shown_hand_store.set(session_key, dict(shown, answered=True))
+
+        return {
+            "correct" : user_was_correct,
+            "correct_answer" : shown["correct_answer"],
+            "player_elo" : new_player_elo,
+            "hand_elo" : new_hand_elo,
+        }
+
+    def stats(self):
+        """Return the cache, sink and session counters, as a dict."""
+
+        return {
+            "hand_cache" : self.hand_cache.stats(),
+            "event_sink" : self.sink.stats(),
+            "rating_updater" : self.rating_updater.stats(),
+            "sessions" : len(self.shown_hand_store),
+            "hands" : len(self.elo_index),
+        }
@@ -0,0 +1,275 @@
+"""
+Rating systems for players and hands, behind one interface.
+
+A player answering a hand is treated as a game between the two: the
+player wins if the answer is correct, the hand wins otherwise. Every
+system offers:
+
+    initial_rating()                      rating of a new player or hand
+    expected_score(player, hand)          probability the player is correct
+    update(player, hand, user_was_correct)
+                                          new (player, hand) after one answer
+    rate_period(ratings, results)         new ratings after a batch of
+                                          answers, rated together
+
+Backends:
+    EloRatingSystem       elo.get_new_elos, as used by quiz.py
+    Glicko2RatingSystem   Glicko-2 (Glickman, 2012), tracking rating
+                          deviation and volatility, so new players and new
+                          hands move quickly and settle as evidence grows.
+
+These backends are for offline comparison (benchmarks/rating_systems.py)
+only. Grading in quiz.py and the replay in replay_ratings.py call elo.py
+directly, and storage keeps one elo per player and hand, with no
+deviation or volatility. Rating live answers with Glicko-2 needs those
+fields stored first.
+"""
+import collections
+import math
+import elo
+
+INITIAL_RATING = 1200
+
+# rating (float), deviation (float or None), volatility (float or None).
+Rating = collections.namedtuple("Rating", ["rating", "deviation", "volatility"])
+
+class RatingSystem(object):
+    """Base class of the rating systems; see the module docstring."""
+
+    name = "base"
+
+    def initial_rating(self):
+        raise NotImplementedError
+
+    def expected_score(self, player, hand):
+        raise NotImplementedError
+
+    def update(self, player, hand, user_was_correct):
+        raise NotImplementedError
+
+    def rate_period(self, ratings, results):
+        """
+        Rate a batch of answers together.
+
+        Parameters:
+            ratings (dict) key -> Rating, for players and hands. Keys which
+                are missing get initial_rating().
+            results (list) (player_key, hand_key, user_was_correct) tuples.
+
+        Returns:
+            new_ratings (dict) key -> Rating, for every key in ratings or
+            results.
+
+        The default applies update() to each answer in order.
+        """
+
+        new_ratings = dict(ratings)
+        for player_key, hand_key, user_was_correct in results:
+            player = new_ratings.get(player_key) or self.initial_rating()
+            hand = new_ratings.get(hand_key) or self.initial_rating()
+            new_ratings[player_key], new_ratings[hand_key] = self.update(
+                    player, hand, user_was_correct)
+
+        return new_ratings
+
+class EloRatingSystem(RatingSystem):
+    """The existing elo.get_new_elos update, with a fixed K."""
+
+    name = "elo"
+
+    def __init__(self, K=30):
+        self.K = K
+
+    def initial_rating(self):
+        return Rating(INITIAL_RATING, None, None)
+
+    def expected_score(self, player, hand):
+        """Probability the player is correct, as used by elo.get_new_elos."""
+
+        return 1.0 / (1 + math.pow(10, (hand.rating - player.rating) / 400))
+
+    def update(self, player, hand, user_was_correct):
+        new_player_elo, new_hand_elo = elo.get_new_elos(player.rating,
+                hand.rating, user_was_correct, K=self.K)
+        return Rating(new_player_elo, None, None), Rating(new_hand_elo, None, None)
+
+    def rate_period(self, ratings, results):
+        """
+        Rate a batch of answers against the ratings at the start of the
+        period, and apply the sum of each key's changes at the end.
+        """
+
+        deltas = collections.defaultdict(float)
+        for player_key, hand_key, user_was_correct in results:
+            player = ratings.get(player_key) or self.initial_rating()
+            hand = ratings.get(hand_key) or self.initial_rating()
+            new_player, new_hand = self.update(player, hand, user_was_correct)
+            deltas[player_key] += new_player.rating - player.rating
+            deltas[hand_key] += new_hand.rating - hand.rating
+
+        new_ratings = dict(ratings)
+        for key, delta in deltas.items():
+            old = ratings.get(key) or self.initial_rating()
+            new_ratings[key] = Rating(old.rating + delta, None, None)
+
+        return new_ratings
+
+class Glicko2RatingSystem(RatingSystem):
+    """
+    Glicko-2, following Glickman, "Example of the Glicko-2 system" (2012).
+
+    Ratings are given on the Elo-like scale; internally they are converted
+    with mu = (rating - 1500) / 173.7178.
+    """
+
+    name = "glicko2"
+    SCALE = 173.7178
+    CENTER = 1500
+
+    def __init__(self, tau=0.5, initial_deviation=350, initial_volatility=0.06,
+            epsilon=0.000001):
+        """
+        Parameters:
+            tau (float) constrains volatility changes, typically 0.3 to 1.2.
+            initial_deviation (float) deviation of a new player or hand.
+            initial_volatility (float) volatility of a new player or hand.
+            epsilon (float) convergence tolerance of the volatility update.
+        """
+
+        self.tau = tau
+        self.initial_deviation = initial_deviation
+        self.initial_volatility = initial_volatility
+        self.epsilon = epsilon
+
+    def initial_rating(self):
+        return Rating(INITIAL_RATING, self.initial_deviation, self.initial_volatility)
+
+    def _g(self, phi):
+        return 1.0 / math.sqrt(1 + 3*phi*phi / (math.pi*math.pi))
+
+    def _expected(self, mu, mu_opponent, g_opponent):
+        return 1.0 / (1 + math.exp(-g_opponent*(mu - mu_opponent)))
+
+    def expected_score(self, player, hand):
+        """Probability the player is correct."""
+
+        mu = (player.rating - self.CENTER) / self.SCALE
+        mu_hand = (hand.rating - self.CENTER) / self.SCALE
+        phi_hand = hand.deviation / self.SCALE
+
+        return self._expected(mu, mu_hand, self._g(phi_hand))
+
+    def _rate(self, rating, games):
+        """
+        Return the new Rating after a period of games.
+
+        Parameters:
+            rating (Rating)
+            games (list) (opponent Rating, score) pairs, score 1 for a win.
+        """
+
+        mu = (rating.rating - self.CENTER) / self.SCALE
+        phi = rating.deviation / self.SCALE
+        sigma = rating.volatility
+
+        # No games: only the deviation grows.
+        if not games:
+            phi_star = math.sqrt(phi*phi + sigma*sigma)
+            return Rating(rating.rating, phi_star*self.SCALE, sigma)
+
+        # Estimated variance and improvement from this period's games.
+        variance_inverse = 0.0
+        improvement_sum = 0.0
+        for opponent, score in games:
+            mu_opponent = (opponent.rating - self.CENTER) / self.SCALE
+            g_opponent = self._g(opponent.deviation / self.SCALE)
+            expected = self._expected(mu, mu_opponent, g_opponent)
+            variance_inverse += g_opponent*g_opponent*expected*(1 - expected)
+            improvement_sum += g_opponent*(score - expected)
+        variance = 1.0 / variance_inverse
+        delta = variance*improvement_sum
+
+        new_sigma = self._new_volatility(phi, sigma, variance, delta)
+
+        phi_star = math.sqrt(phi*phi + new_sigma*new_sigma)
+        new_phi = 1.0 / math.sqrt(1.0/(phi_star*phi_star) + 1.0/variance)
+        new_mu = mu + new_phi*new_phi*improvement_sum
+
+        return Rating(new_mu*self.SCALE + self.CENTER, new_phi*self.SCALE, new_sigma)
+
+    def _new_volatility(self, phi, sigma, variance, delta):
+        """Solve for the new volatility with the Illinois algorithm."""
+
+        a = math.log(sigma*sigma)
+        tau = self.tau
+
+        def f(x):
+            exp_x = math.exp(x)
+            numerator = exp_x*(delta*delta - phi*phi - variance - exp_x)
+            denominator = 2*(phi*phi + variance + exp_x)**2
+            return numerator / denominator - (x - a) / (tau*tau)
+
+        upper = a
+        if delta*delta > phi*phi + variance:
+            lower = math.log(delta*delta - phi*phi - variance)
+        else:
+            k = 1
+            while f(a - k*tau) < 0:
+                k += 1
+            lower = a - k*tau
+
+        f_upper, f_lower = f(upper), f(lower)
+        while abs(lower - upper) > self.epsilon:
+            new = upper + (upper - lower)*f_upper / (f_lower - f_upper)
+            f_new = f(new)
+            if f_new*f_lower <= 0:
+                upper, f_upper = lower, f_lower
+            else:
+                f_upper /= 2
+            lower, f_lower = new, f_new
+
+        return math.exp(upper / 2)
+
+    def update(self, player, hand, user_was_correct):
+        """Rate one answer as a rating period of one game."""
+
+        score = 1.0 if user_was_correct else 0.0
+        new_player = self._rate(player, [(hand, score)])
+        new_hand = self._rate(hand, [(player, 1 - score)])
+
+        return new_player, new_hand
+
+    def rate_period(self, ratings, results):
+        """
+        Rate a batch of answers as one Glicko-2 rating period: every key's
+        games are rated together against the ratings at the start of the
+        period. Keys in ratings without games only gain deviation.
+        """
+
+        games = collections.defaultdict(list)
+        for player_key, hand_key, user_was_correct in results:
+            player = ratings.get(player_key) or self.initial_rating()
+            hand = ratings.get(hand_key) or self.initial_rating()
+            score = 1.0 if user_was_correct else 0.0
+            games[player_key].append((hand, score))
+            games[hand_key].append((player, 1 - score))
+
+        new_ratings = {}
+        for key in set(ratings) | set(games):
+            rating = ratings.get(key) or self.initial_rating()
+            new_ratings[key] = self._rate(rating, games.get(key, []))
+
+        return new_ratings
+
+RATING_SYSTEMS = {
+    "elo" : EloRatingSystem,
+    "glicko2" : Glicko2RatingSystem,
+}
+
+def get_rating_system(name, **kwargs):
+    """Return a rating system by name, e.g. get_rating_system("glicko2")."""
+
+    INVALID_NAME_ERROR = "rating system must be one of {}".format(list(RATING_SYSTEMS))
+    assert name in RATING_SYSTEMS, INVALID_NAME_ERROR
+
+    return RATING_SYSTEMS[name](**kwargs)
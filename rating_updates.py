@@ -0,0 +1,301 @@
+"""
+Atomic elo updates after an answer.
+
+An answer changes the player's and the hand's elo. Writing the new values
+back with a $set loses updates when two users answer the same hand at
+once: both read the old elo, and the later write overwrites the earlier
+one (benchmarks/load_test.py measures this). RatingUpdater instead writes
+each answer's changes as deltas, which storage adds atomically (a $inc in
+Mongo, "elo = elo + ?" in SQLite, see Storage.increment_elos), so
+concurrent answers, in this process or another, all count.
+
+With a flush interval, deltas are summed in memory per hand and per user
+and a worker thread writes them every flush_interval seconds, or when
+max_pending hands and users are waiting, in one bulk write. A popular
+hand then costs one write per interval instead of one per answer. Stored
+elos lag by up to the interval; pending_user_delta() and
+pending_hand_delta() cover the lag for this process's own answers, and
+the hand elos in HandCache and EloIndex are updated in memory at once by
+the caller. Read a stored elo and its pending delta inside
+paused_writes(), or a write between the two reads counts the delta
+twice, or not at all.
+
+No change is lost, but the ratings are not exactly those of a serial
+replay of the answer events (see replay_ratings.py): two answers to a
+hand graded at the same time both start from its elo before either, so
+the second change is computed from an elo one change stale. Over many
+answers the Elo update pulls the ratings back together, and
+tests/test_rating_updates.py bounds the drift.
+
+Deltas which cannot be written are kept and retried with the next write;
+the queue is flushed when the process exits.
+
+Settings for the process-wide updater are read from environment variables:
+    BRIDGE_RATING_FLUSH_INTERVAL  default 0 (seconds; 0 writes every answer
+                                  at once)
+    BRIDGE_RATING_MAX_PENDING     default 1000
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+import storage
+
+logger = logging.getLogger(__name__)
+
+_rating_updater = None
+_rating_updater_lock = threading.Lock()
+
+class RatingUpdater(object):
+    """
+    Applies elo deltas to storage, at once or in periodic batches.
+
+    Counters (see stats()):
+        answers            answers passed to add()
+        writes             increment_elos calls which succeeded
+        hands_written      hand deltas written, after summing
+        users_written      user deltas written, after summing
+        failures           increment_elos calls which failed, wholly or in
+                           part; the deltas not written are retried
+        worker_errors      unexpected errors the worker thread logged and
+                           survived; their deltas are kept and retried
+    """
+
+    def __init__(self, rating_storage, flush_interval=0.0, max_pending=1000):
+        """
+        Parameters:
+            rating_storage (storage.Storage)
+            flush_interval (float) seconds deltas may wait to be written; 0
+                writes each answer's deltas in the calling thread.
+            max_pending (int) hands and users waiting before the worker
+                writes at once.
+        """
+
+        self.rating_storage = rating_storage
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._hand_deltas = {}
+        self._user_deltas = {}
+        self._condition = threading.Condition()
+        # Held while deltas are out of the queue but not yet in storage.
+        self._write_lock = threading.Lock()
+        self._closed = False
+
+        self.answers = 0
+        self.writes = 0
+        self.hands_written = 0
+        self.users_written = 0
+        self.failures = 0
+        self.worker_errors = 0
+
+        self._worker = None
+        if flush_interval > 0:
+            self._worker = threading.Thread(target=self._run, name="rating-updater",
+                    daemon=True)
+            self._worker.start()
+
+    def add(self, hand_id, hand_delta, username=None, player_delta=0.0):
+        """
+        Add one answer's elo changes.
+
+        Parameters:
+            hand_id (hand _id)
+            hand_delta (float) change of the hand elo.
+            username (string) optional, the player; None for guests, whose
+                elo is not stored.
+            player_delta (float) change of the player elo.
+        """
+
+        with self._condition:
+            CLOSED_ERROR = "the rating updater is closed"
+            assert not self._closed, CLOSED_ERROR
+
+            was_empty = not (self._hand_deltas or self._user_deltas)
+            self.answers += 1
+            self._hand_deltas[hand_id] = self._hand_deltas.get(hand_id, 0.0) + hand_delta
+            if username is not None:
+                self._user_deltas[username] = (self._user_deltas.get(username, 0.0)
+                        + player_delta)
+
+            # Wake the worker to start the flush interval, or to write now.
+            n_pending = len(self._hand_deltas) + len(self._user_deltas)
+            if was_empty or n_pending >= self.max_pending:
+                self._condition.notify()
+
+        if self._worker is None:
+            self._write_pending()
+
+        return None
+
+    def pending_user_delta(self, username):
+        """Return the change of a player's elo not yet written to storage."""
+
+        with self._condition:
+            return self._user_deltas.get(username, 0.0)
+
+    def pending_hand_delta(self, hand_id):
+        """Return the change of a hand's elo not yet written to storage."""
+
+        with self._condition:
+            return self._hand_deltas.get(hand_id, 0.0)
+
+    def paused_writes(self):
+        """
+        Return a context manager during which this updater writes nothing,
+        so a stored elo read inside it plus pending_hand_delta() or
+        pending_user_delta() counts each change once, e.g.
+
+            with rating_updater.paused_writes():
+                hand_elo = (rating_storage.get_hand_elo(hand_id)
+                        + rating_updater.pending_hand_delta(hand_id))
+        """
+
+        return self._write_lock
+
+    def flush(self):
+        """Write every pending delta now, in the calling thread."""
+
+        self._write_pending()
+
+        return None
+
+    def close(self):
+        """Write every pending delta and stop the worker thread."""
+
+        with self._condition:
+            if self._closed:
+                return None
+            self._closed = True
+            self._condition.notify()
+
+        if self._worker is not None:
+            self._worker.join()
+        self._write_pending()
+
+        return None
+
+    def stats(self):
+        """Return the counters and the number of deltas waiting, as a dict."""
+
+        with self._condition:
+            return {
+                "answers" : self.answers,
+                "writes" : self.writes,
+                "hands_written" : self.hands_written,
+                "users_written" : self.users_written,
+                "failures" : self.failures,
+                "worker_errors" : self.worker_errors,
+                "pending" : len(self._hand_deltas) + len(self._user_deltas),
+            }
+
+    def _run(self):
+        """Worker thread: write the deltas every flush_interval seconds."""
+
+        while True:
+            with self._condition:
+                # Sleep until a delta arrives.
+                if not (self._hand_deltas or self._user_deltas or self._closed):
+                    self._condition.wait()
+
+                # Let deltas of the same hands add up for flush_interval.
+                n_pending = len(self._hand_deltas) + len(self._user_deltas)
+                if 0 < n_pending < self.max_pending and not self._closed:
+                    self._condition.wait(self.flush_interval)
+
+                closed = self._closed
+
+            # Any other error, e.g. a bug in a storage driver, is logged
+            # rather than stopping the thread, which would leave every
+            # later delta unwritten.
+            try:
+                self._write_pending()
+            except Exception:
+                logger.exception("rating updater: worker error")
+                with self._condition:
+                    self.worker_errors += 1
+
+            if closed:
+                return None
+
+    def _write_pending(self):
+        """
+        Write the pending deltas, keeping them if the write fails.
+
+        Writes of one updater take turns, so paused_writes() never sees
+        deltas which are neither pending nor stored.
+        """
+
+        with self._write_lock:
+            with self._condition:
+                hand_deltas, self._hand_deltas = self._hand_deltas, {}
+                user_deltas, self._user_deltas = self._user_deltas, {}
+
+            if not (hand_deltas or user_deltas):
+                return None
+
+            unwritten = (hand_deltas, user_deltas)
+            try:
+                unwritten = self._write(hand_deltas, user_deltas)
+            finally:
+                # Put back the deltas not written, adding any queued since.
+                with self._condition:
+                    for pending, failed in zip((self._hand_deltas, self._user_deltas),
+                            unwritten):
+                        for key, delta in failed.items():
+                            pending[key] = pending.get(key, 0.0) + delta
+
+        return None
+
+    def _write(self, hand_deltas, user_deltas):
+        """
+        Add deltas to the stored elos.
+
+        Returns:
+            unwritten_hands (dict) hand _id -> elo change not added.
+            unwritten_users (dict) username -> elo change not added.
+        """
+
+        unwritten_hands, unwritten_users = {}, {}
+        try:
+            self.rating_storage.increment_elos(hand_deltas, user_deltas, time.time())
+        except storage.PartialWriteError as error:
+            # Only the deltas which did not apply are retried.
+            logger.warning("rating updater: could not write all elo changes: %s", error)
+            unwritten_hands, unwritten_users = error.unapplied_hands, error.unapplied_users
+        except storage.WRITE_ERRORS as error:
+            logger.warning("rating updater: could not write %d elo changes: %s",
+                    len(hand_deltas) + len(user_deltas), error)
+            with self._condition:
+                self.failures += 1
+            return hand_deltas, user_deltas
+
+        with self._condition:
+            if unwritten_hands or unwritten_users:
+                self.failures += 1
+            else:
+                self.writes += 1
+            self.hands_written += len(hand_deltas) - len(unwritten_hands)
+            self.users_written += len(user_deltas) - len(unwritten_users)
+
+        return unwritten_hands, unwritten_users
+
+def get_rating_updater():
+    """
+    Return the process-wide RatingUpdater for the storage backend, creating
+    it on first use. It is closed, and so flushed, when the process exits.
+    """
+
+    global _rating_updater
+    if _rating_updater is None:
+        with _rating_updater_lock:
+            if _rating_updater is None:
+                environ = os.environ
+                _rating_updater = RatingUpdater(storage.get_storage(),
+                        flush_interval=float(environ.get(
+                            "BRIDGE_RATING_FLUSH_INTERVAL", 0)),
+                        max_pending=int(environ.get("BRIDGE_RATING_MAX_PENDING", 1000)))
+                atexit.register(_rating_updater.close)
+
+    return _rating_updater
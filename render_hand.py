@@ -1,6 +1,17 @@
+import collections
+import hashlib
+import json
+import os
 import textwrap
-import streamlit
-import numpy as np
+import threading
+
+# Rendered problems, keyed by a hash of everything the rendering depends
+# on (see render_cache_key), least recently used first. Editing a hand
+# changes its key, so entries never go stale; old ones are evicted once
+# there are more than BRIDGE_RENDER_CACHE_SIZE.
+RENDER_CACHE_SIZE = int(os.environ.get("BRIDGE_RENDER_CACHE_SIZE", 4096))
+_RENDER_CACHE = collections.OrderedDict()
+_render_cache_lock = threading.Lock()
 
 def render_single_hand(list_of_cards, hidden=False):
     """
@@ -228,14 +239,12 @@ def render_auction(auction_string, dealer):
     for pad_iteration in range(remainder_to_pad_amount[auction_length_mod_four]):
         bids_list.append("-")
     
-    # Reshape the bids list of a rectangular matrix of shape 
-    # (nrounds, 4). This is possible because the auction has been 
-    # left-and right-padded to have length % 4 = 0.
-    auction_rounds = int(len(bids_list)/4)
-    rectangular_bids_list = np.reshape(bids_list, (auction_rounds, 4))
+    # Split the bids list into rounds of 4 bids. This is possible because
+    # the auction has been left-and right-padded to have length % 4 = 0.
+    auction_rounds = [bids_list[i:i + 4] for i in range(0, len(bids_list), 4)]
 
     # Render the auction as markdown with a header and lines of auction.
-    auction_markdown = """
+    auction_markdown_parts = ["""
     <table width="100%" style="border-spacing: 0px;">
     <tr style="border : 0">
         <td style="border: none">N</td>
@@ -243,22 +252,132 @@ def render_auction(auction_string, dealer):
         <td style="border: none">S</td>
         <td style="border: none">W</td>
     </tr>
-    """
-    for auction_row in rectangular_bids_list:
-        
-        row_markdown = "<tr style='border: none'>\n"
-        for bid in auction_row:
-            bid_markdown = "<td style='border: none'>" + bid + "</td>\n"
-            row_markdown += bid_markdown
-        row_markdown += "</tr>\n"
+    """]
+    for auction_row in auction_rounds:
 
-        auction_markdown += row_markdown
+        auction_markdown_parts.append("<tr style='border: none'>\n")
+        for bid in auction_row:
+            auction_markdown_parts.append("<td style='border: none'>" + bid + "</td>\n")
+        auction_markdown_parts.append("</tr>\n")
 
-    auction_markdown += "</table>"
-    print(auction_markdown)
+    auction_markdown_parts.append("</table>")
+    auction_markdown = "".join(auction_markdown_parts)
 
     return auction_markdown
 
+def render_cache_key(hand_json):
+    """
+    Return a hash of the fields a rendered problem depends on.
+
+    Parameters:
+    ------------
+    hand_json (json) hand document.
+
+    Returns:
+    ------------
+    key (string) hex digest.
+    """
+
+    fields = [
+        hand_json["n_hand"],
+        hand_json["w_hand"],
+        hand_json["s_hand"],
+        hand_json["e_hand"],
+        hand_json.get("hidden_hands", ""),
+        hand_json.get("dealer", "S"),
+        hand_json.get("auction", ""),
+        hand_json.get("question", hand_json.get("context", "")),
+    ]
+    encoded_fields = json.dumps(fields, separators=(",", ":")).encode("utf-8")
+
+    return hashlib.sha1(encoded_fields).hexdigest()
+
+def render_hand_json(hand_json):
+    """
+    Render a problem from its hand document, using the render cache, or
+    the rendering stored in the document by prerender_hands(store=True) if
+    it is still current.
+
+    Parameters:
+    ------------
+    hand_json (json) hand document with n_hand, s_hand, w_hand, e_hand,
+        and optionally hidden_hands, dealer, auction and question.
+
+    Returns:
+    ------------
+    rendered_hands (string) the HTML of render_four_hands_with_question.
+    """
+
+    key = render_cache_key(hand_json)
+    with _render_cache_lock:
+        rendered_hands = _RENDER_CACHE.get(key)
+        if rendered_hands is not None:
+            _RENDER_CACHE.move_to_end(key)
+            return rendered_hands
+
+    stored = hand_json.get("rendered")
+    if stored is not None and stored.get("key") == key:
+        rendered_hands = stored["html"]
+    else:
+        list_of_hands = [
+                hand_json["n_hand"],
+                hand_json["w_hand"],
+                hand_json["s_hand"],
+                hand_json["e_hand"]
+                ]
+        rendered_hands = render_four_hands_with_question(
+                list_of_hands=list_of_hands,
+                question=hand_json.get("question", hand_json.get("context", "")),
+                hidden_hands=hand_json.get("hidden_hands", ""),
+                dealer_string=hand_json.get("dealer", "S"),
+                auction_string=hand_json.get("auction", ""))
+
+    with _render_cache_lock:
+        _RENDER_CACHE[key] = rendered_hands
+        _RENDER_CACHE.move_to_end(key)
+        while len(_RENDER_CACHE) > RENDER_CACHE_SIZE:
+            _RENDER_CACHE.popitem(last=False)
+
+    return rendered_hands
+
+def prerender_hands(hand_jsons, store=False):
+    """
+    Render every problem into the render cache ahead of time.
+
+    Parameters:
+    ------------
+    hand_jsons (iterable of json) hand documents.
+    store (boolean) also keep each rendering in its document, as
+        {"key" : render_cache_key, "html" : ...} under "rendered", so the
+        documents are written with it and any process serves them without
+        rendering. A stored rendering is ignored once the hand is edited,
+        as its key no longer matches.
+
+    Returns:
+    ------------
+    n_rendered (int) number of problems rendered.
+
+    Only the last RENDER_CACHE_SIZE problems stay in the render cache.
+    """
+
+    n_rendered = 0
+    for hand_json in hand_jsons:
+        rendered_hands = render_hand_json(hand_json)
+        if store:
+            hand_json["rendered"] = {"key" : render_cache_key(hand_json),
+                    "html" : rendered_hands}
+        n_rendered += 1
+
+    return n_rendered
+
+def clear_render_cache():
+    """Empty the render cache."""
+
+    with _render_cache_lock:
+        _RENDER_CACHE.clear()
+
+    return None
+
 if __name__ == "__main__":
 
     """
@@ -284,16 +403,16 @@ if __name__ == "__main__":
         rendered_hands = render_four_hands(list_of_hands, hidden_hands)
         print(rendered_hands)
 
-    # Render the same four hands, with context.
-    context = """
+    # Render the same four hands, with a question.
+    question = """
     Contract: 4S. You win the CK lead in dummy and play which suit?
     """
     hidden_hands = "SE"
-    rendered_hands_with_context = render_four_hands_with_context(
+    rendered_hands_with_question = render_four_hands_with_question(
             list_of_hands=list_of_hands,
-            context=context,
+            question=question,
             hidden_hands=hidden_hands)
-    print(rendered_hands_with_context)
+    print(rendered_hands_with_question)
 
     # Render an auction as markdown.
     dealer = "E"
@@ -0,0 +1,201 @@
+"""
+CLI to recompute every player and hand rating from the event history.
+
+Answer events ("event_type" : "answer", logged by session.py) are read in
+timestamp order and replayed through elo.get_new_elos_array. Players and
+hands get dense integer ids, and ratings live in two NumPy arrays.
+
+Elo is sequential: an answer's update depends on every earlier answer by
+the same player or to the same hand. The replay therefore splits the
+history into rounds in which no player and no hand appears twice, each
+answer going to the round after the last one touching its player or hand.
+Every round is then one vectorized update, and the result is identical to
+replaying the answers one at a time.
+
+Events are read from, and final ratings written back to, the configured
+storage backend (see storage.py), one bulk write per table.
+
+Only players and hands with answer events are rated. Answer events were
+first logged with the replay itself, so older ratings, e.g. those
+computed with the Elo expected score inverted, stay as they are unless
+--reset-unanswered sets every player and hand without an answer back to
+INITIAL_ELO.
+
+Usage:
+    python replay_ratings.py --dry-run
+    python replay_ratings.py --K 24
+    python replay_ratings.py --reset-unanswered
+"""
+import argparse
+import time
+import numpy as np
+import elo
+import storage
+
+INITIAL_ELO = 1200
+
+def load_answer_events(event_storage):
+    """
+    Read answer events, oldest first.
+
+    Parameters:
+        event_storage (storage.Storage)
+
+    Returns:
+        (usernames, hand_ids, outcomes) three lists, one entry per answer.
+    """
+
+    usernames, hand_ids, outcomes = [], [], []
+    for event in event_storage.iter_events("answer"):
+        usernames.append(event["username"])
+        hand_ids.append(event["hand_id"])
+        outcomes.append(event["user_was_correct"])
+
+    return usernames, hand_ids, outcomes
+
+def dense_ids(keys):
+    """
+    Map arbitrary keys to dense integer ids 0..n-1.
+
+    Returns:
+        (ids, unique_keys) ids (int np.ndarray) one per key, and the key of
+        each id.
+    """
+
+    id_by_key = {}
+    ids = np.empty(len(keys), dtype=np.int64)
+    for position, key in enumerate(keys):
+        ids[position] = id_by_key.setdefault(key, len(id_by_key))
+
+    unique_keys = [None]*len(id_by_key)
+    for key, key_id in id_by_key.items():
+        unique_keys[key_id] = key
+
+    return ids, unique_keys
+
+def schedule_rounds(player_ids, hand_ids, n_players, n_hands):
+    """
+    Assign each answer to the earliest round after every earlier answer
+    by its player or to its hand.
+
+    Returns:
+        rounds (int np.ndarray) round of each answer.
+    """
+
+    next_player_round = [0]*n_players
+    next_hand_round = [0]*n_hands
+    rounds = np.empty(len(player_ids), dtype=np.int64)
+    for position, (player_id, hand_id) in enumerate(
+            zip(player_ids.tolist(), hand_ids.tolist())):
+        answer_round = max(next_player_round[player_id], next_hand_round[hand_id])
+        rounds[position] = answer_round
+        next_player_round[player_id] = answer_round + 1
+        next_hand_round[hand_id] = answer_round + 1
+
+    return rounds
+
+def replay(player_ids, hand_ids, outcomes, n_players, n_hands, K=30,
+        initial_elo=INITIAL_ELO):
+    """
+    Replay answers, in order, from initial ratings.
+
+    Parameters:
+        player_ids, hand_ids (int np.ndarray) dense ids, one per answer.
+        outcomes (bool np.ndarray) whether each answer was correct.
+        n_players, n_hands (int) number of distinct players and hands.
+        K (float) elo scaling factor.
+        initial_elo (float) starting rating of every player and hand.
+
+    Returns:
+        (player_elos, hand_elos) float np.ndarrays indexed by dense id.
+    """
+
+    player_elos = np.full(n_players, initial_elo, dtype=np.float64)
+    hand_elos = np.full(n_hands, initial_elo, dtype=np.float64)
+    if len(player_ids) == 0:
+        return player_elos, hand_elos
+
+    rounds = schedule_rounds(player_ids, hand_ids, n_players, n_hands)
+
+    # Group answers by round. Answers in a round share no player or hand,
+    # so their order within the round does not matter.
+    order = np.argsort(rounds, kind="stable")
+    boundaries = np.searchsorted(rounds[order], np.arange(rounds.max() + 2))
+
+    for round_index in range(len(boundaries) - 1):
+        in_round = order[boundaries[round_index]:boundaries[round_index + 1]]
+        players = player_ids[in_round]
+        hands = hand_ids[in_round]
+
+        new_player_elos, new_hand_elos = elo.get_new_elos_array(
+                player_elos[players], hand_elos[hands], outcomes[in_round], K)
+        player_elos[players] = new_player_elos
+        hand_elos[hands] = new_hand_elos
+
+    return player_elos, hand_elos
+
+def write_ratings(rating_storage, hand_keys, hand_elos, usernames, player_elos,
+        reset_unanswered=False):
+    """
+    Write final ratings back, with one bulk write per table.
+    Guest ratings (keyed ("guest", position)) are not stored, as in
+    session.py. If reset_unanswered, every stored hand and user without
+    an answer is set to INITIAL_ELO.
+    """
+
+    hand_elo_by_key = {hand_id : float(hand_elo)
+            for hand_id, hand_elo in zip(hand_keys, hand_elos)}
+    user_elo_by_key = {username : float(player_elo)
+            for username, player_elo in zip(usernames, player_elos)
+            if not isinstance(username, tuple)}
+    if reset_unanswered:
+        for _, hand_id in rating_storage.hand_elos():
+            hand_elo_by_key.setdefault(hand_id, float(INITIAL_ELO))
+        for user_json in rating_storage.iter_users():
+            user_elo_by_key.setdefault(user_json["username"], float(INITIAL_ELO))
+    rating_storage.set_elos(hand_elo_by_key, user_elo_by_key, time.time())
+
+    return None
+
+def replay_wrapper(K=30, dry_run=False, reset_unanswered=False):
+    """Recompute all ratings from the answer events, and store them."""
+
+    rating_storage = storage.get_storage()
+    usernames, hand_keys, outcomes = load_answer_events(rating_storage)
+
+    # Guest ratings are never stored, so every guest answer starts from
+    # the initial rating, as it does in session.py.
+    player_keys = [username if username != "guest" else ("guest", position)
+            for position, username in enumerate(usernames)]
+
+    player_ids, unique_usernames = dense_ids(player_keys)
+    hand_ids, unique_hand_keys = dense_ids(hand_keys)
+    outcomes = np.asarray(outcomes, dtype=bool)
+
+    player_elos, hand_elos = replay(player_ids, hand_ids, outcomes,
+            len(unique_usernames), len(unique_hand_keys), K=K)
+
+    print("Answers replayed: {} Hands: {}".format(
+        len(outcomes), len(unique_hand_keys)))
+
+    if not dry_run:
+        write_ratings(rating_storage, unique_hand_keys, hand_elos,
+                unique_usernames, player_elos, reset_unanswered)
+
+        # Running apps hold hand elos in memory; make them re-read.
+        rating_storage.bump_generation()
+
+    return player_elos, hand_elos
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--K", type=float, default=30, help="elo scaling factor")
+    parser.add_argument("--dry-run", action="store_true",
+            help="replay without writing ratings back")
+    parser.add_argument("--reset-unanswered", action="store_true",
+            help="set players and hands without answers to {}".format(INITIAL_ELO))
+    args = parser.parse_args()
+
+    replay_wrapper(K=args.K, dry_run=args.dry_run,
+            reset_unanswered=args.reset_unanswered)
@@ -0,0 +1,244 @@
+"""
+Declared indexes of every collection, and checks that queries use them.
+
+INDEXES lists the indexes each collection needs. ensure_indexes() creates
+them; creating an index which already exists is a no-op, so it is safe to
+run on every start.
+
+QUERIES lists the queries the app issues, with sample values.
+check_query_plans() runs explain() on each one and reports any whose
+winning plan scans the whole collection (a COLLSCAN stage).
+
+The SQLite backend creates its indexes with its tables (see
+storage.SQLITE_SCHEMA). SQLITE_QUERIES lists the statements it issues,
+and check_sqlite_query_plans() reports any whose EXPLAIN QUERY PLAN
+scans a whole table.
+
+Usage:
+    python schema.py            create indexes, then check query plans
+    python schema.py --check    only check query plans
+    python schema.py --sqlite bridge_problem_database.sqlite3
+                                check the query plans of a SQLite database
+"""
+import argparse
+import sqlite3
+import sys
+import pymongo
+import db
+
+ASCENDING = pymongo.ASCENDING
+DESCENDING = pymongo.DESCENDING
+
+# Collection name -> list of index key lists. Default index names are
+# used, so indexes created elsewhere with the same keys are the same index.
+INDEXES = {
+    "hands" : [
+        # Hand selection by rating window, and the EloIndex covered query.
+        [("elo", ASCENDING), ("_id", ASCENDING)],
+        # Changed hands, for incremental backups.
+        [("updated_at", ASCENDING)],
+        # Problems by kind and contract, then rating (see hand_features.py).
+        [("features.problem_type", ASCENDING), ("features.contract_strain", ASCENDING),
+            ("features.contract_level", ASCENDING), ("elo", ASCENDING)],
+        # Problems by the strength of the declaring side, then rating.
+        [("features.declarer_side_hcp", ASCENDING), ("elo", ASCENDING)],
+        # Duplicates of a new hand (see deal_hashing.py).
+        [("deal_hashes.canonical", ASCENDING)],
+        [("deal_hashes.notrump", ASCENDING)],
+        [("deal_hashes.spotless", ASCENDING)],
+        [("deal_hashes.bands", ASCENDING)],
+    ],
+    "user" : [
+        # lookup_user_elo and elo updates.
+        [("username", ASCENDING)],
+        # Changed users, for incremental backups.
+        [("updated_at", ASCENDING)],
+    ],
+    "events" : [
+        # A user's most recent shown hand.
+        [("username", ASCENDING), ("timestamp", ASCENDING)],
+        # Answer history in order, for replay_ratings.py.
+        [("event_type", ASCENDING), ("timestamp", ASCENDING)],
+        # Every event in order, for migrate_storage.py.
+        [("timestamp", ASCENDING)],
+    ],
+}
+
+# Queries issued by session.py and the scripts around it, with sample
+# values. Each is (description, collection name, filter, sort, projection).
+QUERIES = [
+    ("user elo lookup", "user", {"username" : "guest"}, None, None),
+    ("hand by id", "hands", {"_id" : "hand id"}, None, None),
+    ("hands in a rating window", "hands",
+        {"elo" : {"$gte" : 1000, "$lte" : 1400}}, None, None),
+    ("elo index build", "hands", {}, [("elo", ASCENDING)], {"elo" : 1}),
+    ("last shown hand of a user", "events",
+        {"username" : "guest", "event_type" : {"$ne" : "answer"}},
+        [("timestamp", DESCENDING)], None),
+    ("answer to the last shown hand", "events",
+        {"username" : "guest", "timestamp" : {"$gte" : 0},
+            "event_type" : "answer", "hand_id" : "hand id"},
+        [("timestamp", ASCENDING)], None),
+    ("answer history", "events", {"event_type" : "answer"},
+        [("timestamp", ASCENDING)], {"username" : 1, "hand_id" : 1,
+            "user_was_correct" : 1, "_id" : 0}),
+    ("event history", "events", {}, [("timestamp", ASCENDING)], None),
+    ("problems by kind and contract", "hands",
+        {"features.problem_type" : "lead", "features.contract_strain" : "N",
+            "features.contract_level" : 3, "elo" : {"$gte" : 1300, "$lte" : 1500}},
+        None, None),
+    ("problems by declaring side strength", "hands",
+        {"features.declarer_side_hcp" : {"$gte" : 24}}, None, None),
+    ("duplicates of a new hand", "hands",
+        {"$or" : [{"deal_hashes.canonical" : "hash"},
+            {"deal_hashes.spotless" : "hash"},
+            {"deal_hashes.bands" : {"$in" : ["0:hash", "1:hash"]}},
+            {"deal_hashes.notrump" : "hash"}]},
+        None, None),
+    ("hands changed since a backup", "hands", {"updated_at" : {"$gte" : 0}},
+        None, None),
+    ("users changed since a backup", "user", {"updated_at" : {"$gte" : 0}},
+        None, None),
+]
+
+# Statements issued by storage.SQLiteStorage, with sample parameters.
+# Each is (description, sql, parameters). Reads of every row, e.g.
+# iter_hands(), are not listed.
+SQLITE_QUERIES = [
+    ("user elo lookup", "SELECT doc FROM users WHERE username = ?", ("guest",)),
+    ("hand by id", "SELECT doc FROM hands WHERE id = ?", ('"hand id"',)),
+    ("hand elo by id", "SELECT elo FROM hands WHERE id = ?", ('"hand id"',)),
+    ("elo index build", "SELECT elo, id FROM hands ORDER BY elo, id", ()),
+    ("hand count", "SELECT COUNT(*) FROM hands", ()),
+    ("last shown hand of a user", "SELECT doc FROM events "
+        "WHERE username = ? AND (event_type IS NULL OR event_type != 'answer') "
+        "ORDER BY timestamp DESC LIMIT 1", ("guest",)),
+    ("answer to the last shown hand", "SELECT doc FROM events "
+        "WHERE username = ? AND timestamp >= ? AND event_type = 'answer' "
+        "ORDER BY timestamp", ("guest", 0)),
+    ("answer history", "SELECT doc FROM events "
+        "WHERE event_type = ? ORDER BY timestamp", ("answer",)),
+    ("event history", "SELECT doc FROM events ORDER BY timestamp", ()),
+    ("hand generation", "SELECT value FROM meta WHERE key = ?", ("generation",)),
+]
+
+def ensure_collection_indexes(collection, collection_name=None):
+    """
+    Create the declared indexes of one collection.
+
+    Parameters:
+        collection (pymongo collection object)
+        collection_name (string) key into INDEXES, default collection.name.
+    """
+
+    for keys in INDEXES[collection_name or collection.name]:
+        collection.create_index(keys)
+
+    return None
+
+def ensure_indexes(database):
+    """Create the declared indexes of every collection in the database."""
+
+    for collection_name in INDEXES:
+        ensure_collection_indexes(database[collection_name], collection_name)
+
+    return None
+
+def plan_stages(plan):
+    """Return every stage name in an explain() plan, depth first."""
+
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+
+    return stages
+
+def explain_query(collection, query_filter, sort=None, projection=None):
+    """Return the winning plan's stage names for one query."""
+
+    cursor = collection.find(query_filter, projection).limit(1)
+    if sort:
+        cursor = cursor.sort(sort)
+    explanation = cursor.explain()
+
+    return plan_stages(explanation["queryPlanner"]["winningPlan"])
+
+def check_query_plans(database, queries=QUERIES):
+    """
+    Explain every query in queries.
+
+    Returns:
+        collection_scans (list) descriptions of queries whose plan has a
+        COLLSCAN stage; empty if every query uses an index.
+    """
+
+    collection_scans = []
+    for description, collection_name, query_filter, sort, projection in queries:
+        stages = explain_query(database[collection_name], query_filter, sort,
+                projection)
+        uses_collscan = "COLLSCAN" in stages
+        print("{:<28} {:<8} {}".format(description, collection_name,
+            " <- ".join(stages)))
+        if uses_collscan:
+            collection_scans.append(description)
+
+    return collection_scans
+
+def explain_sqlite_query(connection, sql, parameters=()):
+    """Return the detail of every step of a statement's EXPLAIN QUERY PLAN."""
+
+    rows = connection.execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+
+    return [row[-1] for row in rows]
+
+def check_sqlite_query_plans(connection, queries=SQLITE_QUERIES):
+    """
+    Explain every statement in queries.
+
+    Returns:
+        table_scans (list) descriptions of statements whose plan scans a
+        table without an index, e.g. "SCAN events"; empty if every
+        statement uses an index.
+    """
+
+    table_scans = []
+    for description, sql, parameters in queries:
+        details = explain_sqlite_query(connection, sql, parameters)
+        uses_table_scan = any(detail.startswith("SCAN") and "INDEX" not in detail
+                for detail in details)
+        print("{:<28} {}".format(description, " | ".join(details)))
+        if uses_table_scan:
+            table_scans.append(description)
+
+    return table_scans
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--check", action="store_true",
+            help="only check query plans, without creating indexes")
+    parser.add_argument("--sqlite", default=None,
+            help="check the query plans of this SQLite database instead")
+    args = parser.parse_args()
+
+    if args.sqlite is not None:
+        table_scans = check_sqlite_query_plans(sqlite3.connect(args.sqlite))
+        if table_scans:
+            print("Table scans: {}".format(", ".join(table_scans)))
+            sys.exit(1)
+        sys.exit(0)
+
+    database = db.get_database()
+    if not args.check:
+        ensure_indexes(database)
+
+    collection_scans = check_query_plans(database)
+    if collection_scans:
+        print("Collection scans: {}".format(", ".join(collection_scans)))
+        sys.exit(1)
@@ -0,0 +1,570 @@
+"""
+Full-text search over the text of the problems.
+
+SearchIndex is an in-process inverted index over the question, context,
+explanation, source and notes of every hand, with:
+
+    ranked keyword search   BM25 over the words of the query
+    phrase search           "quoted phrases" must appear, words in order
+    filters                 elo range, source substring, and the problem
+                            type and contract of hand_features.py
+
+Postings map each word to a sorted array of the hands holding it and the
+word positions there; fields are placed far apart, so a phrase never
+spans two fields. Scoring, phrase matching and filtering are NumPy
+operations, so a search costs milliseconds at 100k problems.
+
+The index is saved to DEFAULT_INDEX_PATH, a .npz file next to this
+module unless BRIDGE_SEARCH_INDEX names another, with the hands
+generation it was built at. Changes made by alter_database.py and
+import_problems.py are appended to a journal next to it, each with the
+generation before it, and replayed when the index is opened, so adding
+hands does not rewrite the index; the replayed index is then saved,
+emptying the journal. If hands changed some other way, e.g. the
+hand_features.py or deal_hashing.py backfills, the generations no longer
+line up and the index is rebuilt from storage.
+
+Usage:
+    python search_index.py build
+    python search_index.py search finesse '"west leads"' --type declarer
+    python search_index.py search squeeze --elo 1400 --window 200 --source kantar
+"""
+import argparse
+import json
+import math
+import os
+import re
+import numpy as np
+from bson import json_util
+import hand_features
+import storage
+
+DEFAULT_INDEX_PATH = os.environ.get("BRIDGE_SEARCH_INDEX", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "search_index.npz"))
+TEXT_FIELDS = ["question", "context", "explanation", "source", "notes"]
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+# Positions between fields, so phrases do not match across them, and
+# between hands.
+FIELD_GAP = 100000
+ROW_STRIDE = len(TEXT_FIELDS)*FIELD_GAP
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+
+def tokenize(text):
+    """Return the lower-case words of a text, e.g. "West leads the SQ." ->
+    ["west", "leads", "the", "sq"]."""
+
+    return TOKEN_PATTERN.findall((text or "").lower())
+
+def parse_query(query):
+    """
+    Split a query into words and quoted phrases.
+
+    Returns:
+        (words, phrases) words (string []) to rank by, and phrases
+        (string [] []) each the words of one quoted phrase.
+    """
+
+    words = []
+    phrases = []
+    for phrase, word in QUERY_PATTERN.findall(query):
+        if phrase:
+            phrase_words = tokenize(phrase)
+            if phrase_words:
+                phrases.append(phrase_words)
+                words.extend(phrase_words)
+        else:
+            words.extend(tokenize(word))
+
+    return words, phrases
+
+def filter_values(hand_json):
+    """Return the values filters test of a hand: elo, source and features."""
+
+    features = hand_json.get("features")
+    if hand_features.needs_features(hand_json):
+        try:
+            features = hand_features.compute_features(hand_json)
+        except AssertionError:
+            features = {}
+
+    return {
+        "elo" : hand_json.get("elo"),
+        "source" : (hand_json.get("source") or "").lower(),
+        "problem_type" : features.get("problem_type"),
+        "contract_level" : features.get("contract_level"),
+        "contract_strain" : features.get("contract_strain"),
+    }
+
+class SearchIndex(object):
+    """
+    Inverted index of hand text, keyed by hand _id.
+
+    Each hand gets a row number when added. A word's postings are one
+    sorted array of row*ROW_STRIDE + position, so a hand's entries are
+    contiguous, and new hands, which get the highest rows, are appended.
+    Rows of removed hands stay empty until the index is rebuilt.
+
+    Attributes:
+        generation (int) hands generation the index is up to date with.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self.postings = {} # word -> sorted int64 array.
+        self.id_keys = [] # row -> _id_key of the hand, None once removed.
+        self.row_by_key = {}
+        self.sources = [] # row -> lower-case source.
+
+        # One entry per row, grown as rows are added.
+        self._lengths = np.zeros(0)
+        self._alive = np.zeros(0, dtype=bool)
+        self._elos = np.zeros(0)
+        self._types = np.zeros(0, dtype=np.int8)
+        self._levels = np.zeros(0, dtype=np.int8)
+        self._strains = np.zeros(0, dtype=np.int8)
+        self._n_rows = 0
+        self._total_length = 0.0
+
+        # word -> (rows, term frequencies) arrays, built on first search.
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.row_by_key)
+
+    def add(self, hand_json):
+        """Index a hand, replacing it if it is already indexed."""
+
+        self.add_many([hand_json])
+
+        return None
+
+    def add_many(self, hand_jsons):
+        """Index hands, replacing any already indexed."""
+
+        new_postings = {}
+        for hand_json in hand_jsons:
+            self.remove(hand_json["_id"])
+            row = self._n_rows
+            self._grow(row + 1)
+            self._n_rows += 1
+
+            # Word positions, each field far from the last.
+            length = 0
+            for field_index, field in enumerate(TEXT_FIELDS):
+                words = tokenize(hand_json.get(field))[:FIELD_GAP]
+                base = row*ROW_STRIDE + field_index*FIELD_GAP
+                for position, word in enumerate(words):
+                    new_postings.setdefault(word, []).append(base + position)
+                length += len(words)
+
+            values = filter_values(hand_json)
+            id_key = _id_key(hand_json["_id"])
+            self.id_keys.append(id_key)
+            self.row_by_key[id_key] = row
+            self.sources.append(values["source"])
+            self._lengths[row] = length
+            self._alive[row] = True
+            self._elos[row] = values["elo"] if values["elo"] is not None else np.nan
+            self._types[row] = _code(hand_features.PROBLEM_TYPES, values["problem_type"])
+            self._levels[row] = values["contract_level"] or 0
+            self._strains[row] = _code(hand_features.STRAINS, values["contract_strain"])
+            self._total_length += length
+
+        # The new rows are the highest, so appending keeps postings sorted.
+        for word, entries in new_postings.items():
+            entries = np.array(entries, dtype=np.int64)
+            if word in self.postings:
+                entries = np.concatenate([self.postings[word], entries])
+            self.postings[word] = entries
+            self._arrays.pop(word, None)
+
+        return None
+
+    def remove(self, hand_id):
+        """Remove a hand from the index, if present."""
+
+        row = self.row_by_key.pop(_id_key(hand_id), None)
+        if row is None:
+            return None
+
+        for word in list(self.postings):
+            entries = self.postings[word]
+            low, high = np.searchsorted(entries, [row*ROW_STRIDE, (row + 1)*ROW_STRIDE])
+            if low == high:
+                continue
+            if high - low == len(entries):
+                del self.postings[word]
+            else:
+                self.postings[word] = np.concatenate([entries[:low], entries[high:]])
+            self._arrays.pop(word, None)
+
+        self.id_keys[row] = None
+        self._alive[row] = False
+        self._total_length -= self._lengths[row]
+
+        return None
+
+    def update_elo(self, hand_id, new_elo):
+        """Set the elo a hand is filtered by."""
+
+        row = self.row_by_key.get(_id_key(hand_id))
+        if row is not None:
+            self._elos[row] = new_elo
+
+        return None
+
+    def hand_id(self, row):
+        """Return the _id of the hand in a row."""
+
+        return json_util.loads(self.id_keys[row])
+
+    def search(self, query, filters=None, limit=20):
+        """
+        Return the hands best matching a query.
+
+        Parameters:
+            query (string) words, ranked by BM25, and "quoted phrases",
+                which must appear. An empty query matches every hand.
+            filters (dict) optional, any of:
+                elo              (low, high)
+                source           a substring of the source, any case
+                problem_type     e.g. "lead", see hand_features.py
+                contract_level   e.g. 3
+                contract_strain  e.g. "N"
+            limit (int) most results to return.
+
+        Returns:
+            results ((hand_id, score) []) best first.
+        """
+
+        words, phrases = parse_query(query)
+        filters = dict(filters or {})
+        source = filters.pop("source", None)
+        n_rows = self._n_rows
+        selected = self._alive[:n_rows] & self._filter_mask(filters)
+
+        # BM25: each row's score is the sum over query words it holds.
+        scores = np.zeros(n_rows)
+        if words:
+            matched = np.zeros(n_rows, dtype=bool)
+            n_hands = max(len(self), 1)
+            average_length = max(self._total_length / n_hands, 1.0)
+            for word in set(words):
+                rows, frequencies = self._word_arrays(word)
+                if not len(rows):
+                    continue
+                idf = math.log(1 + (n_hands - len(rows) + 0.5) / (len(rows) + 0.5))
+                norms = K1*(1 - B + B*self._lengths[rows] / average_length)
+                scores[rows] += idf * frequencies*(K1 + 1) / (frequencies + norms)
+                matched[rows] = True
+            selected &= matched
+
+        for phrase in phrases:
+            selected &= self._phrase_mask(phrase, n_rows)
+
+        rows = np.flatnonzero(selected)
+
+        # The source is matched by substring, so only on the rows left.
+        if source:
+            source = source.lower()
+            rows = rows[[source in self.sources[row] for row in rows]]
+
+        if len(rows) > limit:
+            rows = rows[np.argpartition(-scores[rows], limit - 1)[:limit]]
+        rows = rows[np.argsort(-scores[rows], kind="stable")]
+
+        return [(self.hand_id(row), float(scores[row])) for row in rows]
+
+    def save(self, path):
+        """Write the index to path, a .npz file, atomically."""
+
+        words = sorted(self.postings)
+        offsets = np.cumsum([0] + [len(self.postings[word]) for word in words])
+        entries = (np.concatenate([self.postings[word] for word in words])
+                if words else np.zeros(0, dtype=np.int64))
+        n_rows = self._n_rows
+
+        temporary_path = path + ".tmp.npz"
+        np.savez(temporary_path, generation=self.generation,
+                words=np.array(words, dtype=str), offsets=offsets, entries=entries,
+                id_keys=np.array([key or "" for key in self.id_keys], dtype=str),
+                sources=np.array(self.sources, dtype=str),
+                lengths=self._lengths[:n_rows], alive=self._alive[:n_rows],
+                elos=self._elos[:n_rows], types=self._types[:n_rows],
+                levels=self._levels[:n_rows], strains=self._strains[:n_rows])
+        os.replace(temporary_path, path)
+
+        return None
+
+    @classmethod
+    def load(cls, path):
+        """Read an index written by save(), or return None if there is none."""
+
+        if not os.path.exists(path):
+            return None
+
+        index = cls()
+        with np.load(path) as data:
+            index.generation = int(data["generation"])
+            offsets = data["offsets"]
+            entries = data["entries"]
+            index.postings = {str(word) : entries[offsets[position]:offsets[position + 1]]
+                    for position, word in enumerate(data["words"].tolist())}
+
+            alive = data["alive"]
+            index.id_keys = [key if is_alive else None for key, is_alive in
+                    zip(data["id_keys"].tolist(), alive.tolist())]
+            index.row_by_key = {key : row for row, key in enumerate(index.id_keys)
+                    if key is not None}
+            index.sources = data["sources"].tolist()
+            index._n_rows = len(alive)
+            index._alive = alive
+            index._lengths = data["lengths"]
+            index._elos = data["elos"]
+            index._types = data["types"]
+            index._levels = data["levels"]
+            index._strains = data["strains"]
+            index._total_length = float(index._lengths[alive].sum())
+
+        return index
+
+    def _grow(self, n_rows):
+        """Make room for n_rows rows, doubling the arrays as needed."""
+
+        if n_rows <= len(self._alive):
+            return None
+
+        capacity = max(n_rows, 2*len(self._alive), 1024)
+        for name in ["_lengths", "_alive", "_elos", "_types", "_levels", "_strains"]:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+        return None
+
+    def _word_arrays(self, word):
+        """Return (rows, term frequencies) of a word, as arrays."""
+
+        arrays = self._arrays.get(word)
+        if arrays is None:
+            entry_rows = self.postings.get(word, np.zeros(0, dtype=np.int64)) // ROW_STRIDE
+            # Entries are sorted, so each row's entries are a run.
+            starts = np.flatnonzero(np.diff(entry_rows, prepend=-1))
+            frequencies = np.diff(np.append(starts, len(entry_rows))).astype(np.float64)
+            arrays = self._arrays[word] = (entry_rows[starts], frequencies)
+
+        return arrays
+
+    def _filter_mask(self, filters):
+        """Return a boolean array of the rows passing filters."""
+
+        n_rows = self._n_rows
+        mask = np.ones(n_rows, dtype=bool)
+        for name, value in filters.items():
+            if value is None:
+                continue
+            if name == "elo":
+                low, high = value
+                elos = self._elos[:n_rows]
+                if low is not None:
+                    mask &= elos >= low
+                if high is not None:
+                    mask &= elos <= high
+            elif name == "problem_type":
+                mask &= self._types[:n_rows] == _code(hand_features.PROBLEM_TYPES, value)
+            elif name == "contract_level":
+                mask &= self._levels[:n_rows] == value
+            elif name == "contract_strain":
+                mask &= self._strains[:n_rows] == _code(hand_features.STRAINS, value)
+            else:
+                UNKNOWN_FILTER_ERROR = "filter not understood: {}".format(name)
+                raise AssertionError(UNKNOWN_FILTER_ERROR)
+
+        return mask
+
+    def _phrase_mask(self, phrase, n_rows):
+        """Return a boolean array of the rows containing a phrase."""
+
+        mask = np.zeros(n_rows, dtype=bool)
+        word_entries = [self.postings.get(word) for word in phrase]
+        if any(entries is None for entries in word_entries):
+            return mask
+
+        # Start from the rarest word's entries, and look up where each
+        # other word would have to be.
+        rarest = min(range(len(phrase)), key=lambda offset: len(word_entries[offset]))
+        starts = word_entries[rarest] - rarest
+        for offset, entries in enumerate(word_entries):
+            if offset == rarest or not len(starts):
+                continue
+            wanted = starts + offset
+            found = np.searchsorted(entries, wanted)
+            found[found == len(entries)] = 0
+            starts = starts[entries[found] == wanted]
+
+        mask[starts // ROW_STRIDE] = True
+
+        return mask
+
+def _code(values, value):
+    """Return the index of value in values, or -1 for None."""
+
+    return values.index(value) if value is not None else -1
+
+def _id_key(hand_id):
+    """Return a string key of a hand _id, as stored in the index file."""
+
+    return json_util.dumps(hand_id)
+
+def journal_path(path):
+    return path + ".journal"
+
+def build_index(hand_storage):
+    """Return a SearchIndex of every hand in storage."""
+
+    index = SearchIndex()
+    index.generation = hand_storage.read_generation()
+    index.add_many(hand_storage.iter_hands())
+
+    return index
+
+def record_change(hand_json=None, removed_id=None, generation=None,
+        path=DEFAULT_INDEX_PATH):
+    """
+    Append a change to the index journal, to be applied when the index is
+    next opened.
+
+    A change is one generation bump. Several entries with the same
+    generation, e.g. the hands of one import, are one change.
+
+    Parameters:
+        hand_json (json) optional, a hand added or edited, in full.
+        removed_id (hand _id) optional, a hand deleted.
+        generation (int) the hands generation before the change, read
+            before writing the hands.
+        path (string) the index file.
+    """
+
+    # Without a saved index, the next open builds one from storage.
+    if not os.path.exists(path):
+        return None
+
+    entry = {"generation" : generation}
+    if hand_json is not None:
+        entry["hand"] = hand_json
+    if removed_id is not None:
+        entry["removed"] = removed_id
+
+    with open(journal_path(path), "a") as journal_file:
+        journal_file.write(json_util.dumps(entry) + "\n")
+
+    return None
+
+def open_index(hand_storage, path=DEFAULT_INDEX_PATH):
+    """
+    Return the search index of every hand in storage.
+
+    The saved index is read and the journal replayed, and if it held any
+    changes the index is saved again, so the journal does not grow
+    forever. A journal entry is replayed only if it starts from the
+    generation the index is at, which its change then advances by one.
+    If hands changed without being journaled, the generations do not line
+    up, and the index, like a missing one, is rebuilt from storage and
+    saved.
+    """
+
+    index = SearchIndex.load(path)
+    n_replayed = 0
+    if index is not None and os.path.exists(journal_path(path)):
+        change_generation = None
+        with open(journal_path(path)) as journal_file:
+            for line in journal_file:
+                if not line.strip():
+                    continue
+                entry = json_util.loads(line)
+                generation = entry.get("generation")
+                if generation == index.generation:
+                    # The first entry of the next change.
+                    change_generation = generation
+                    index.generation = generation + 1
+                elif generation is None or generation != change_generation:
+                    # A change was made without being journaled.
+                    index = None
+                    break
+                if "removed" in entry:
+                    index.remove(entry["removed"])
+                if "hand" in entry:
+                    index.add(entry["hand"])
+                n_replayed += 1
+
+    if index is None or index.generation != hand_storage.read_generation():
+        index = build_index(hand_storage)
+        save_index(index, path)
+    else:
+        # Elo changes are not journaled.
+        for hand_elo, hand_id in hand_storage.hand_elos():
+            index.update_elo(hand_id, hand_elo)
+
+        # Fold the journal into the saved index. A change journaled
+        # meanwhile is lost with the journal, but it also bumped the
+        # generation, so the next open rebuilds.
+        if n_replayed:
+            save_index(index, path)
+
+    return index
+
+def save_index(index, path=DEFAULT_INDEX_PATH):
+    """Save the index and empty its journal, which it now includes."""
+
+    index.save(path)
+    with open(journal_path(path), "w"):
+        pass
+
+    return None
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["build", "search"])
+    parser.add_argument("query", nargs="*", help="search: words and quoted phrases")
+    parser.add_argument("--storage", choices=["mongo", "sqlite"], default=None,
+            help="backend, default BRIDGE_STORAGE")
+    parser.add_argument("--path", default=DEFAULT_INDEX_PATH)
+    parser.add_argument("--type", choices=hand_features.PROBLEM_TYPES)
+    parser.add_argument("--contract", help="e.g. 3N or 4S")
+    parser.add_argument("--source", help="substring of the source")
+    parser.add_argument("--elo", type=float, help="rating of the problem")
+    parser.add_argument("--window", type=float, default=100)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    hand_storage = (storage.open_storage(args.storage) if args.storage
+            else storage.get_storage())
+
+    if args.command == "build":
+        index = build_index(hand_storage)
+        save_index(index, args.path)
+        print("{} hands, {} words".format(len(index), len(index.postings)))
+
+    else:
+        index = open_index(hand_storage, args.path)
+        level, strain = hand_features.parse_contract(args.contract)
+        filters = {"problem_type" : args.type, "contract_level" : level,
+                "contract_strain" : strain, "source" : args.source}
+        if args.elo is not None:
+            filters["elo"] = (args.elo - args.window, args.elo + args.window)
+
+        # Quoted phrases arrive without their quotes if not escaped.
+        query = " ".join('"{}"'.format(part) if " " in part else part
+                for part in args.query)
+        for hand_id, score in index.search(query, filters, args.limit):
+            hand_json = hand_storage.get_hand(hand_id)
+            print("{} {:6.2f} {}".format(hand_id, score, json.dumps(
+                (hand_json.get("question") or hand_json.get("context", ""))[:80])))
@@ -0,0 +1,340 @@
+"""
+Asynchronous HTTP frontend for the quiz.
+
+Unlike the Streamlit app, which reruns session.py on every answer, the
+server loads the hands, caches and indexes once, keeps each session's
+hand on screen in memory (see quiz.py), and does only the work a request
+needs. Connections are handled by an asyncio event loop from the standard
+library; the blocking storage calls run in a thread pool, so a slow query
+does not stall other connections.
+
+Endpoints:
+    GET  /          the quiz page
+    GET  /next      the session's problem: the hand on screen if it is
+                    unanswered, otherwise a new one. JSON.
+    POST /answer    grade {"answer" : "..."} against the hand on screen.
+                    JSON, or 409 if there is no unanswered hand.
+    GET  /stats     cache, event sink and session counters. JSON.
+
+Each endpoint takes a "username" query parameter, default guest. The
+session is the "session" query parameter, or else the bridge_session
+cookie, which is set on the first response.
+
+Usage:
+    python server.py --port 8080
+    BRIDGE_STORAGE=sqlite python server.py --threads 16
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import traceback
+import urllib.parse
+import uuid
+from instrumentation import get_metrics
+from quiz import Quiz
+
+SESSION_COOKIE = "bridge_session"
+MAX_BODY_SIZE = 64 * 1024
+MAX_HEADERS = 100
+MAX_LINE_SIZE = 64 * 1024 # of the request line and of each header line.
+
+STATUS_TEXT = {200 : "OK", 400 : "Bad Request", 404 : "Not Found",
+        405 : "Method Not Allowed", 409 : "Conflict",
+        413 : "Payload Too Large", 414 : "URI Too Long",
+        431 : "Request Header Fields Too Large", 500 : "Internal Server Error",
+        503 : "Service Unavailable"}
+
+INDEX_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Bridge problems</title></head>
+<body>
+<p>Username: <input id="username" value="guest"></p>
+<h3 id="header"></h3>
+<div id="feedback"></div>
+<div id="hand"></div>
+<form id="form"><input id="answer" autocomplete="off"> <button>Answer</button></form>
+<script>
+function query() {
+  return "?username=" + encodeURIComponent(document.getElementById("username").value);
+}
+async function next() {
+  const response = await fetch("/next" + query());
+  const problem = await response.json();
+  if (!response.ok) {
+    document.getElementById("header").textContent = problem.error;
+    return;
+  }
+  document.getElementById("header").textContent = "You are rated: "
+    + Math.round(problem.player_elo) + " This hand is rated: " + Math.round(problem.hand_elo);
+  document.getElementById("hand").innerHTML = problem.html;
+  document.getElementById("answer").value = "";
+}
+document.getElementById("form").onsubmit = async function(event) {
+  event.preventDefault();
+  const response = await fetch("/answer" + query(), {method: "POST",
+    body: JSON.stringify({answer: document.getElementById("answer").value})});
+  if (response.ok) {
+    const result = await response.json();
+    const feedback = document.getElementById("feedback");
+    feedback.style.color = result.correct ? "green" : "red";
+    feedback.textContent = result.correct
+      ? "Correct!" : "Incorrect. Correct answer is " + result.correct_answer;
+  }
+  next();
+};
+next();
+</script>
+</body></html>
+"""
+
+class HTTPError(Exception):
+    """An error response, e.g. HTTPError(404, "no such endpoint")."""
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+async def read_line(reader, status, what):
+    """Read one line, raising HTTPError(status) if it is over MAX_LINE_SIZE."""
+
+    try:
+        return await reader.readline()
+    except ValueError:
+        raise HTTPError(status, "{} over {} bytes".format(what, MAX_LINE_SIZE))
+
+async def read_request(reader):
+    """
+    Read one HTTP/1.1 request.
+
+    Returns:
+        request (dict) method, path, query, headers, body; or None if the
+        client closed the connection.
+    """
+
+    request_line = await read_line(reader, 414, "request line")
+    if not request_line:
+        return None
+
+    parts = request_line.decode("latin-1").split()
+    if len(parts) != 3:
+        raise HTTPError(400, "malformed request line")
+    method, target, version = parts
+
+    headers = {}
+    while True:
+        line = await read_line(reader, 431, "header line")
+        if line in [b"\r\n", b"\n", b""]:
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise HTTPError(400, "too many headers")
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    # Content-Length is digits only: int() would also take "-1", "+5"
+    # and "1_000".
+    content_length_value = headers.get("content-length", "") or "0"
+    if not (content_length_value.isascii() and content_length_value.isdigit()):
+        raise HTTPError(400, "invalid content-length: {!r}".format(
+            content_length_value[:40]))
+    content_length = int(content_length_value)
+    if content_length > MAX_BODY_SIZE:
+        raise HTTPError(413, "request body over {} bytes".format(MAX_BODY_SIZE))
+    body = await reader.readexactly(content_length) if content_length else b""
+
+    url = urllib.parse.urlsplit(target)
+    query = {key : values[-1] for key, values in
+            urllib.parse.parse_qs(url.query).items()}
+
+    return {"method" : method, "path" : url.path, "query" : query,
+            "headers" : headers, "body" : body, "version" : version}
+
+def encode_response(status, body, content_type="application/json",
+        headers=None, keep_alive=True):
+    """Return the bytes of an HTTP/1.1 response."""
+
+    lines = ["HTTP/1.1 {} {}".format(status, STATUS_TEXT.get(status, "")),
+            "Content-Type: {}".format(content_type),
+            "Content-Length: {}".format(len(body)),
+            "Connection: {}".format("keep-alive" if keep_alive else "close")]
+    for name, value in (headers or {}).items():
+        lines.append("{}: {}".format(name, value))
+
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+def session_id_of(request):
+    """Return (session id, is_new) from the query or the session cookie."""
+
+    if "session" in request["query"]:
+        return request["query"]["session"], False
+
+    for cookie in request["headers"].get("cookie", "").split(";"):
+        name, _, value = cookie.strip().partition("=")
+        if name == SESSION_COOKIE and value:
+            return value, False
+
+    return uuid.uuid4().hex, True
+
+class QuizServer(object):
+    """
+    Routes HTTP requests to a Quiz, running its blocking calls in a
+    thread pool.
+    """
+
+    def __init__(self, quiz, threads=8):
+        """
+        Parameters:
+            quiz (quiz.Quiz)
+            threads (int) size of the thread pool for storage calls.
+        """
+
+        self.quiz = quiz
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads,
+                thread_name_prefix="quiz")
+        self.requests = 0
+        self.errors = 0
+
+    async def call(self, function, *args):
+        """
+        Run a blocking function in the thread pool, timed as a rerun named
+        after it (see instrumentation.py).
+        """
+
+        def timed_call():
+            metrics = get_metrics()
+            metrics.start_rerun(function.__name__)
+            try:
+                return function(*args)
+            finally:
+                metrics.finish_rerun()
+                metrics.maybe_dump()
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, timed_call)
+
+    async def handle_connection(self, reader, writer):
+        """Serve requests on one connection until it is closed."""
+
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HTTPError as error:
+                    writer.write(encode_response(error.status, json.dumps(
+                        {"error" : str(error)}).encode("utf-8"), keep_alive=False))
+                    break
+                if request is None:
+                    break
+
+                keep_alive = (request["headers"].get("connection", "").lower() != "close"
+                        and request["version"] == "HTTP/1.1")
+                status, body, content_type, headers = await self.respond(request)
+                writer.write(encode_response(status, body, content_type, headers,
+                    keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, request):
+        """Return (status, body, content type, headers) for a request."""
+
+        self.requests += 1
+        session_id, new_session = session_id_of(request)
+        headers = {}
+        if new_session:
+            headers["Set-Cookie"] = "{}={}; Path=/; HttpOnly".format(
+                    SESSION_COOKIE, session_id)
+
+        try:
+            if request["path"] == "/":
+                return 200, INDEX_PAGE.encode("utf-8"), "text/html; charset=utf-8", headers
+
+            result = await self.route(request, session_id)
+            return 200, json.dumps(result).encode("utf-8"), "application/json", headers
+
+        except HTTPError as error:
+            status, result = error.status, {"error" : str(error)}
+        except Exception:
+            traceback.print_exc()
+            status, result = 500, {"error" : "internal error"}
+
+        # Client errors, e.g. an answer before GET /next, are not server
+        # errors.
+        if status >= 500:
+            self.errors += 1
+        return status, json.dumps(result).encode("utf-8"), "application/json", headers
+
+    async def route(self, request, session_id):
+        """Dispatch an API request, returning its JSON result."""
+
+        path = request["path"]
+        username = request["query"].get("username", "guest")
+        session_key = (session_id, username)
+
+        if path == "/next":
+            problem = await self.call(self.quiz.next_problem, session_key, username)
+            if problem is None:
+                raise HTTPError(503, "no hands in the database")
+            return problem
+
+        if path == "/answer":
+            if request["method"] != "POST":
+                raise HTTPError(405, "use POST")
+            try:
+                user_answer = json.loads(request["body"] or b"{}")["answer"]
+            except (ValueError, KeyError, TypeError):
+                raise HTTPError(400, 'body must be {"answer" : "..."}')
+            if not isinstance(user_answer, str) or not user_answer:
+                raise HTTPError(400, "answer must be a non-empty string")
+            result = await self.call(self.quiz.submit_answer, session_key,
+                    username, user_answer)
+            if result is None:
+                raise HTTPError(409, "no unanswered hand; GET /next first")
+            return result
+
+        if path == "/stats":
+            stats = await self.call(self.quiz.stats)
+            stats["server"] = {"requests" : self.requests, "errors" : self.errors}
+            return stats
+
+        raise HTTPError(404, "no such endpoint: {}".format(path))
+
+    async def start(self, host, port):
+        """Start listening, returning the asyncio server."""
+
+        return await asyncio.start_server(self.handle_connection, host, port,
+                limit=MAX_LINE_SIZE)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+async def serve(host, port, threads):
+    """Serve the quiz until cancelled."""
+
+    quiz_server = QuizServer(Quiz.create(), threads)
+    server = await quiz_server.start(host, port)
+    print("serving on http://{}:{}".format(host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        quiz_server.close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--threads", type=int,
+            default=int(os.environ.get("BRIDGE_SERVER_THREADS", 8)),
+            help="thread pool size for storage calls")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.threads))
+    except KeyboardInterrupt:
+        pass
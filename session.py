@@ -1,12 +1,17 @@
 import os
 import json 
-import numpy as np
-from render_hand import render_four_hands_with_question
-import sqlite3
-import elo
-import pymongo
+from render_hand import render_hand_json, prerender_hands
+from hand_selection import EloIndex
+from hand_cache import HandCache
+from session_state import ShownHandStore
+from quiz import (lookup_user_elo, lookup_shown_record, grade_answer,
+        choose_hand, refresh_elo_index, show_hand)
 import streamlit
-import datetime
+import db
+import event_sink
+import rating_updates
+import storage
+from instrumentation import get_metrics
 
 
 def provide_feedback(user_was_correct, feedback_widget):
@@ -34,25 +39,6 @@ def provide_feedback(user_was_correct, feedback_widget):
     
     feedback_widget.markdown(feedback_msg, unsafe_allow_html = True)
 
-def test_if_correct_answer(user_answer, correct_answer):
-    """Return True if user gave the correect answer
-
-    Parameters:
-    -----------
-    user_answer (string)
-    correct_answer (string)
-
-    Returns:
-    correct (Boolean)
-
-    Currently, we validate by checking for an exact but case-insensitive
-    string match. As a future direction we should consider cases where
-    more flexibility may be desired, for example allowing "F" (false) to 
-    count when "N" (no) is the correct answer.
-    """
-
-    return user_answer.lower() == correct_answer.lower()
-
 def show_hand_header(player_elo, hand_json, header_widget):
     """
     Display a brief header for each hand, retuning None.
@@ -79,156 +65,125 @@ def show_hand_header(player_elo, hand_json, header_widget):
 
     return None
 
-def load_hands():
-    """Load hands list of json objects.
+@streamlit.cache(allow_output_mutation=True)
+def load_elo_index():
+    """Load the index of hand ids sorted by elo.
 
-    The hands are loaded from the PyMongo database bridge_problem_database,
-    collection "hands"
+    The index is built once per process from the storage backend (see
+    storage.py), reading only the elo and _id of each hand. Streamlit
+    caches the result across reruns, and the app keeps it current by
+    calling elo_index.update() after each elo change.
 
-    Output: hands, json[]. Example:
+    Output: elo_index, hand_selection.EloIndex
+    """
 
-       "n_hand" : ["SQ", "S6", "S2", "HA", "HK", "H6", "H2", "DA", "DQ", "D5", "CK", "C3", "C2"],
-       "s_hand" : ["SA", "SK", "SJ", "ST", "S5", "HQ", "H7", "H3", "D7", "D4", "C8", "C7", "C5"],
-       "w_hand" : ["S9", "S8", "S3", "HT", "H5", "DJ", "D9", "D8", "D6", "D3", "CJ", "C9", "C6"],
-       "e_hand" : ["S7", "S4", "HJ", "H9", "H8", "H4", "DK", "DT", "D2", "CA", "CQ", "CT", "C4"],
-       "context" : "Contract: 4 spades. You draw trumps in three rounds and play three top hearts ending in dummy, East having 4H. Which suit do you play next?",
-       "correct_answer" : "H",
-       "_id" : hexadecimal id object,
-       "elo" : 1200,
-       "hidden_hands" : "NS"
+    hand_storage = storage.get_storage()
+    elo_index = EloIndex.from_storage(hand_storage)
+    elo_index.generation = hand_storage.read_generation()
 
-    Todo, as a future direction this function may be eliminated. It should be possible to randomly
-    query the hands directly as a MongoDB cursor object. No python lists needed.
-    """
+    return elo_index
 
-    # Connect to PyMongo database which stores the hands.
-    client = pymongo.MongoClient()
-    db = client["bridge_problem_database"]
-    hands_collection = db["hands"]
-    
-    # Get all hands from the database, as a list of JSON objects.
-    all_hands = hands_collection.find({})
-    hands_json = list(all_hands)
-    
-    return hands_json
 
+@streamlit.cache(allow_output_mutation=True)
+def load_hand_cache():
+    """Create the process-wide cache of hand documents.
 
-def render_hands_in_streamlit(hand_json, hands_widget):
-    """Helper function to render hand diagram in streamlit.
-    
-    Parameters:
-    ----------------
-    hand_json : json object containing 4 hands, context, etc.
-    hands_widget: streamlit widget, to which the hands will be written.
+    Streamlit caches the result across reruns, so hand documents are read
+    from the database once and then served from memory until a hand is
+    added or edited (see hand_cache.py).
 
-    Returns:
-    ---------------
-    None
+    With the environment variable BRIDGE_PRERENDER=1, every hand is also
+    loaded into the cache and rendered once, when the app starts.
 
-    Renders the hands in HTML + markdown by calling 
-    render_hands.render_four_hands_with_context()
+    Output: hand_cache, hand_cache.HandCache
     """
 
-    # Show the hand.
-    list_of_hands = [
-            hand_json["n_hand"],
-            hand_json["w_hand"],
-            hand_json["s_hand"],
-            hand_json["e_hand"]
-            ]
-    question = hand_json["question"]
-    correct_answer = hand_json["correct_answer"]
-    hidden_hands = hand_json["hidden_hands"]
-    auction_string = hand_json["auction"]
-    dealer_string = hand_json["dealer"]
-
-    rendered_hands = render_four_hands_with_question(
-            list_of_hands=list_of_hands, 
-            question=question,
-            hidden_hands=hidden_hands,
-            auction_string=auction_string,
-            dealer_string=dealer_string
-            )
+    hand_storage = storage.get_storage()
+    hand_cache = HandCache(hand_storage)
 
-    hands_widget.markdown(rendered_hands, unsafe_allow_html=True)
-    
-    return None
+    if os.environ.get("BRIDGE_PRERENDER") == "1":
+        all_hands = list(hand_storage.iter_hands())
+        hand_cache.preload(all_hands)
+        prerender_hands(all_hands)
 
+    return hand_cache
 
-def lookup_user_elo(username, user_collection):
-    """Lookup a user's ELO rating.
 
-    Parameters:
-    -----------
-    username (string)
-    user_collection (pymongo collection object)
+@streamlit.cache(allow_output_mutation=True)
+def load_shown_hand_store():
+    """Create the process-wide store of the hand each session is shown.
 
-    Returns:
-    ----------
-    player_elo (numeric) e.g. 1200
+    Output: shown_hand_store, session_state.ShownHandStore
     """
 
-    params = {"username" : username}
-    query_result = user_collection.find_one(params)
-    
-    if query_result:
-        player_elo = query_result["elo"]
-    else:
-        player_elo = 1200
+    return ShownHandStore()
+
+
+@streamlit.cache(allow_output_mutation=True)
+def ensure_indexes():
+    """Create the indexes every query of the app relies on, once per process.
+
+    See schema.py and storage.py. Creating an index which already exists
+    is a no-op.
+    """
 
-    return player_elo
+    storage.get_storage().ensure_indexes()
 
-def log_showing_hand(hand_json, username, events_collection):
-    """Log that a hand was shown to the user in the events collection.
+    return True
+
+
+def get_session_key(username):
+    """Return a key identifying this browser session and user.
 
     Parameters:
     -----------
-    hand_json (json)
     username (string)
-    events_collection (pymongo collection object)
 
     Returns:
-    ------------
-    None
-
-    Writes to the events collection a row with
-    username, hand_id, correct_answer, timestamp.
+    ----------
+    session_key (tuple or string) (streamlit session id, username), or
+    username alone if this streamlit version does not expose session ids.
     """
 
-    event_record = {
-        "username" : username,
-        "hand_id" : hand_json["_id"],
-        "correct_answer" : hand_json["correct_answer"],
-        "timestamp" : datetime.datetime.now().timestamp()
-    }
-    events_collection.insert_one(event_record)
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:
+        try:
+            from streamlit.report_thread import get_report_ctx as get_script_run_ctx
+        except ImportError:
+            return username
 
-    return None
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return username
 
-def lookup_correct_answer(events_collection, username):
-    """Lookup the correct answer
+    return (ctx.session_id, username)
 
-    Paramters:
-    ----------
-    events_collection (pymongo collection)
-    username (string)
+
+def render_hands_in_streamlit(hand_json, hands_widget):
+    """Helper function to render hand diagram in streamlit.
+    
+    Parameters:
+    ----------------
+    hand_json : json object containing 4 hands, context, etc.
+    hands_widget: streamlit widget, to which the hands will be written.
 
     Returns:
-    ----------
-    correct_answer (string)
+    ---------------
+    None
 
-    Strategy: the correct answer is the SECOND-most recent row
-    shown to this user. It is not the first row since the code executes
-    from top to bottom, thus a new hand was shown before the answer was 
-    looked up.
+    Renders the hands in HTML + markdown by calling 
+    render_hand.render_hand_json(), which only builds the HTML the first
+    time a problem is shown.
     """
 
-    params = {"username" : username}
-    events_sorted_by_timestamp = events_collection.find(params).sort(
-            "timestamp", pymongo.DESCENDING)
-    second_most_recent_event = events_sorted_by_timestamp[1]
+    # Show the hand.
+    rendered_hands = render_hand_json(hand_json)
+
+    hands_widget.markdown(rendered_hands, unsafe_allow_html=True)
+    
+    return None
 
-    return second_most_recent_event["correct_answer"]
 
 #################################################################
 ################## Start Streamlit App #########################
@@ -237,25 +192,31 @@ def lookup_correct_answer(events_collection, username):
 # Streamlit renders the following code in declarative style from
 # top to bottom. 
 
+# Time each stage of this rerun, see instrumentation.py.
+metrics = get_metrics()
+metrics.start_rerun()
+
 # Allow the user to log in on the sidebar.
 username = streamlit.sidebar.text_input("Username:", value="guest")
 
-# Load all hands from the database, and randomize their order
-# of presentation.
-hands = load_hands()
-hand_indices = np.arange(len(hands), dtype=np.int8)
-np.random.shuffle(hands)
+# Hands, users and events (hands shown to users) are read and written
+# through the process-wide storage backend: Mongo, or an embedded SQLite
+# file with BRIDGE_STORAGE=sqlite. See storage.py.
+with metrics.stage("connect"):
+    app_storage = storage.get_storage()
+
+    # Events are written in batches by a background thread.
+    sink = event_sink.get_event_sink()
+
+    # Elo changes are added atomically, optionally in batches.
+    rating_updater = rating_updates.get_rating_updater()
 
-# Connect to the "hands", "user", and "events" collections in 
-# the database.
-client = pymongo.MongoClient()
-db = client["bridge_problem_database"]
-hands_collection = db["hands"]
-user_collection = db["user"]
-events_collection = db["events"] # hands shown to users.
+# Make sure the queries below are served by indexes.
+with metrics.stage("ensure_indexes"):
+    ensure_indexes()
 
 # Look up user ELO from the database. 
-player_elo = lookup_user_elo(username, user_collection)
+player_elo = lookup_user_elo(username, app_storage, rating_updater)
 
 # Initialize empty streamlit "widgets" to write page components
 # to. By using widgets, we are able to over-write the content
@@ -265,54 +226,81 @@ feedback_widget = streamlit.empty() # correct/incorrect.
 hands_widget = streamlit.empty()
 response_widget = streamlit.empty()
 
-# Show the user a hand and log to the database that the hand was shown.
-hand_json = hands.pop()
-show_hand_header(player_elo=player_elo,
-    header_widget=header_widget,
-    hand_json=hand_json)
-render_hands_in_streamlit(hand_json, hands_widget)
-log_showing_hand(hand_json=hand_json, 
-        username=username, events_collection=events_collection)
-
-# For debugging purposes, log the hand to the shell.
-# This is helpful to identify incorrectly added hands.
-print(hand_json)
-
-# Ask for an answer.
+with metrics.stage("load_caches"):
+    hand_cache = load_hand_cache()
+    elo_index = load_elo_index()
+    shown_hand_store = load_shown_hand_store()
+
+# Export the counters of the process-wide objects with the metrics dump,
+# rather than logging them every rerun. The pool statistics show whether
+# connections are being reused.
+metrics.register_counters("hand_cache", hand_cache.stats)
+metrics.register_counters("event_sink", sink.stats)
+metrics.register_counters("rating_updater", rating_updater.stats)
+if app_storage.name == "mongo":
+    metrics.register_counters("mongo_pool", db.get_pool_statistics)
+session_key = get_session_key(username)
+
+# Find the hand on screen, which is the hand being answered.
+shown = lookup_shown_record(shown_hand_store, session_key, username,
+        app_storage, sink)
+
+# Ask for an answer. Each hand shown gets its own answer box, so an
+# answer is graded once, against the hand it was typed for.
 # Note that when the user interacts enters an answer, 
 # the entire script will re-run.
-user_answer = response_widget.text_input("Your answer:")
+user_answer = None
+if shown is not None and not shown.get("answered"):
+    user_answer = response_widget.text_input("Your answer:",
+            key=shown["answer_key"])
 
 if user_answer not in [None, ""]:
 
-    # Lookup the correct answer, which is the second-to-most-
-    # recent row in the events table. It is the second to most
-    # recent row because the code above already showed one more hand.
-    correct_answer = lookup_correct_answer(events_collection, username)
+    # Grade the answer against the hand on screen, log it, and update the
+    # player and hand ELO (see quiz.py).
+    correct_answer = shown["correct_answer"]
+    graded = grade_answer(shown, username, user_answer, player_elo,
+            rating_updater, hand_cache, elo_index, sink)
 
-    # Calculate new player and hand ELO scores.
-    user_was_correct = test_if_correct_answer(user_answer, correct_answer)
-    hand_elo = hand_json["elo"]
-    new_player_elo, new_hand_elo = elo.get_new_elos(
-            player_elo, 
-            hand_elo, 
-            user_was_correct)
+    # The hand was deleted since it was shown: forget it, and show a new one.
+    if graded is None:
+        shown_hand_store.pop(session_key)
+        shown = None
+        feedback_widget.markdown("This hand was removed from the database; "
+                "here is a new one.")
 
     # Provide feedback to the user (correct/incorrect)
-    provide_feedback(user_was_correct, feedback_widget)
-
-    # Update player and hand ELO in the database.
-    # For now, the player ELO is only stored in the 
-    # current session, but a future direction is to 
-    # store player ELO across sessions.
-    hand_id = hand_json["_id"]
-    query = {"_id" : hand_id} # update rows matching this query.
-    update = {"$set" : {"elo" : new_hand_elo}} # update to perform.
-    hands_collection.update_one(query, update)
-
-    player_elo = new_player_elo
-    if username != "guest":
-        query = {"username" : username}
-        update = {"$set" : {"elo" : new_player_elo}}
-        user_collection.update_one(query, update)
-    
+    else:
+        user_was_correct, player_elo, new_hand_elo = graded
+        provide_feedback(user_was_correct, feedback_widget)
+
+# Keep an unanswered hand on screen. Otherwise choose the next hand,
+# rated near the player.
+hand_json = None
+if shown is not None and not shown.get("answered") and user_answer in [None, ""]:
+    hand_json = hand_cache.get(shown["hand_id"])
+new_hand = hand_json is None
+if new_hand:
+    exclude = shown["hand_id"] if shown is not None else None
+    hand_json = choose_hand(hand_cache, elo_index, player_elo, exclude)
+    if hand_json is None:
+        header_widget.markdown("There are no hands in the database.")
+        streamlit.stop()
+
+# If hands were added or edited since the index was read, re-read it
+# for the next rerun.
+refresh_elo_index(elo_index, hand_cache, app_storage)
+
+# Show the user the hand, and for a new hand log that it was shown and
+# remember it for grading the next answer.
+show_hand_header(player_elo=player_elo,
+    header_widget=header_widget,
+    hand_json=hand_json)
+with metrics.stage("render"):
+    render_hands_in_streamlit(hand_json, hands_widget)
+if new_hand:
+    shown = show_hand(hand_json, username, session_key, shown_hand_store, sink)
+    response_widget.text_input("Your answer:", key=shown["answer_key"])
+
+metrics.finish_rerun()
+metrics.maybe_dump()
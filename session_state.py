@@ -0,0 +1,106 @@
+"""
+Per-session record of the hand on screen, for grading answers.
+
+When a hand is shown, the app stores its id and expected answer under the
+session's key. When the answer arrives, grading is a dictionary lookup
+instead of a sorted query over the user's event history.
+
+If a session has no record (the store evicted it, the app restarted, or
+the user is in a new session), lookup_last_shown_event() finds the user's
+most recent "shown" event with the (username, timestamp) index of the
+events collection (see schema.py), and lookup_answer_since() whether the
+hand was answered after it was shown, so it is not graded twice.
+"""
+import collections
+import threading
+import pymongo
+
+class ShownHandStore(object):
+    """
+    Thread-safe map of session key -> shown hand record, holding at most
+    max_size sessions and evicting the least recently used.
+
+    A record is a dict with:
+        hand_id          _id of the hand shown
+        correct_answer   expected answer
+        answer_key       key of the answer widget for this hand, unique per
+                         showing, so every hand gets an empty answer box
+        answered         True once the answer was graded
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._records = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_key):
+        """Return the record shown to this session, or None."""
+
+        with self._lock:
+            record = self._records.get(session_key)
+            if record is not None:
+                self._records.move_to_end(session_key)
+
+        return record
+
+    def set(self, session_key, record):
+        """Record the hand now shown to this session."""
+
+        with self._lock:
+            self._records[session_key] = record
+            self._records.move_to_end(session_key)
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+
+        return None
+
+    def pop(self, session_key):
+        """Forget this session's record, returning it or None."""
+
+        with self._lock:
+            return self._records.pop(session_key, None)
+
+    def __len__(self):
+        return len(self._records)
+
+def shown_record(event_record, answered=False):
+    """
+    Return the store record for a "shown" event record, as logged by
+    quiz.log_showing_hand, with an _id.
+    """
+
+    return {
+        "hand_id" : event_record["hand_id"],
+        "correct_answer" : event_record["correct_answer"],
+        "answer_key" : "answer-{}".format(event_record["_id"]),
+        "answered" : answered,
+    }
+
+def lookup_last_shown_event(events_collection, username):
+    """
+    Return the most recent "shown" event of a user, or None.
+
+    The (username, timestamp) index serves both the filter and the sort,
+    so this reads one event however long the history is. Events logged
+    before event_type existed are all "shown".
+    """
+
+    params = {"username" : username, "event_type" : {"$ne" : "answer"}}
+
+    return events_collection.find_one(params,
+            sort=[("timestamp", pymongo.DESCENDING)])
+
+def lookup_answer_since(events_collection, username, hand_id, timestamp):
+    """
+    Return the user's first answer to a hand at or after timestamp, e.g.
+    that of the "shown" event, or None.
+
+    The (username, timestamp) index bounds the scan to the user's events
+    since the hand was shown.
+    """
+
+    params = {"username" : username, "timestamp" : {"$gte" : timestamp},
+            "event_type" : "answer", "hand_id" : hand_id}
+
+    return events_collection.find_one(params,
+            sort=[("timestamp", pymongo.ASCENDING)])
@@ -0,0 +1,652 @@
+"""
+Storage backends for hands, users and events.
+
+The app reads and writes through a Storage object rather than Mongo
+collections, so the same code runs on either backend:
+
+    MongoStorage    the MongoDB database of db.py.
+    SQLiteStorage   an embedded SQLite file, for a single-node deployment
+                    or a test run without a Mongo server. Reads are
+                    in-process calls.
+
+get_storage() returns the process-wide backend chosen by environment
+variables:
+    BRIDGE_STORAGE         mongo (default) or sqlite
+    BRIDGE_SQLITE_PATH     default bridge_problem_database.sqlite3
+
+Documents keep the Mongo layout on both backends. SQLite stores each one
+as MongoDB extended JSON, next to the columns queries filter and sort on.
+
+The maintenance scripts (alter_database.py, import_problems.py,
+replay_ratings.py) also write through get_storage(). migrate_storage.py
+copies one backend into the other; backup_database.py is Mongo only.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import bson
+from bson import json_util
+import pymongo
+import db
+import hand_cache
+import instrumentation
+import schema
+import session_state
+
+DEFAULT_SQLITE_PATH = "bridge_problem_database.sqlite3"
+
+DUPLICATE_KEY_ERROR = 11000
+
+class PartialWriteError(Exception):
+    """
+    Raised by Storage.increment_elos when only some of the deltas were
+    added. unapplied_hands and unapplied_users hold the ones which were
+    not, so a retry counts each change once.
+    """
+
+    def __init__(self, message, unapplied_hands, unapplied_users):
+        Exception.__init__(self, message)
+        self.unapplied_hands = unapplied_hands
+        self.unapplied_users = unapplied_users
+
+# Errors a backend raises when it cannot be written, e.g. the server is
+# down or the file is locked; a retry may succeed.
+WRITE_ERRORS = (pymongo.errors.PyMongoError, sqlite3.Error, PartialWriteError)
+
+logger = logging.getLogger(__name__)
+
+_storage = None
+_storage_lock = threading.Lock()
+
+class Storage(object):
+    """
+    Interface of the storage backends.
+
+    Hands are keyed by _id, users by username and events by _id.
+    """
+
+    name = "base"
+
+    # Hands.
+    def get_hand(self, hand_id):
+        """Return the hand document with this _id, or None."""
+        raise NotImplementedError
+
+    def iter_hands(self):
+        """Yield every hand document."""
+        raise NotImplementedError
+
+    def hand_elos(self):
+        """Return (elo, _id) pairs of every hand, in elo order."""
+        raise NotImplementedError
+
+    def get_hand_elo(self, hand_id):
+        """Return the stored elo of the hand with this _id, or None."""
+        hand_json = self.get_hand(hand_id)
+        return hand_json["elo"] if hand_json is not None else None
+
+    def count_hands(self):
+        raise NotImplementedError
+
+    def put_hands(self, hand_jsons):
+        """Insert hand documents, replacing any with the same _id."""
+        raise NotImplementedError
+
+    def insert_hands(self, hand_jsons):
+        """
+        Insert new hand documents, giving each without an _id a new one.
+
+        Returns:
+            (n_inserted, failures) failures is a list of (position in
+            hand_jsons, error message) of documents not inserted, e.g.
+            because their _id is taken.
+        """
+        raise NotImplementedError
+
+    def update_hand(self, hand_id, fields):
+        """Set fields of one hand, e.g. {"elo" : 1210.5, "updated_at" : ...}."""
+        raise NotImplementedError
+
+    # Users.
+    def get_user(self, username):
+        """Return the user document with this username, or None."""
+        raise NotImplementedError
+
+    def iter_users(self):
+        raise NotImplementedError
+
+    def put_users(self, user_jsons):
+        """Insert user documents, replacing any with the same username."""
+        raise NotImplementedError
+
+    def update_user(self, username, fields):
+        """Set fields of one existing user."""
+        raise NotImplementedError
+
+    def increment_elos(self, hand_deltas, user_deltas, updated_at):
+        """
+        Add deltas to the elos of existing hands and users, atomically per
+        document, so concurrent increments all count. If some deltas were
+        added and others not, raises PartialWriteError naming the others.
+
+        Parameters:
+            hand_deltas (dict) hand _id -> elo change.
+            user_deltas (dict) username -> elo change.
+            updated_at (float) timestamp set on every document changed.
+        """
+        raise NotImplementedError
+
+    # Events.
+    def insert_events(self, event_records):
+        """
+        Insert event records, which must have an _id. Records already
+        stored are skipped, so a batch can be retried.
+        """
+        raise NotImplementedError
+
+    def last_shown_event(self, username):
+        """Return the user's most recent "shown" event, or None."""
+        raise NotImplementedError
+
+    def answer_since(self, username, hand_id, timestamp):
+        """Return the user's first answer to a hand at or after timestamp, or None."""
+        raise NotImplementedError
+
+    def iter_events(self, event_type=None):
+        """Yield every event, or every event of one event_type, oldest first."""
+        raise NotImplementedError
+
+    def set_elos(self, hand_elos, user_elos, updated_at):
+        """
+        Overwrite stored elos, e.g. with ratings recomputed from the events.
+
+        Parameters:
+            hand_elos (dict) hand _id -> elo.
+            user_elos (dict) username -> elo.
+            updated_at (float) time.time() of the change.
+        """
+        raise NotImplementedError
+
+    # Hands generation, see hand_cache.py.
+    def read_generation(self):
+        raise NotImplementedError
+
+    def bump_generation(self):
+        raise NotImplementedError
+
+    def ensure_indexes(self):
+        """Create the indexes the queries above rely on."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class MongoStorage(Storage):
+    """Storage in the MongoDB database of db.py."""
+
+    name = "mongo"
+
+    def __init__(self, database=None):
+        """
+        Parameters:
+            database (pymongo database object) default db.get_database().
+        """
+
+        self.database = database if database is not None else db.get_database()
+        self.hands = self.database["hands"]
+        self.users = self.database["user"]
+        self.events = self.database["events"]
+        self.meta = self.database["meta"]
+
+    def get_hand(self, hand_id):
+        return self.hands.find_one({"_id" : hand_id})
+
+    def iter_hands(self):
+        return self.hands.find({})
+
+    def hand_elos(self):
+        cursor = self.hands.find({}, {"elo" : 1}).sort("elo", pymongo.ASCENDING)
+        return [(hand["elo"], hand["_id"]) for hand in cursor]
+
+    def get_hand_elo(self, hand_id):
+        hand = self.hands.find_one({"_id" : hand_id}, {"elo" : 1})
+        return hand["elo"] if hand is not None else None
+
+    def count_hands(self):
+        return self.hands.count_documents({})
+
+    def put_hands(self, hand_jsons):
+        updates = [pymongo.ReplaceOne({"_id" : hand_json["_id"]}, hand_json,
+            upsert=True) for hand_json in hand_jsons]
+        if updates:
+            self.hands.bulk_write(updates, ordered=False)
+
+    def insert_hands(self, hand_jsons):
+        if not hand_jsons:
+            return 0, []
+        try:
+            result = self.hands.insert_many(hand_jsons, ordered=False)
+            return len(result.inserted_ids), []
+        except pymongo.errors.BulkWriteError as error:
+            failures = [(write_error["index"], write_error["errmsg"])
+                    for write_error in error.details.get("writeErrors", [])]
+            return error.details.get("nInserted", 0), failures
+
+    def update_hand(self, hand_id, fields):
+        self.hands.update_one({"_id" : hand_id}, {"$set" : fields})
+
+    def get_user(self, username):
+        return self.users.find_one({"username" : username})
+
+    def iter_users(self):
+        return self.users.find({})
+
+    def put_users(self, user_jsons):
+        updates = [pymongo.ReplaceOne({"username" : user_json["username"]},
+            user_json, upsert=True) for user_json in user_jsons]
+        if updates:
+            self.users.bulk_write(updates, ordered=False)
+
+    def update_user(self, username, fields):
+        self.users.update_one({"username" : username}, {"$set" : fields})
+
+    def increment_elos(self, hand_deltas, user_deltas, updated_at):
+        # Hands and users are separate writes, and an unordered bulk write
+        # may apply some of its updates; its write errors name the others
+        # by index. A write which raised anything else is taken to have
+        # applied nothing.
+        unapplied = []
+        first_error = None
+        for collection, key_field, deltas in [(self.hands, "_id", hand_deltas),
+                (self.users, "username", user_deltas)]:
+            keys = list(deltas)
+            updates = [({key_field : key}, {"$inc" : {"elo" : deltas[key]},
+                "$set" : {"updated_at" : updated_at}}) for key in keys]
+            failed = []
+            try:
+                if len(updates) == 1:
+                    # One answer's change, without the overhead of a bulk write.
+                    collection.update_one(*updates[0])
+                elif updates:
+                    collection.bulk_write([pymongo.UpdateOne(*update)
+                        for update in updates], ordered=False)
+            except pymongo.errors.BulkWriteError as error:
+                first_error = first_error or error
+                failed = [keys[write_error["index"]]
+                    for write_error in error.details.get("writeErrors", [])]
+            except pymongo.errors.PyMongoError as error:
+                first_error = first_error or error
+                failed = keys
+            unapplied.append({key : deltas[key] for key in failed})
+
+        unapplied_hands, unapplied_users = unapplied
+        if first_error is None:
+            return None
+        if unapplied_hands == hand_deltas and unapplied_users == user_deltas:
+            raise first_error
+        raise PartialWriteError("{} of {} elo changes not added: {}".format(
+            len(unapplied_hands) + len(unapplied_users),
+            len(hand_deltas) + len(user_deltas), first_error),
+            unapplied_hands, unapplied_users)
+
+    def insert_events(self, event_records):
+        if not event_records:
+            return None
+        try:
+            self.events.insert_many(event_records, ordered=False)
+        except pymongo.errors.BulkWriteError as error:
+            # Records already in the collection are fine; others are bad
+            # records which no retry will fix.
+            write_errors = error.details.get("writeErrors", [])
+            n_bad = sum(1 for write_error in write_errors
+                    if write_error.get("code") != DUPLICATE_KEY_ERROR)
+            if n_bad:
+                logger.warning("storage: %d events rejected: %s", n_bad,
+                        write_errors[0].get("errmsg"))
+
+        return None
+
+    def last_shown_event(self, username):
+        return session_state.lookup_last_shown_event(self.events, username)
+
+    def answer_since(self, username, hand_id, timestamp):
+        return session_state.lookup_answer_since(self.events, username,
+                hand_id, timestamp)
+
+    def iter_events(self, event_type=None):
+        query = {} if event_type is None else {"event_type" : event_type}
+        return self.events.find(query).sort("timestamp", pymongo.ASCENDING)
+
+    def set_elos(self, hand_elos, user_elos, updated_at):
+        for collection, key_field, elos in [(self.hands, "_id", hand_elos),
+                (self.users, "username", user_elos)]:
+            updates = [pymongo.UpdateOne({key_field : key}, {"$set" : {"elo" : elo,
+                "updated_at" : updated_at}}) for key, elo in elos.items()]
+            if updates:
+                collection.bulk_write(updates, ordered=False)
+
+    def read_generation(self):
+        return hand_cache.read_generation(self.meta)
+
+    def bump_generation(self):
+        return hand_cache.bump_generation(self.meta)
+
+    def ensure_indexes(self):
+        return schema.ensure_indexes(self.database)
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hands (
+    id TEXT PRIMARY KEY,
+    elo REAL,
+    updated_at REAL,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hands_elo_id ON hands (elo, id);
+CREATE INDEX IF NOT EXISTS hands_updated_at ON hands (updated_at);
+
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    elo REAL,
+    updated_at REAL,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_updated_at ON users (updated_at);
+
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    username TEXT,
+    event_type TEXT,
+    timestamp REAL,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_username_timestamp ON events (username, timestamp);
+CREATE INDEX IF NOT EXISTS events_event_type_timestamp ON events (event_type, timestamp);
+CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+def _id_key(value):
+    """
+    Return the text key of an _id, e.g. '{"$oid": "5eb6..."}' for an
+    ObjectId and '"abc"' for a string, so keys of different types differ.
+    """
+
+    return json_util.dumps(value)
+
+def _dumps(document):
+    return json_util.dumps(document)
+
+def _loads(text):
+    return json.loads(text, object_hook=json_util.object_hook)
+
+class SQLiteStorage(Storage):
+    """
+    Storage in an embedded SQLite file.
+
+    Each thread gets its own connection. The database runs in WAL mode, so
+    readers do not wait for the writer, and every statement is
+    parameterized, so sqlite3 reuses its prepared form.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        """
+        Parameters:
+            path (string) database file, created if missing.
+        """
+
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SQLITE_SCHEMA)
+
+    def _connection(self):
+        """Return this thread's connection, opening it on first use."""
+
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit; writes which must be atomic use _transaction().
+            connection = sqlite3.connect(self.path, timeout=30,
+                    isolation_level=None, check_same_thread=False,
+                    cached_statements=256)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            # Count statements as round trips, see instrumentation.py.
+            connection.set_trace_callback(instrumentation.count_round_trip)
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+
+        return connection
+
+    def _transaction(self, statements):
+        """
+        Run (sql, parameters) statements in one write transaction.
+
+        Parameters:
+            statements (iterable) may be a generator, which can read inside
+                the transaction before yielding its writes.
+        """
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, parameters in statements:
+                if isinstance(parameters, list):
+                    connection.executemany(sql, parameters)
+                else:
+                    connection.execute(sql, parameters)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        return None
+
+    def get_hand(self, hand_id):
+        row = self._connection().execute("SELECT doc FROM hands WHERE id = ?",
+                (_id_key(hand_id),)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def iter_hands(self):
+        for (doc,) in self._connection().execute("SELECT doc FROM hands"):
+            yield _loads(doc)
+
+    def hand_elos(self):
+        rows = self._connection().execute(
+                "SELECT elo, id FROM hands ORDER BY elo, id").fetchall()
+        return [(elo, _loads(key)) for elo, key in rows]
+
+    def get_hand_elo(self, hand_id):
+        row = self._connection().execute("SELECT elo FROM hands WHERE id = ?",
+                (_id_key(hand_id),)).fetchone()
+        return row[0] if row else None
+
+    def count_hands(self):
+        return self._connection().execute("SELECT COUNT(*) FROM hands").fetchone()[0]
+
+    def put_hands(self, hand_jsons):
+        rows = [(_id_key(hand_json["_id"]), hand_json.get("elo"),
+            hand_json.get("updated_at"), _dumps(hand_json)) for hand_json in hand_jsons]
+        self._transaction([("INSERT OR REPLACE INTO hands (id, elo, updated_at, doc) "
+            "VALUES (?, ?, ?, ?)", rows)])
+
+    def insert_hands(self, hand_jsons):
+        connection = self._connection()
+        failures = []
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for position, hand_json in enumerate(hand_jsons):
+                hand_json.setdefault("_id", bson.ObjectId())
+                cursor = connection.execute("INSERT OR IGNORE INTO hands "
+                        "(id, elo, updated_at, doc) VALUES (?, ?, ?, ?)",
+                        (_id_key(hand_json["_id"]), hand_json.get("elo"),
+                            hand_json.get("updated_at"), _dumps(hand_json)))
+                if cursor.rowcount == 0:
+                    failures.append((position, "duplicate _id {}".format(
+                        hand_json["_id"])))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        return len(hand_jsons) - len(failures), failures
+
+    def _update_fields(self, table, key_column, key, fields):
+        """Read-modify-write one document inside a write transaction."""
+
+        connection = self._connection()
+
+        def statements():
+            row = connection.execute("SELECT doc FROM {} WHERE {} = ?".format(
+                table, key_column), (key,)).fetchone()
+            if row is None:
+                return
+            document = _loads(row[0])
+            document.update(fields)
+            yield ("UPDATE {} SET elo = ?, updated_at = ?, doc = ? WHERE {} = ?".format(
+                table, key_column), (document.get("elo"), document.get("updated_at"),
+                    _dumps(document), key))
+
+        self._transaction(statements())
+
+    def update_hand(self, hand_id, fields):
+        self._update_fields("hands", "id", _id_key(hand_id), fields)
+
+    def get_user(self, username):
+        row = self._connection().execute("SELECT doc FROM users WHERE username = ?",
+                (username,)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def iter_users(self):
+        for (doc,) in self._connection().execute("SELECT doc FROM users"):
+            yield _loads(doc)
+
+    def put_users(self, user_jsons):
+        rows = [(user_json["username"], user_json.get("elo"),
+            user_json.get("updated_at"), _dumps(user_json)) for user_json in user_jsons]
+        self._transaction([("INSERT OR REPLACE INTO users (username, elo, updated_at, doc) "
+            "VALUES (?, ?, ?, ?)", rows)])
+
+    def update_user(self, username, fields):
+        self._update_fields("users", "username", username, fields)
+
+    def increment_elos(self, hand_deltas, user_deltas, updated_at):
+        # SET expressions see the old row, so the document gets the new elo.
+        statements = []
+        for table, key_column, rows in [
+                ("hands", "id", [(delta, updated_at, _id_key(hand_id))
+                    for hand_id, delta in hand_deltas.items()]),
+                ("users", "username", [(delta, updated_at, username)
+                    for username, delta in user_deltas.items()])]:
+            if rows:
+                statements.append(("UPDATE {} SET elo = elo + ?1, updated_at = ?2, "
+                    "doc = json_set(doc, '$.elo', elo + ?1, '$.updated_at', ?2) "
+                    "WHERE {} = ?3".format(table, key_column), rows))
+        if statements:
+            self._transaction(statements)
+
+    def insert_events(self, event_records):
+        rows = [(_id_key(event["_id"]), event.get("username"), event.get("event_type"),
+            event.get("timestamp"), _dumps(event)) for event in event_records]
+        self._transaction([("INSERT OR IGNORE INTO events "
+            "(id, username, event_type, timestamp, doc) VALUES (?, ?, ?, ?, ?)", rows)])
+
+    def last_shown_event(self, username):
+        # Events logged before event_type existed are all "shown".
+        row = self._connection().execute("SELECT doc FROM events "
+                "WHERE username = ? AND (event_type IS NULL OR event_type != 'answer') "
+                "ORDER BY timestamp DESC LIMIT 1", (username,)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def answer_since(self, username, hand_id, timestamp):
+        # hand_id is inside the document, so filter on it here; the index
+        # bounds the rows to the user's answers since timestamp.
+        for (doc,) in self._connection().execute("SELECT doc FROM events "
+                "WHERE username = ? AND timestamp >= ? AND event_type = 'answer' "
+                "ORDER BY timestamp", (username, timestamp)):
+            event = _loads(doc)
+            if event.get("hand_id") == hand_id:
+                return event
+        return None
+
+    def iter_events(self, event_type=None):
+        if event_type is None:
+            rows = self._connection().execute(
+                    "SELECT doc FROM events ORDER BY timestamp")
+        else:
+            rows = self._connection().execute("SELECT doc FROM events "
+                    "WHERE event_type = ? ORDER BY timestamp", (event_type,))
+        for (doc,) in rows:
+            yield _loads(doc)
+
+    def set_elos(self, hand_elos, user_elos, updated_at):
+        statements = []
+        for table, key_column, rows in [
+                ("hands", "id", [(elo, updated_at, _id_key(hand_id))
+                    for hand_id, elo in hand_elos.items()]),
+                ("users", "username", [(elo, updated_at, username)
+                    for username, elo in user_elos.items()])]:
+            if rows:
+                statements.append(("UPDATE {} SET elo = ?1, updated_at = ?2, "
+                    "doc = json_set(doc, '$.elo', ?1, '$.updated_at', ?2) "
+                    "WHERE {} = ?3".format(table, key_column), rows))
+        if statements:
+            self._transaction(statements)
+
+    def read_generation(self):
+        row = self._connection().execute("SELECT value FROM meta WHERE key = ?",
+                (hand_cache.GENERATION_ID,)).fetchone()
+        return row[0] if row else 0
+
+    def bump_generation(self):
+        self._transaction([("INSERT INTO meta (key, value) VALUES (?, 1) "
+            "ON CONFLICT (key) DO UPDATE SET value = value + 1",
+            (hand_cache.GENERATION_ID,))])
+
+    def ensure_indexes(self):
+        # Created with the tables.
+        return None
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+def open_storage(name, sqlite_path=None):
+    """Return a new backend by name: "mongo" or "sqlite"."""
+
+    INVALID_STORAGE_ERROR = "storage must be mongo or sqlite, not {}".format(name)
+    assert name in ["mongo", "sqlite"], INVALID_STORAGE_ERROR
+
+    if name == "mongo":
+        return MongoStorage()
+
+    return SQLiteStorage(sqlite_path or os.environ.get("BRIDGE_SQLITE_PATH",
+        DEFAULT_SQLITE_PATH))
+
+def get_storage():
+    """
+    Return the process-wide backend chosen by BRIDGE_STORAGE, creating it
+    on first use.
+    """
+
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = open_storage(os.environ.get("BRIDGE_STORAGE", "mongo"))
+
+    return _storage
@@ -0,0 +1,199 @@
+"""
+Concurrency tests of rating_updates.py on SQLite: threads answering the
+same hands at once must not lose elo changes, and stay close to a serial
+replay of the answers. A Mongo write which fails partway must retry only
+what did not apply.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import os
+import random
+import sys
+import threading
+
+# Shared modules live in the repository root.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import numpy as np
+import pymongo
+import pytest
+import event_sink
+import quiz
+import rating_updates
+import replay_ratings
+import storage
+from hand_cache import HandCache
+from hand_selection import EloIndex
+
+N_THREADS = 8
+N_ANSWERS = 200
+HAND_IDS = ["hand0", "hand1"]
+USERNAMES = ["user0", "user1"]
+
+@pytest.mark.parametrize("flush_interval", [0.0, 0.01])
+def test_concurrent_deltas_all_count(tmp_path, flush_interval):
+    test_storage = storage.open_storage("sqlite", str(tmp_path / "bridge.sqlite3"))
+    test_storage.put_hands([{"_id" : hand_id, "elo" : 1200.0} for hand_id in HAND_IDS])
+    test_storage.put_users([{"username" : username, "elo" : 1200.0}
+        for username in USERNAMES])
+    rating_updater = rating_updates.RatingUpdater(test_storage, flush_interval)
+
+    # Each thread adds its own deltas to the shared hands and users, and
+    # records them; all start together so the writes interleave.
+    barrier = threading.Barrier(N_THREADS)
+    added = [[] for _ in range(N_THREADS)]
+
+    def answer(thread_index):
+        rng = random.Random(thread_index)
+        barrier.wait()
+        for _ in range(N_ANSWERS):
+            hand_id, username = rng.choice(HAND_IDS), rng.choice(USERNAMES)
+            hand_delta, player_delta = rng.uniform(-15, 15), rng.uniform(-15, 15)
+            rating_updater.add(hand_id, hand_delta, username, player_delta)
+            added[thread_index].append((hand_id, hand_delta, username, player_delta))
+
+    threads = [threading.Thread(target=answer, args=(thread_index,))
+            for thread_index in range(N_THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rating_updater.close()
+
+    expected = {key : 1200.0 for key in HAND_IDS + USERNAMES}
+    for hand_id, hand_delta, username, player_delta in sum(added, []):
+        expected[hand_id] += hand_delta
+        expected[username] += player_delta
+
+    for hand_id in HAND_IDS:
+        assert test_storage.get_hand(hand_id)["elo"] == pytest.approx(expected[hand_id])
+    for username in USERNAMES:
+        assert test_storage.get_user(username)["elo"] == pytest.approx(expected[username])
+    assert rating_updater.stats()["answers"] == N_THREADS*N_ANSWERS
+
+# Most a hand or player elo may differ from a serial replay of the answer
+# events after concurrent grading, see rating_updates.py: half of one
+# answer's largest change, K = 30. Drifts of a few points are typical.
+MAX_REPLAY_DRIFT = 15.0
+
+@pytest.mark.parametrize("n_threads", [1, N_THREADS])
+def test_concurrent_grading_matches_replay(tmp_path, n_threads):
+    test_storage = storage.open_storage("sqlite", str(tmp_path / "bridge.sqlite3"))
+    test_storage.put_hands([{"_id" : hand_id, "elo" : 1200.0,
+        "correct_answer" : "SA"} for hand_id in HAND_IDS])
+    test_storage.put_users([{"username" : "user{}".format(thread_index),
+        "elo" : 1200.0} for thread_index in range(n_threads)])
+    rating_updater = rating_updates.RatingUpdater(test_storage, 0.01)
+    sink = event_sink.EventSink(test_storage, flush_interval=0.01)
+    hand_cache = HandCache(test_storage)
+    elo_index = EloIndex.from_storage(test_storage)
+
+    # Each thread is one player, answering the shared hands through the
+    # same grading path as the app.
+    barrier = threading.Barrier(n_threads)
+
+    def answer(thread_index):
+        rng = random.Random(thread_index)
+        username = "user{}".format(thread_index)
+        barrier.wait()
+        for _ in range(N_ANSWERS):
+            shown = {"hand_id" : rng.choice(HAND_IDS), "correct_answer" : "SA"}
+            player_elo = quiz.lookup_user_elo(username, test_storage, rating_updater)
+            quiz.grade_answer(shown, username, rng.choice(["SA", "HK"]),
+                    player_elo, rating_updater, hand_cache, elo_index, sink)
+
+    # Switch threads often, so gradings of a hand overlap.
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=answer, args=(thread_index,))
+                for thread_index in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    rating_updater.close()
+    sink.close()
+
+    # Replay the logged answers one at a time, in the order logged.
+    usernames, hand_keys, outcomes = replay_ratings.load_answer_events(test_storage)
+    assert len(outcomes) == n_threads*N_ANSWERS
+    player_ids, unique_usernames = replay_ratings.dense_ids(usernames)
+    hand_ids, unique_hand_keys = replay_ratings.dense_ids(hand_keys)
+    player_elos, hand_elos = replay_ratings.replay(player_ids, hand_ids,
+            np.asarray(outcomes, dtype=bool), len(unique_usernames),
+            len(unique_hand_keys))
+
+    # Serial grading is a serial replay; concurrent grading drifts from it
+    # by at most MAX_REPLAY_DRIFT.
+    tolerance = 1e-6 if n_threads == 1 else MAX_REPLAY_DRIFT
+    for hand_id, hand_elo in zip(unique_hand_keys, hand_elos):
+        assert abs(test_storage.get_hand_elo(hand_id) - hand_elo) <= tolerance
+    for username, player_elo in zip(unique_usernames, player_elos):
+        assert abs(test_storage.get_user(username)["elo"] - player_elo) <= tolerance
+
+class FlakyCollection(object):
+    """
+    Stands in for a pymongo collection of elo documents. The first
+    failing_writes bulk writes apply every other update and report the
+    rest as write errors, as an unordered bulk write does.
+    """
+
+    def __init__(self, key_field, keys, failing_writes):
+        self.key_field = key_field
+        self.elos = {key : 1200.0 for key in keys}
+        self.failing_writes = failing_writes
+
+    def _apply(self, selector, update):
+        self.elos[selector[self.key_field]] += update["$inc"]["elo"]
+
+    def update_one(self, selector, update):
+        if self.failing_writes:
+            self.failing_writes -= 1
+            raise pymongo.errors.AutoReconnect("connection lost")
+        self._apply(selector, update)
+
+    def bulk_write(self, operations, ordered=True):
+        write_errors = []
+        for index, operation in enumerate(operations):
+            if self.failing_writes and index % 2:
+                write_errors.append({"index" : index, "code" : 91,
+                    "errmsg" : "shutdown in progress"})
+            else:
+                self._apply(operation._filter, operation._doc)
+        if write_errors:
+            self.failing_writes -= 1
+            raise pymongo.errors.BulkWriteError({"writeErrors" : write_errors})
+
+def test_partial_write_retries_only_unapplied():
+    hand_ids = ["hand{}".format(index) for index in range(5)]
+    usernames = ["user{}".format(index) for index in range(3)]
+    mongo_storage = storage.MongoStorage({"hands" : FlakyCollection("_id", hand_ids, 1),
+        "user" : FlakyCollection("username", usernames, 1), "events" : None,
+        "meta" : None})
+
+    # A long flush interval keeps the deltas queued until flush(), which
+    # writes them in one call failing partway for both hands and users.
+    rating_updater = rating_updates.RatingUpdater(mongo_storage, flush_interval=3600.0)
+    expected = {}
+    for index, hand_id in enumerate(hand_ids):
+        username = usernames[index % len(usernames)]
+        rating_updater.add(hand_id, index + 1.0, username, 10.0)
+        expected[hand_id] = index + 1.0
+        expected[username] = expected.get(username, 0.0) + 10.0
+    rating_updater.flush()
+    stats = rating_updater.stats()
+    assert stats["failures"] == 1
+    assert 0 < stats["pending"] < len(hand_ids) + len(usernames)
+
+    # The retry writes only what did not apply.
+    rating_updater.flush()
+    assert rating_updater.stats()["pending"] == 0
+
+    # Each delta counts exactly once.
+    for collection in [mongo_storage.hands, mongo_storage.users]:
+        for key, elo in collection.elos.items():
+            assert elo == pytest.approx(1200.0 + expected[key])
+    rating_updater.close()
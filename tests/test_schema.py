@@ -0,0 +1,135 @@
+"""
+Tests of the query plan checks in schema.py: every declared query must
+use an index, on SQLite through EXPLAIN QUERY PLAN, and on Mongo against
+the declared indexes.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import os
+import sqlite3
+import sys
+
+# Shared modules live in the repository root.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import schema
+import storage
+
+# Statements of SQLiteStorage which read every row by design.
+SQLITE_FULL_READS = ["SELECT doc FROM hands", "SELECT doc FROM users"]
+
+def open_sqlite(tmp_path):
+    """Create a SQLite database with the backend's tables and indexes."""
+
+    path = str(tmp_path / "bridge.sqlite3")
+    storage.open_storage("sqlite", path).close()
+    return sqlite3.connect(path)
+
+def test_sqlite_queries_use_indexes(tmp_path):
+    assert schema.check_sqlite_query_plans(open_sqlite(tmp_path)) == []
+
+def test_sqlite_check_reports_table_scans(tmp_path):
+    connection = open_sqlite(tmp_path)
+    connection.execute("DROP INDEX events_event_type_timestamp")
+    connection.execute("DROP INDEX events_timestamp")
+
+    assert "answer history" in schema.check_sqlite_query_plans(connection)
+
+class RecordingConnection(object):
+    """Wraps a sqlite3 connection, recording the SQL of every execute()."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = []
+
+    def execute(self, sql, *args):
+        self.statements.append(sql)
+        return self.connection.execute(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+def test_sqlite_queries_are_declared(tmp_path):
+    # Run every read of the backend, recording the statements it issues.
+    test_storage = storage.open_storage("sqlite", str(tmp_path / "bridge.sqlite3"))
+    test_storage.put_hands([{"_id" : "hand id", "elo" : 1200.0}])
+    test_storage.put_users([{"username" : "guest", "elo" : 1200.0}])
+    connection = RecordingConnection(test_storage._connection())
+    test_storage._local.connection = connection
+
+    test_storage.get_hand("hand id")
+    list(test_storage.iter_hands())
+    test_storage.hand_elos()
+    test_storage.get_hand_elo("hand id")
+    test_storage.count_hands()
+    test_storage.update_hand("hand id", {"elo" : 1300.0})
+    test_storage.get_user("guest")
+    list(test_storage.iter_users())
+    test_storage.update_user("guest", {"elo" : 1300.0})
+    test_storage.last_shown_event("guest")
+    test_storage.answer_since("guest", "hand id", 0)
+    list(test_storage.iter_events())
+    list(test_storage.iter_events("answer"))
+    test_storage.read_generation()
+    test_storage.close()
+
+    declared = [sql for _, sql, _ in schema.SQLITE_QUERIES]
+    selects = [sql for sql in connection.statements if sql.startswith("SELECT")]
+    assert selects
+    for sql in selects:
+        assert sql in declared or sql in SQLITE_FULL_READS, sql
+
+class PlannedCollection(object):
+    """
+    Stands in for a pymongo collection, planning a query the way Mongo
+    does for these simple shapes: an index is used if the filter tests
+    its first key, or, with no filter, if the sort starts with it. Each
+    branch of an $or is planned on its own. _id is always indexed.
+    """
+
+    def __init__(self):
+        self.first_keys = {"_id"}
+        self.query = None
+
+    def create_index(self, keys):
+        self.first_keys.add(keys[0][0])
+
+    def find(self, query_filter, projection=None):
+        self.query = (query_filter, None)
+        return self
+
+    def limit(self, n):
+        return self
+
+    def sort(self, sort):
+        self.query = (self.query[0], sort)
+        return self
+
+    def _plan(self, query_filter, sort):
+        if "$or" in query_filter:
+            return {"stage" : "SUBPLAN", "inputStage" : {"stage" : "OR",
+                "inputStages" : [self._plan(branch, sort)
+                    for branch in query_filter["$or"]]}}
+        fields = set(query_filter)
+        if not fields and sort:
+            fields = {sort[0][0]}
+        if fields & self.first_keys:
+            return {"stage" : "FETCH", "inputStage" : {"stage" : "IXSCAN"}}
+        return {"stage" : "COLLSCAN"}
+
+    def explain(self):
+        return {"queryPlanner" : {"winningPlan" : self._plan(*self.query)}}
+
+def test_mongo_queries_use_declared_indexes(monkeypatch):
+    database = {name : PlannedCollection() for name in schema.INDEXES}
+    schema.ensure_indexes(database)
+    assert schema.check_query_plans(database) == []
+
+    # Without the event_type index, the answer history scans the events.
+    indexes = dict(schema.INDEXES)
+    indexes["events"] = [keys for keys in indexes["events"]
+            if keys[0][0] != "event_type"]
+    monkeypatch.setattr(schema, "INDEXES", indexes)
+    database = {name : PlannedCollection() for name in schema.INDEXES}
+    schema.ensure_indexes(database)
+    assert "answer history" in schema.check_query_plans(database)
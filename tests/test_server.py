@@ -0,0 +1,148 @@
+"""
+Tests of server.py over HTTP, on a SQLite database of the sample hands.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import asyncio
+import json
+import os
+import sys
+
+# Shared modules live in the repository root.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import event_sink
+import import_problems
+import rating_updates
+import storage
+from quiz import Quiz
+from server import QuizServer
+
+HANDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+        "data", "hands.json")
+
+async def send(port, method, target, body=b"", cookie=None):
+    """Send one request on a new connection, returning (status, headers, body)."""
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    lines = ["{} {} HTTP/1.1".format(method, target), "Host: localhost",
+            "Connection: close", "Content-Length: {}".format(len(body))]
+    if cookie is not None:
+        lines.append("Cookie: " + cookie)
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+    response = await reader.read()
+    writer.close()
+
+    head, _, response_body = response.partition(b"\r\n\r\n")
+    status_line, *header_lines = head.decode("latin-1").split("\r\n")
+    headers = dict(line.split(": ", 1) for line in header_lines)
+    return int(status_line.split()[1]), headers, json.loads(response_body)
+
+def test_answer_without_session_cookie_is_not_graded_again(tmp_path):
+    test_storage = storage.open_storage("sqlite", str(tmp_path / "bridge.sqlite3"))
+    import_problems.import_file(HANDS_PATH, hand_storage=test_storage)
+    sink = event_sink.EventSink(test_storage, flush_interval=0.05)
+    quiz = Quiz.create(test_storage, sink=sink,
+            rating_updater=rating_updates.RatingUpdater(test_storage))
+    quiz_server = QuizServer(quiz, threads=2)
+
+    async def run():
+        server = await quiz_server.start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        answer = json.dumps({"answer" : "SA"}).encode("utf-8")
+        try:
+            status, headers, _ = await send(port, "GET", "/next?username=alice")
+            assert status == 200
+            cookie = headers["Set-Cookie"].split(";")[0]
+
+            status, _, result = await send(port, "POST", "/answer?username=alice",
+                    answer, cookie)
+            assert status == 200
+            assert result["correct_answer"]
+
+            # Each replay without the cookie is a new session, which must
+            # find the hand already answered.
+            for _ in range(3):
+                status, _, _ = await send(port, "POST", "/answer?username=alice",
+                        answer)
+                assert status == 409
+            status, _, _ = await send(port, "POST", "/answer?username=alice",
+                    answer, cookie)
+            assert status == 409
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    try:
+        asyncio.run(run())
+    finally:
+        quiz_server.close()
+        sink.close()
+        quiz.rating_updater.close()
+
+    # One answer logged, so the rating moved once.
+    assert sum(1 for _ in test_storage.iter_events("answer")) == 1
+
+def test_client_errors_are_answered_not_counted(tmp_path):
+    test_storage = storage.open_storage("sqlite", str(tmp_path / "bridge.sqlite3"))
+    import_problems.import_file(HANDS_PATH, hand_storage=test_storage)
+    sink = event_sink.EventSink(test_storage, flush_interval=0.05)
+    quiz = Quiz.create(test_storage, sink=sink,
+            rating_updater=rating_updates.RatingUpdater(test_storage))
+    quiz_server = QuizServer(quiz, threads=2)
+
+    async def run():
+        server = await quiz_server.start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /next HTTP/1.1\r\nX-Long: " + b"a"*(100*1024)
+                    + b"\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            assert response.startswith(b"HTTP/1.1 431 ")
+
+            # Client errors are not server errors.
+            status, _, _ = await send(port, "POST", "/answer?username=alice",
+                    json.dumps({"answer" : "SA"}).encode("utf-8"))
+            assert status == 409
+            status, _, stats = await send(port, "GET", "/stats")
+            assert status == 200
+            assert stats["server"]["errors"] == 0
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    try:
+        asyncio.run(run())
+    finally:
+        quiz_server.close()
+        sink.close()
+
+def test_next_without_hands_is_unavailable(tmp_path):
+    test_storage = storage.open_storage("sqlite", str(tmp_path / "bridge.sqlite3"))
+    sink = event_sink.EventSink(test_storage, flush_interval=0.05)
+    quiz = Quiz.create(test_storage, sink=sink,
+            rating_updater=rating_updates.RatingUpdater(test_storage))
+    quiz_server = QuizServer(quiz, threads=2)
+
+    async def run():
+        server = await quiz_server.start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            status, _, result = await send(port, "GET", "/next?username=alice")
+            assert status == 503
+            assert result["error"]
+            status, _, _ = await send(port, "POST", "/answer?username=alice",
+                    json.dumps({"answer" : "SA"}).encode("utf-8"))
+            assert status == 409
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    try:
+        asyncio.run(run())
+    finally:
+        quiz_server.close()
+        sink.close()
+        quiz.rating_updater.close()
@@ -1,19 +1,21 @@
 """
 CLI to add new hands to the dataset efficienctly.
 """
-import json
 import os
-import pymongo
-import bson
+import sys
+import time
+
+# Shared modules live in the repository root.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import hand_features
+import storage
 
 def edit_hands_wrapper():
 
     # Load existing hands.
-    client = pymongo.MongoClient()
-    db = client["bridge_problem_database"]
-    hands_collection = db["hands"]
+    hand_storage = storage.get_storage()
 
-    for hand in hands_collection.find({}):
+    for hand in hand_storage.iter_hands():
 
         hand_id_to_edit = hand["_id"]
 
@@ -21,9 +23,15 @@ def edit_hands_wrapper():
         hidden_hands = input("hidden hands?")
         print(hidden_hands)
 
-        query = {"_id" : hand_id_to_edit} # update rows matching this query.
-        update = {"$set" : {"hidden_hands" : hidden_hands}} # update to perform.
+        # The features depend on the hidden hands, so recompute them too.
+        hand["hidden_hands"] = hidden_hands
+        fields = {"hidden_hands" : hidden_hands,
+                "features" : hand_features.compute_features(hand),
+                "updated_at" : time.time()}
+
+        hand_storage.update_hand(hand_id_to_edit, fields)
 
-        hands_collection.update_one(query, update)
+    # Tell running apps to reload their cached hands.
+    hand_storage.bump_generation()
 
 edit_hands_wrapper()